@@ -1,13 +1,20 @@
+import asyncio
 import random
-from openai import OpenAI
-from langchain_openai import OpenAIEmbeddings
+import time
 from langchain_community.vectorstores import FAISS
-from langchain_openai import ChatOpenAI
-from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone import ServerlessSpec
 
 import settings
 from streamlit.logger import get_logger
+from embedding_cache import get_query_embedding_cache, truncate_embeddings
+from answer_cache import get_answer_cache
+from index_manifest import get_manifest_store
+from ingestion import get_ingestion_jobs
+import resources
+from context_packing import ContextCandidate, ContextPacker, PackedContext
+from diversity import diversify_matches
+import tracing
+from cost_model import Usage, chat_usage
+from async_runner import iter_sync, run_sync
 
 
 logger = get_logger(__name__)
@@ -15,37 +22,124 @@ logger = get_logger(__name__)
 class AIGenerator:
     
     last_price_usage = 0
+    last_usage = Usage()
+    last_context = None
+    last_trace = None
 
     def __init__(self, template_prompt, chat_type = "midiacode"):
-        self.pinecone = Pinecone(api_key=settings.PINECONE_API_KEY)
-        self.embeddings = OpenAIEmbeddings(model=settings.EMBEDDING_MODEL_VERSION)
+        # clients and chains are shared by the whole process, see resources
+        self.embeddings = resources.get_embeddings(settings.EMBEDDING_MODEL_VERSION)
+        self.embedding_cache = get_query_embedding_cache(
+            settings.EMBEDDING_MODEL_VERSION, settings.EMBEDDING_MODEL_MAX_DIMENSION)
+        self.answer_cache = get_answer_cache() if settings.ANSWER_CACHE_ENABLED else None
         self.template_prompt = template_prompt
         self.is_generic = chat_type != "midiacode"
+        self.tokenizer = resources.get_tokenizer(settings.LLM_MODEL)
+        self.context_packer = ContextPacker(self.tokenizer)
+
+    def get_cache_version(self, source_id: str):
+        # version of the indexed content, read before the answer is generated
+        return get_manifest_store().get_version(source_id)
+
+    def can_cache_answer(self, source_id: str) -> bool:
+        # an answer generated while the namespace is ingested only saw part of it
+        job = get_ingestion_jobs().get(source_id)
+        return job is None or job.done
+
+    def get_chain(self, streaming=False):
+        prompt = self.template_prompt
+        return resources.get_chain(prompt.template, prompt, settings.LLM_MODEL, streaming)
     
     def retrieve_context(self, query: str, db: FAISS):
         logger.info("Retrieving context for question: %s", query)
-        similar_response = db.similarity_search(query, k=20)
-        return similar_response
+        similar_response = db.similarity_search_with_relevance_scores(query, k=settings.RETRIEVAL_TOP_K)
+        self.last_context = self.context_packer.pack([
+            ContextCandidate(text=doc.page_content, score=score, id=getattr(doc, "id", None))
+            for doc, score in similar_response
+        ])
+        return self.last_context.text
 
-    def retrieve_context_from_remote(self, query: str, db_index, source_id: str):  
+    def embed_query(self, query: str):
         logger.info("Embedding query...")
-        query_embedding = self.embeddings.embed_query(query)
+        with tracing.span("query_embedding"):
+            query_embedding = self.embedding_cache.get_or_compute(query, self.embeddings.embed_query)
+        logger.info("Query embedding cache: %s", self.embedding_cache.stats())
+        return query_embedding
+
+    def retrieve_context_from_remote(self, query: str, db_index, source_id: str, query_embedding=None):  
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        query_embedding = self.fit_query_embedding(query_embedding, db_index.get_namespace_dimension(source_id))
         logger.info("Querying vector database...")
-        results = db_index.query(
-            vector=query_embedding,
-            namespace=source_id,
-            top_k=20,
-            include_values=False,
-            include_metadata=True            
-        )        
+        # with MMR, fetch more matches and their vectors to pick diverse ones
+        use_mmr = settings.RETRIEVAL_MMR_ENABLED
+        with tracing.span("vector_query", source_id):
+            results = db_index.query(
+                vector=query_embedding,
+                namespace=source_id,
+                top_k=settings.RETRIEVAL_FETCH_K if use_mmr else settings.RETRIEVAL_TOP_K,
+                include_values=use_mmr,
+                include_metadata=True            
+            )        
+        return self.pack_matches(query_embedding, results, source_id)
+
+    def fit_query_embedding(self, query_embedding, dimension):
+        # queries are embedded at full size, shortened to the dimension of the namespace
+        if dimension and dimension < len(query_embedding):
+            return truncate_embeddings(query_embedding, dimension).tolist()
+        return query_embedding
+
+    def pack_matches(self, query_embedding, results, source_id: str):
         if not results.matches:
             logger.warning("No matches found in vector database!!!")
+            self.last_context = PackedContext(text=None)
             return None
 
         logger.info("Found %d matches in vector database", len(results.matches))
-        context_text = "\n".join([match.metadata['text'] for match in results.matches])
-        # logger.info("Context text: %s", context_text)
-        return context_text
+        # best matches first, within the token budget of the prompt
+        use_mmr = settings.RETRIEVAL_MMR_ENABLED
+        with tracing.span("context_packing", source_id):
+            if use_mmr:
+                candidates = diversify_matches(query_embedding, results.matches, k=settings.RETRIEVAL_TOP_K)
+            else:
+                candidates = [
+                    ContextCandidate(text=match.metadata['text'], score=match.score, id=match.id)
+                    for match in results.matches
+                ]
+            self.last_context = self.context_packer.pack(candidates, ranked=use_mmr)
+        # logger.info("Context text: %s", self.last_context.text)
+        return self.last_context.text
+
+    async def aembed_query(self, query: str):
+        logger.info("Embedding query...")
+        with tracing.span("query_embedding"):
+            query_embedding = await self.embedding_cache.aget_or_compute(query, self.embeddings.aembed_query)
+        logger.info("Query embedding cache: %s", self.embedding_cache.stats())
+        return query_embedding
+
+    async def aretrieve_context_from_remote(self, query: str, db_index, source_id: str,
+                                            query_embedding=None, dimension=None):
+        """
+        Async version of retrieve_context_from_remote. The namespace dimension
+        lookup runs concurrently with the query embedding.
+        """
+        if query_embedding is None:
+            query_embedding, dimension = await asyncio.gather(
+                self.aembed_query(query), db_index.aget_namespace_dimension(source_id))
+        elif dimension is None:
+            dimension = await db_index.aget_namespace_dimension(source_id)
+        query_embedding = self.fit_query_embedding(query_embedding, dimension)
+        logger.info("Querying vector database...")
+        use_mmr = settings.RETRIEVAL_MMR_ENABLED
+        with tracing.span("vector_query", source_id):
+            results = await db_index.aquery(
+                vector=query_embedding,
+                namespace=source_id,
+                top_k=settings.RETRIEVAL_FETCH_K if use_mmr else settings.RETRIEVAL_TOP_K,
+                include_values=use_mmr,
+                include_metadata=True
+            )
+        return self.pack_matches(query_embedding, results, source_id)
 
     
     def create_text_response(self, question: str, my_vectorstore: FAISS) -> str:
@@ -59,10 +153,8 @@ class AIGenerator:
             str: The generated response.
         """
 
-        logger.info("Creating LLM chain v1...")
-        llm = ChatOpenAI(temperature=0, model=settings.LLM_MODEL)
-        prompt = self.template_prompt
-        chain = prompt | llm
+        logger.info("Getting LLM chain v1...")
+        chain = self.get_chain()
 
         logger.info("Retrieving context for question: %s", question)
         custom_content = self.retrieve_context(question, my_vectorstore)
@@ -81,71 +173,196 @@ class AIGenerator:
 
         logger.info("Generated answer: %s", answer)
 
-        # getting usage of tokens       
-        self.last_price_usage = 0 
-        response_metadata = response.response_metadata
-        if response_metadata:
-            token_usage = response_metadata.get('token_usage')
-            logger.info("Tokens usage: %s", token_usage)
-            if token_usage:                                
-                input_price = token_usage.get('prompt_tokens', 0) * settings.OPEN_AI_GPT_PRICE_PER_INPUT_TOKEN
-                out_price = token_usage.get(
-                    'completion_tokens', 0) * settings.OPEN_AI_GPT_PRICE_PER_OUTPUT_TOKEN
-                self.last_price_usage = input_price + out_price
+        self.set_usage(chat_usage(response, self.tokenizer, lambda: self.template_prompt.format(**inputs)))
         return answer
 
+    def set_usage(self, usage: Usage):
+        logger.info("Usage: %s", usage)
+        self.last_usage = usage
+        self.last_price_usage = usage.cost
+
     def create_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None) -> str:
-        # TODO use doc id to retrieve context from different names
-        logger.info("Creating LLM chain v2...")
-        llm = ChatOpenAI(temperature=0, model=settings.LLM_MODEL)
-        prompt = self.template_prompt
-        logger.info("Use Prompt: %s", prompt)
-        chain = prompt | llm
+        # sync wrapper of the async answer path, for Streamlit and the batch tools
+        return run_sync(self.acreate_text_response_with_remote_db(
+            question, my_vectorstore, source_id, add_midiacode_ads, content_title))
+
+    async def acreate_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None) -> str:
+        # the stage timings of this answer are kept in last_trace
+        with tracing.trace("answer", namespace=source_id) as self.last_trace:
+            return await self._acreate_text_response_with_remote_db(
+                question, my_vectorstore, source_id, add_midiacode_ads, content_title)
 
+    async def _acreate_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None) -> str:
+        # the namespace dimension lookup overlaps the query embedding
+        query_embedding, dimension = await asyncio.gather(
+            self.aembed_query(question), my_vectorstore.aget_namespace_dimension(source_id))
+        cache_version = self.get_cache_version(source_id)
+        if self.answer_cache is not None:
+            cached_answer = self.answer_cache.get(source_id, question, query_embedding, cache_version)
+            logger.info("Answer cache: %s", self.answer_cache.stats())
+            if cached_answer is not None:
+                self.set_usage(Usage())
+                return self.add_footer(cached_answer, add_midiacode_ads)
+
+        # TODO use doc id to retrieve context from different names
         logger.info("Retrieving context for question: %s", question)
-        custom_content = self.retrieve_context_from_remote(question, my_vectorstore, source_id)
+        custom_content = await self.aretrieve_context_from_remote(
+            question, my_vectorstore, source_id, query_embedding=query_embedding, dimension=dimension)
         logger.info("Custom content (truncated): %s ...", custom_content)
 
-        logger.info("Invoking chain...")
+        answer = await self.agenerate_answer(question, custom_content, content_title)
+
+        if answer is None:
+            logger.info(answer)
+            logger.warning("No answer is generated!")
+        elif self.answer_cache is not None and custom_content and self.can_cache_answer(source_id):
+            self.answer_cache.put(source_id, question, query_embedding, answer, cache_version)
+
+        answer = self.add_footer(answer, add_midiacode_ads)
+
+        logger.info("Generated answer: %s", answer)
+        return answer
+
+    def get_chain_inputs(self, question: str, custom_content: str, content_title = None) -> dict:
         inputs = {
             "question": question,
             "custom_content": custom_content
         }
         if self.is_generic:
             inputs["content_title"] = content_title
-        response = chain.invoke(inputs)
+        return inputs
 
-        answer = response.content
+    def generate_answer(self, question: str, custom_content: str, content_title = None) -> str:
+        """
+        Invokes the LLM chain v2 with an already retrieved context, without
+        the answer cache. Sets last_usage and last_price_usage.
 
-        if answer is None:
-            logger.info(answer)
+        Args:
+            question (str): The question string.
+            custom_content (str): The context from retrieve_context_from_remote.
+            content_title (str): Title of the content, used by the generic prompt.
+
+        Returns:
+            str: The generated answer, without footer.
+        """
+        logger.info("Getting LLM chain v2...")
+        chain = self.get_chain()
+        logger.info("Invoking chain...")
+        inputs = self.get_chain_inputs(question, custom_content, content_title)
+        with tracing.span("llm"):
+            response = chain.invoke(inputs)
+
+        self.set_usage(chat_usage(response, self.tokenizer, lambda: self.template_prompt.format(**inputs)))
+        return response.content
+
+    async def agenerate_answer(self, question: str, custom_content: str, content_title = None) -> str:
+        """
+        Async version of generate_answer.
+        """
+        logger.info("Getting LLM chain v2...")
+        chain = self.get_chain()
+        logger.info("Invoking chain...")
+        inputs = self.get_chain_inputs(question, custom_content, content_title)
+        with tracing.span("llm"):
+            response = await chain.ainvoke(inputs)
+
+        self.set_usage(chat_usage(response, self.tokenizer, lambda: self.template_prompt.format(**inputs)))
+        return response.content
+
+    def stream_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None):
+        """
+        Streaming version of create_text_response_with_remote_db.
+
+        Yields the answer tokens as they arrive from the LLM, to be rendered with
+        ``st.write_stream``. ``last_usage`` and ``last_price_usage`` are updated
+        when the stream is exhausted.
+
+        Args:
+            question (str): The question string.
+            my_vectorstore: The vector index returned by VectorRemoteDatabase.
+            source_id (str): The namespace of the source document.
+            add_midiacode_ads (bool): Randomly append the Midiacode footer.
+            content_title (str): Title of the content, used by the generic prompt.
+
+        Yields:
+            str: Pieces of the answer.
+        """
+        # sync wrapper of the async answer path, the stream is consumed from the Streamlit thread
+        return iter_sync(self.astream_text_response_with_remote_db(
+            question, my_vectorstore, source_id, add_midiacode_ads, content_title))
+
+    async def astream_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None):
+        # the stage timings of this answer (including rendering) are kept in last_trace
+        with tracing.trace("answer", namespace=source_id) as self.last_trace:
+            async for piece in self._astream_text_response_with_remote_db(
+                    question, my_vectorstore, source_id, add_midiacode_ads, content_title):
+                yield piece
+
+    async def _astream_text_response_with_remote_db(self, question: str, my_vectorstore, source_id: str, add_midiacode_ads = True, content_title = None):
+        self.set_usage(Usage())
+        # the namespace dimension lookup overlaps the query embedding
+        query_embedding, dimension = await asyncio.gather(
+            self.aembed_query(question), my_vectorstore.aget_namespace_dimension(source_id))
+        cache_version = self.get_cache_version(source_id)
+        if self.answer_cache is not None:
+            cached_answer = self.answer_cache.get(source_id, question, query_embedding, cache_version)
+            logger.info("Answer cache: %s", self.answer_cache.stats())
+            if cached_answer is not None:
+                yield self.add_footer(cached_answer, add_midiacode_ads)
+                return
+
+        logger.info("Getting streaming LLM chain v2...")
+        chain = self.get_chain(streaming=True)
+
+        logger.info("Retrieving context for question: %s", question)
+        custom_content = await self.aretrieve_context_from_remote(
+            question, my_vectorstore, source_id, query_embedding=query_embedding, dimension=dimension)
+
+        logger.info("Streaming chain...")
+        response = None
+        started = time.perf_counter()
+        # time spent by the page between chunks is rendering, not LLM
+        render_seconds = 0.0
+        first_token = True
+        inputs = self.get_chain_inputs(question, custom_content, content_title)
+        async for chunk in chain.astream(inputs):
+            response = chunk if response is None else response + chunk
+            if chunk.content:
+                if first_token:
+                    tracing.record("llm_first_token", time.perf_counter() - started)
+                    first_token = False
+                yielded_at = time.perf_counter()
+                yield chunk.content
+                render_seconds += time.perf_counter() - yielded_at
+        tracing.record("llm", time.perf_counter() - started - render_seconds)
+        tracing.record("render", render_seconds)
+
+        if response is None or not response.content:
             logger.warning("No answer is generated!")
+            return
 
-        if add_midiacode_ads:
+        answer = response.content
+        if self.answer_cache is not None and custom_content and self.can_cache_answer(source_id):
+            self.answer_cache.put(source_id, question, query_embedding, answer, cache_version)
+        footer = self.add_footer("", add_midiacode_ads)
+        if footer:
+            yield footer
+        logger.info("Generated answer: %s", answer + footer)
+
+        # usage is sent in the last chunk of the stream
+        self.set_usage(chat_usage(response, self.tokenizer, lambda: self.template_prompt.format(**inputs)))
+
+    def add_footer(self, answer: str, add_midiacode_ads = True) -> str:
+        # an empty answer returns only the footer, used when streaming
+        if add_midiacode_ads and answer is not None:
             if random.choice(['yes', 'no']) == 'yes':
                 footer_message = "Se preferir, pode acessar nosso site [midiacode.com](https://midiacode.com/) e também solicitar um chat com nossa equipe."
                 answer += "\n\n" + footer_message
-
-        logger.info("Generated answer: %s", answer)
-
-        # getting usage of tokens       
-        self.last_price_usage = 0 
-        response_metadata = response.response_metadata
-        if response_metadata:
-            token_usage = response_metadata.get('token_usage')
-            logger.info("Tokens usage: %s", token_usage)
-            if token_usage:                                
-                input_price = token_usage.get('prompt_tokens', 0) * settings.OPEN_AI_GPT_PRICE_PER_INPUT_TOKEN
-                out_price = token_usage.get(
-                    'completion_tokens', 0) * settings.OPEN_AI_GPT_PRICE_PER_OUTPUT_TOKEN
-                self.last_price_usage = input_price + out_price
-
         return answer
-    
 
     def create_image(self, prompt: str, size="1024x1792", quality="standard"):
         logger.info("Generating image...")
-        client = OpenAI()
+        client = resources.get_openai_client()
 
         response = client.images.generate(
             model=settings.DALLE_MODEL_VERSION,
@@ -157,6 +374,6 @@ class AIGenerator:
         logger.info("Image generation response: %s", response)
         image_url = response.data[0].url
         
-        self.last_price_usage = settings.OPEN_AI_DALLE_PRICE_PER_IMAGE_256X256
+        self.set_usage(Usage(images=1))
         
         return image_url
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+import numpy as np
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class CachedAnswer:
+    """
+    An answer generated for a question of a namespace
+    """
+    question: str
+    answer: str
+    embedding: np.ndarray
+    created_at: float
+    version: Optional[str] = None
+
+
+class SemanticAnswerCache:
+    """
+    Caches LLM answers per namespace (source_id) and serves them for new
+    questions whose embedding is within a cosine similarity threshold of a
+    cached question. Entries are tied to the version of the indexed content
+    (index_manifest.manifest_version), so an answer is not served once the
+    namespace is re-indexed, by this or another process. Entries expire
+    after a TTL and the least recently used ones are evicted when a
+    namespace or the whole cache is full.
+    """
+
+    def __init__(self, similarity_threshold: float = settings.ANSWER_CACHE_SIMILARITY_THRESHOLD,
+                 ttl_seconds: int = settings.ANSWER_CACHE_TTL_SECONDS,
+                 max_items_per_namespace: int = settings.ANSWER_CACHE_MAX_ITEMS_PER_NAMESPACE,
+                 max_namespaces: int = settings.ANSWER_CACHE_MAX_NAMESPACES):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_items_per_namespace = max_items_per_namespace
+        self.max_namespaces = max_namespaces
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.last_similarity = None
+        self._namespaces = OrderedDict()  # namespace -> OrderedDict[question -> CachedAnswer]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _drop_expired(self, entries: OrderedDict, version: Optional[str]):
+        now = time.time()
+        expired = [key for key, entry in entries.items()
+                   if now - entry.created_at > self.ttl_seconds or entry.version != version]
+        for key in expired:
+            del entries[key]
+        self.expired += len(expired)
+
+    def get(self, namespace: str, question: str, embedding, version: str = None) -> Optional[str]:
+        """
+        Returns the cached answer of the most similar question in the namespace.
+
+        Args:
+            namespace (str): The source id (short code or settings.SOURCE_UUID).
+            question (str): The user question, only used for logging.
+            embedding (List[float]): The question embedding.
+            version (str): Version of the indexed content, answers of other versions are dropped.
+
+        Returns:
+            str: The cached answer or None when no question is similar enough.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if entries:
+                self._drop_expired(entries, version)
+            if not entries:
+                self.misses += 1
+                self.last_similarity = None
+                return None
+
+            keys = list(entries.keys())
+            matrix = np.stack([entries[key].embedding for key in keys])
+            similarities = matrix @ query
+            best = int(np.argmax(similarities))
+            self.last_similarity = float(similarities[best])
+            if self.last_similarity < self.similarity_threshold:
+                self.misses += 1
+                logger.info("Answer cache miss for %s (best similarity %.4f)", namespace, self.last_similarity)
+                return None
+
+            entry = entries[keys[best]]
+            entries.move_to_end(keys[best])
+            self._namespaces.move_to_end(namespace)
+            self.hits += 1
+            logger.info("Answer cache hit for %s: %r ~ %r (similarity %.4f)",
+                        namespace, question, entry.question, self.last_similarity)
+            return entry.answer
+
+    def put(self, namespace: str, question: str, embedding, answer: str, version: str = None):
+        if not answer:
+            return
+        with self._lock:
+            entries = self._namespaces.setdefault(namespace, OrderedDict())
+            self._namespaces.move_to_end(namespace)
+            entries[question] = CachedAnswer(
+                question=question,
+                answer=answer,
+                embedding=self._normalize(embedding),
+                created_at=time.time(),
+                version=version
+            )
+            entries.move_to_end(question)
+            while len(entries) > self.max_items_per_namespace:
+                entries.popitem(last=False)
+                self.evictions += 1
+            while len(self._namespaces) > self.max_namespaces:
+                _, dropped = self._namespaces.popitem(last=False)
+                self.evictions += len(dropped)
+
+    def invalidate(self, namespace: str):
+        """
+        Drops all answers of a namespace, called when it is re-indexed. Other
+        processes drop theirs when they see the new manifest version.
+        """
+        with self._lock:
+            if self._namespaces.pop(namespace, None) is not None:
+                self.invalidations += 1
+                logger.info("Answer cache invalidated for namespace %s", namespace)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "namespaces": len(self._namespaces),
+            "items": sum(len(entries) for entries in self._namespaces.values()),
+            "similarity_threshold": self.similarity_threshold,
+            "last_similarity": self.last_similarity,
+        }
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> SemanticAnswerCache:
+    """
+    Returns the process-wide answer cache shared by all Streamlit sessions.
+    """
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache()
+        return _answer_cache
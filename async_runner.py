@@ -0,0 +1,82 @@
+import asyncio
+import queue
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, TypeVar
+from streamlit.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the process-wide event loop, running in a daemon thread. All the
+    async clients (OpenAI, ContentSpot) are used from this loop only, so
+    their connection pools survive Streamlit reruns.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="async-runner", daemon=True).start()
+            logger.info("Started the async runner event loop")
+            _loop = loop
+        return _loop
+
+
+def run_sync(coroutine: Awaitable[T]) -> T:
+    """
+    Runs a coroutine on the process-wide loop and waits for its result, so
+    sync code (the Streamlit script thread, thread pools) can call the
+    async answer path.
+    """
+    loop = get_event_loop()
+    if threading.current_thread().name == "async-runner":
+        raise Exception("run_sync called from the async runner loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def iter_sync(iterator: AsyncIterator[T]) -> Iterator[T]:
+    """
+    Iterates an async generator from sync code, one item at a time (e.g.
+    for ``st.write_stream``). The generator runs in a single task, so its
+    context variables (the answer trace) hold across items, and it only
+    resumes when the consumer asks for the next item. It is closed when the
+    consumer stops early.
+    """
+    loop = get_event_loop()
+    results = queue.Queue()
+    requests = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for item in iterator:
+                results.put((True, item))
+                # False when the consumer stopped
+                if not await requests.get():
+                    break
+        except Exception as e:
+            results.put((False, e))
+        else:
+            results.put((False, None))
+        finally:
+            await iterator.aclose()
+
+    future = asyncio.run_coroutine_threadsafe(pump(), loop)
+    try:
+        while True:
+            has_item, item = results.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+            loop.call_soon_threadsafe(requests.put_nowait, True)
+    finally:
+        if not future.done():
+            loop.call_soon_threadsafe(requests.put_nowait, False)
@@ -0,0 +1,203 @@
+"""
+Offline batch question answering over an indexed namespace.
+
+Reads questions from a JSONL file, one object per line:
+
+    {"id": "q1", "question": "O que é a Midiacode?", "namespace": "...", "content_title": "..."}
+
+("namespace" and "content_title" are optional) and runs retrieval and
+generation for them with a bounded number of concurrent requests. Each
+result is written as a JSONL line with the answer, the retrieved chunk ids,
+the latency of each stage, the tokens and the cost.
+
+Usage:
+    python batch_qa.py questions.jsonl --output answers.jsonl --concurrency 8
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+from langchain.prompts import PromptTemplate
+from streamlit.logger import get_logger
+import settings
+from ai_generator import AIGenerator
+from prompt_template import get_prompt, prompt_template_generic
+from tracing import percentile
+from vector_db_remote import VectorRemoteDatabase
+
+
+logger = get_logger(__name__)
+
+
+def read_questions(path: str) -> List[dict]:
+    """
+    Reads the questions of a JSONL file. A malformed line does not stop the
+    batch: it becomes an item with its ``error``, reported in the results.
+    """
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error("Line %d of %s is not valid JSON: %s", line_number, path, e)
+                questions.append({"id": str(line_number), "question": None,
+                                  "error": f"Line {line_number} of {path} is not valid JSON: {e}"})
+                continue
+            if not isinstance(item, dict) or not item.get("question"):
+                logger.error("Line %d of %s has no question", line_number, path)
+                questions.append({"id": str(line_number), "question": None,
+                                  "error": f"Line {line_number} of {path} has no question"})
+                continue
+            item.setdefault("id", str(line_number))
+            questions.append(item)
+    return questions
+
+
+class BatchQARunner:
+    """
+    Answers a list of questions with a thread pool. Every thread has its own
+    AIGenerator (it keeps per-call state such as the last context and usage),
+    the clients behind them are shared. The answer cache is bypassed so every
+    question goes through retrieval and generation.
+    """
+
+    def __init__(self, prompt: str = "midiacode", namespace: str = settings.SOURCE_UUID,
+                 concurrency: int = settings.BATCH_QA_CONCURRENCY):
+        self.prompt = prompt
+        self.namespace = namespace
+        self.concurrency = max(1, concurrency)
+        self.vector_index = VectorRemoteDatabase().get_vector_index()
+        self._local = threading.local()
+
+    def get_generator(self) -> AIGenerator:
+        ai = getattr(self._local, "ai", None)
+        if ai is None:
+            if self.prompt == "generic":
+                template_prompt = PromptTemplate(
+                    input_variables=["question", "custom_content", "content_title"],
+                    template=prompt_template_generic
+                )
+                ai = AIGenerator(template_prompt=template_prompt, chat_type="qrcode")
+            else:
+                ai = AIGenerator(template_prompt=get_prompt())
+            self._local.ai = ai
+        return ai
+
+    def answer(self, item: dict) -> dict:
+        namespace = item.get("namespace") or self.namespace
+        result = {
+            "id": item["id"],
+            "question": item.get("question"),
+            "namespace": namespace,
+            "answer": None,
+            "chunk_ids": [],
+            "latency": {},
+            "tokens": {},
+            "cost": 0.0,
+            "error": item.get("error"),
+        }
+        if result["error"]:
+            # line that could not be read, see read_questions
+            return result
+        ai = self.get_generator()
+        started = time.perf_counter()
+        try:
+            stage_started = time.perf_counter()
+            query_embedding = ai.embed_query(item["question"])
+            result["latency"]["embed"] = time.perf_counter() - stage_started
+
+            stage_started = time.perf_counter()
+            custom_content = ai.retrieve_context_from_remote(
+                item["question"], self.vector_index, namespace, query_embedding=query_embedding)
+            result["latency"]["retrieve"] = time.perf_counter() - stage_started
+            result["chunk_ids"] = list(ai.last_context.ids) if ai.last_context else []
+
+            stage_started = time.perf_counter()
+            result["answer"] = ai.generate_answer(
+                item["question"], custom_content, item.get("content_title"))
+            result["latency"]["generate"] = time.perf_counter() - stage_started
+            result["tokens"] = {
+                "input_tokens": ai.last_usage.input_tokens,
+                "output_tokens": ai.last_usage.output_tokens,
+                "total_tokens": ai.last_usage.total_tokens,
+                "estimated": ai.last_usage.estimated,
+            }
+            result["cost"] = ai.last_usage.cost
+        except Exception as e:
+            logger.error("Question %s failed: %s", item["id"], e)
+            result["error"] = str(e)
+        result["latency"]["total"] = time.perf_counter() - started
+        return result
+
+    def run(self, questions: List[dict], output_path: str) -> dict:
+        """
+        Answers the questions and writes the results to ``output_path`` as
+        they complete (so not in input order).
+
+        Returns:
+            dict: Summary with throughput, latency percentiles, tokens and cost.
+        """
+        started = time.perf_counter()
+        results = []
+        with open(output_path, "w", encoding="utf-8") as output, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self.answer, item) for item in questions]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                logger.info("Answered %d of %d questions", len(results), len(questions))
+        elapsed = time.perf_counter() - started
+        return self.summarize(results, elapsed)
+
+    def summarize(self, results: List[dict], elapsed: float) -> dict:
+        succeeded = [result for result in results if not result["error"]]
+        summary = {
+            "questions": len(results),
+            "errors": len(results) - len(succeeded),
+            "concurrency": self.concurrency,
+            "elapsed_seconds": elapsed,
+            "questions_per_second": len(results) / elapsed if elapsed else 0.0,
+            "total_tokens": sum(result["tokens"].get("total_tokens", 0) for result in succeeded),
+            "total_cost": sum(result["cost"] for result in succeeded),
+            "latency": {},
+        }
+        for stage in ("embed", "retrieve", "generate", "total"):
+            values = [result["latency"][stage] for result in succeeded if stage in result["latency"]]
+            summary["latency"][stage] = {
+                "p50": percentile(values, 0.5),
+                "p95": percentile(values, 0.95),
+            }
+        return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions offline.")
+    parser.add_argument("questions", help="JSONL file with one question object per line")
+    parser.add_argument("--output", default="answers.jsonl", help="JSONL file for the answers")
+    parser.add_argument("--namespace", default=settings.SOURCE_UUID,
+                        help="Namespace of the questions without one")
+    parser.add_argument("--concurrency", type=int, default=settings.BATCH_QA_CONCURRENCY,
+                        help="Maximum number of questions answered at the same time")
+    parser.add_argument("--prompt", choices=["midiacode", "generic"], default="midiacode",
+                        help="Prompt template: Midiacode guide or generic QR code content")
+    args = parser.parse_args(argv)
+
+    questions = read_questions(args.questions)
+    runner = BatchQARunner(prompt=args.prompt, namespace=args.namespace, concurrency=args.concurrency)
+    summary = runner.run(questions, args.output)
+    json.dump(summary, sys.stdout, indent=2)
+    print()
+    return 0 if summary["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Deterministic local stand-ins for OpenAI and Pinecone, so the benchmarks
+run without network and with the same results on every run.
+"""
+import hashlib
+import re
+import threading
+import time
+from typing import Dict, List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+import settings
+import resources
+from vector_backend import QueryResult, VectorBackend, VectorMatch
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Hashing bag-of-words embeddings: texts sharing words get close vectors,
+    so retrieval still returns relevant chunks.
+    """
+
+    def __init__(self, dimension: int = settings.EMBEDDING_MODEL_MAX_DIMENSION, latency: float = 0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.requests = 0
+        self._word_slots = {}
+
+    def _slot(self, word: str) -> tuple:
+        slot = self._word_slots.get(word)
+        if slot is None:
+            digest = int.from_bytes(hashlib.sha1(word.encode("utf-8")).digest()[:8], "little")
+            slot = (digest % self.dimension, 1.0 if digest >> 63 else -1.0)
+            self._word_slots[word] = slot
+        return slot
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            index, sign = self._slot(word)
+            vector[index] += sign
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+
+class FakeChatModel:
+    """
+    Answers with the first words of the prompt context and reports token
+    usage like the OpenAI chat API.
+    """
+
+    answer_words = 120
+
+    def __init__(self, tokenizer, latency: float = 0.0):
+        self.tokenizer = tokenizer
+        self.latency = latency
+
+    def invoke(self, prompt_value) -> AIMessage:
+        if self.latency:
+            time.sleep(self.latency)
+        prompt = prompt_value.to_string()
+        answer = " ".join(prompt.split()[-self.answer_words:])
+        prompt_tokens = len(self.tokenizer.encode_ordinary(prompt))
+        completion_tokens = len(self.tokenizer.encode_ordinary(answer))
+        token_usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        return AIMessage(
+            content=answer,
+            response_metadata={"token_usage": token_usage},
+            usage_metadata={
+                "input_tokens": prompt_tokens,
+                "output_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        )
+
+
+class FakePineconeBackend(VectorBackend):
+    """
+    In-memory vector backend with the Pinecone request limits. Every
+    request waits ``latency`` seconds, like a network round trip.
+    """
+
+    name = "fake-pinecone"
+    max_upsert_batch_size = settings.PINECONE_UPSERT_MAX_BATCH_SIZE
+    max_upsert_batch_bytes = settings.PINECONE_UPSERT_MAX_BATCH_BYTES
+    max_parallel_upserts = settings.UPSERT_MAX_WORKERS
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self._namespaces: Dict[str, Dict[str, tuple]] = {}
+        self._lock = threading.Lock()
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def namespace_exists(self, namespace: str) -> bool:
+        return namespace in self._namespaces
+
+    def create_namespace(self, namespace: str, dimension: int = settings.EMBEDDING_MODEL_DIMENSION):
+        with self._lock:
+            self._namespaces.setdefault(namespace, {})
+
+    def get_namespace_dimension(self, namespace: str):
+        store = self._namespaces.get(namespace)
+        if not store:
+            return None
+        return len(next(iter(store.values()))[0])
+
+    def upsert(self, vectors: list, namespace: str):
+        self._request()
+        with self._lock:
+            store = self._namespaces.setdefault(namespace, {})
+            for vector_id, values, metadata in vectors:
+                store[str(vector_id)] = (np.asarray(values, dtype=np.float32), metadata or {})
+        return {"upserted_count": len(vectors)}
+
+    def query(self, vector, namespace: str, top_k: int = 20,
+              include_values: bool = False, include_metadata: bool = True) -> QueryResult:
+        self._request()
+        store = self._namespaces.get(namespace)
+        if not store:
+            return QueryResult(matches=[], namespace=namespace)
+        ids = list(store.keys())
+        matrix = np.stack([store[vector_id][0] for vector_id in ids])
+        matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = matrix @ query
+        top = np.argsort(-scores)[:top_k]
+        return QueryResult(matches=[
+            VectorMatch(
+                id=ids[i],
+                score=float(scores[i]),
+                metadata=store[ids[i]][1] if include_metadata else {},
+                values=store[ids[i]][0].tolist() if include_values else None
+            )
+            for i in top.tolist()
+        ], namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, tuple]:
+        self._request()
+        store = self._namespaces.get(namespace, {})
+        return {str(vector_id): (store[str(vector_id)][0].tolist(), store[str(vector_id)][1])
+                for vector_id in ids if str(vector_id) in store}
+
+    def list_ids(self, namespace: str) -> List[str]:
+        self._request()
+        return list(self._namespaces.get(namespace, {}).keys())
+
+    def delete(self, ids: List[str], namespace: str):
+        self._request()
+        with self._lock:
+            store = self._namespaces.get(namespace, {})
+            for vector_id in ids:
+                store.pop(str(vector_id), None)
+
+    def delete_namespace(self, namespace: str):
+        self._request()
+        with self._lock:
+            self._namespaces.pop(namespace, None)
+
+
+def install_fakes(latency: float = 0.0) -> dict:
+    """
+    Replaces the OpenAI and Pinecone clients of the resources registry with
+    the fakes. Must run before AIGenerator / VectorRemoteDatabase are created.
+
+    Args:
+        latency (float): Simulated round trip of every fake request, in seconds.
+
+    Returns:
+        dict: The fake instances, by name.
+    """
+    tokenizer = resources.get_tokenizer(settings.LLM_MODEL)
+    fakes = {
+        "embeddings": FakeEmbeddings(latency=latency),
+        "embeddings_by_dimension": {},
+        "chat": FakeChatModel(tokenizer, latency=latency),
+        "backend": FakePineconeBackend(latency=latency),
+    }
+    chat_runnable = RunnableLambda(fakes["chat"].invoke)
+
+    def get_embeddings(model_name: str = settings.EMBEDDING_MODEL_VERSION,
+                       dimensions: int = settings.EMBEDDING_MODEL_MAX_DIMENSION):
+        if dimensions == fakes["embeddings"].dimension:
+            return fakes["embeddings"]
+        by_dimension = fakes["embeddings_by_dimension"]
+        if dimensions not in by_dimension:
+            by_dimension[dimensions] = FakeEmbeddings(dimension=dimensions, latency=latency)
+        return by_dimension[dimensions]
+
+    resources.get_embeddings = get_embeddings
+    resources.get_shared_vector_backend = lambda backend_name='': fakes["backend"]
+    resources.get_chain = lambda prompt_key, _prompt, model_name=settings.LLM_MODEL, streaming=False: \
+        _prompt | chat_runnable
+    return fakes
@@ -0,0 +1,112 @@
+"""
+Recall vs memory of the local index types (see settings.LOCAL_INDEX_TYPE)
+on the bundled guide.
+
+Every index type is built in a temporary local store from the same
+embeddings. Its top-k results are compared with an exact search, with and
+without the full-precision re-rank:
+
+    python -m benchmarks.index_recall --output index_recall.json
+    python -m benchmarks.index_recall --openai   # real embeddings, needs OPENAI_API_KEY
+
+The fake embeddings need no network, but the real ones give the recall to
+expect in production.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import settings
+from benchmarks.fakes import FakeEmbeddings
+from benchmarks.run import QUESTIONS, create_synthetic_pdf
+
+
+def recall_at_k(expected: list, found: list) -> float:
+    return len(set(expected) & set(found)) / len(expected) if expected else 1.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall vs memory of the local index types.")
+    parser.add_argument("--output", default="index_recall.json", help="JSON report file")
+    parser.add_argument("--top-k", type=int, default=settings.RETRIEVAL_TOP_K)
+    parser.add_argument("--queries", type=int, default=100, help="Chunks also used as queries")
+    parser.add_argument("--synthetic-pages", type=int, default=0,
+                        help="Add a synthetic PDF so the guide has enough vectors to train PQ/IVF")
+    parser.add_argument("--openai", action="store_true", help="Use the OpenAI embeddings")
+    args = parser.parse_args(argv)
+
+    from utils import extract_from_pdf
+    from vector_backend import LOCAL_INDEX_TYPES, LocalFaissBackend
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        chunks = extract_from_pdf(settings.PDF_FILE_PATH_SOURCE)
+        if args.synthetic_pages:
+            synthetic_path = os.path.join(work_dir, "synthetic.pdf")
+            create_synthetic_pdf(synthetic_path, args.synthetic_pages)
+            chunks += extract_from_pdf(synthetic_path)
+        chunks = list(dict.fromkeys(chunks))
+        if args.openai:
+            import resources
+            embeddings = resources.get_embeddings(settings.EMBEDDING_MODEL_VERSION)
+        else:
+            embeddings = FakeEmbeddings()
+        vectors = np.asarray(embeddings.embed_documents(chunks), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        ids = [str(i) for i in range(len(chunks))]
+        metadatas = [{"text": chunk} for chunk in chunks]
+
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(chunks), size=min(args.queries, len(chunks)), replace=False)
+        query_texts = QUESTIONS + [chunks[i][:200] for i in sample]
+        queries = np.asarray([embeddings.embed_query(text) for text in query_texts], dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        top_k = min(args.top_k, len(chunks))
+        expected = [[ids[i] for i in np.argsort(-(vectors @ query))[:top_k]] for query in queries]
+
+        # IVF is meant for large namespaces, let it train on the guide
+        settings.LOCAL_INDEX_IVF_MIN_VECTORS = min(settings.LOCAL_INDEX_IVF_MIN_VECTORS, len(chunks))
+        rerank_factor = settings.LOCAL_INDEX_RERANK_FACTOR
+        results = {}
+        flat_bytes = None
+        for index_type in LOCAL_INDEX_TYPES:
+            print(f"Building {index_type} index on {len(chunks)} vectors...", file=sys.stderr)
+            backend = LocalFaissBackend(base_path=os.path.join(work_dir, index_type))
+            backend.create_namespace(index_type, dimension=vectors.shape[1], index_type=index_type)
+            backend.bulk_upsert(ids, vectors, metadatas, namespace=index_type)
+            stats = backend.memory_stats(index_type)
+            if index_type == "flat":
+                flat_bytes = stats["index_bytes"]
+            result = {**stats, "compression": flat_bytes / stats["index_bytes"]}
+            for label, factor in (("recall_no_rerank", 1), ("recall", rerank_factor)):
+                settings.LOCAL_INDEX_RERANK_FACTOR = factor
+                recalls = [
+                    recall_at_k(expected_ids, [match.id for match in backend.query(
+                        query, namespace=index_type, top_k=top_k, include_metadata=False).matches])
+                    for query, expected_ids in zip(queries, expected)
+                ]
+                result[label] = float(np.mean(recalls))
+            settings.LOCAL_INDEX_RERANK_FACTOR = rerank_factor
+            results[index_type] = result
+
+    report = {
+        "vectors": len(chunks),
+        "dimension": int(vectors.shape[1]),
+        "queries": len(query_texts),
+        "top_k": top_k,
+        "rerank_factor": rerank_factor,
+        "embeddings": "openai" if args.openai else "fake",
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for index_type, result in results.items():
+        print(f"{index_type}: {result['bytes_per_vector']:.0f} bytes/vector ({result['compression']:.1f}x), "
+              f"recall@{top_k} {result['recall']:.3f} (no re-rank {result['recall_no_rerank']:.3f})"
+              + ("" if result["quantized"] or index_type == "flat" else " [not enough vectors to train]"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
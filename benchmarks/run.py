@@ -0,0 +1,258 @@
+"""
+Benchmarks of the ingestion and query hot paths, with local fakes for
+OpenAI and Pinecone (see benchmarks/fakes.py), so they need no network.
+
+Writes a JSON report and compares it with a stored baseline:
+
+    python -m benchmarks.run --output benchmark_report.json
+    python -m benchmarks.run --save-baseline   # after an intended change
+
+Exits with status 1 when a benchmark is slower than the baseline by more
+than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+import numpy as np
+import fitz  # PyMuPDF
+import settings
+from benchmarks.fakes import install_fakes
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+WORDS = (
+    "conteúdo marketing plataforma código qr campanha cliente produto serviço "
+    "relatório dados acesso usuário mobile página documento publicação estúdio "
+    "análise resultado estratégia empresa tecnologia solução integração mídia"
+).split()
+
+QUESTIONS = [
+    "O que é a Midiacode?",
+    "Quais são os produtos e serviços da Midiacode?",
+    "Como funciona o QR Code dinâmico?",
+    "Como publicar um conteúdo no Midiacode Studio?",
+    "Quais relatórios de acesso estão disponíveis?",
+]
+
+
+def create_synthetic_pdf(path: str, pages: int, seed: int = 0):
+    """
+    Writes a PDF with ``pages`` pages of pseudo-random paragraphs. The same
+    seed always gives the same document.
+    """
+    rng = np.random.default_rng(seed)
+    with fitz.open() as doc:
+        for _ in range(pages):
+            paragraphs = []
+            for _ in range(int(rng.integers(4, 9))):
+                words = rng.choice(WORDS, size=int(rng.integers(40, 90)))
+                paragraphs.append(" ".join(words).capitalize() + ".")
+            page = doc.new_page()
+            page.insert_textbox(page.rect + (36, 36, -36, -36), "\n\n".join(paragraphs), fontsize=8)
+        doc.save(path)
+
+
+def measure(func: Callable, repeat: int, setup: Callable = None) -> dict:
+    """
+    Runs ``func(setup())`` ``repeat`` times. Only func is timed.
+
+    Returns:
+        dict: Timings in seconds plus what the last call returned (a dict of extra numbers, or None).
+    """
+    timings = []
+    extra = None
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        extra = func(argument) if setup else func()
+        timings.append(time.perf_counter() - start)
+    result = {
+        "runs": repeat,
+        "median_seconds": statistics.median(timings),
+        "min_seconds": min(timings),
+        "max_seconds": max(timings),
+    }
+    if isinstance(extra, dict):
+        result.update(extra)
+    return result
+
+
+class BenchmarkSuite:
+
+    def __init__(self, work_dir: str, synthetic_pages: int, repeat: int, latency: float):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.fakes = install_fakes(latency=latency)
+        # imported after the fakes are installed
+        from ai_generator import AIGenerator
+        from embedding_cache import QueryEmbeddingCache
+        from prompt_template import get_prompt
+        from vector_db_remote import VectorRemoteDatabase
+
+        settings.ANSWER_CACHE_ENABLED = False
+        self.db = VectorRemoteDatabase()
+        self.ai = AIGenerator(template_prompt=get_prompt())
+        # no query embedding cache: every question is embedded again
+        self.ai.embedding_cache = QueryEmbeddingCache(
+            settings.EMBEDDING_MODEL_VERSION, settings.EMBEDDING_MODEL_MAX_DIMENSION,
+            max_memory_items=0, db_path='')
+
+        self.pdfs = {"bundled": settings.PDF_FILE_PATH_SOURCE}
+        synthetic_path = os.path.join(work_dir, f"synthetic_{synthetic_pages}.pdf")
+        create_synthetic_pdf(synthetic_path, synthetic_pages)
+        self.pdfs[f"synthetic_{synthetic_pages}"] = synthetic_path
+        self.results: Dict[str, dict] = {}
+
+    def add(self, name: str, func: Callable, setup: Callable = None, repeat: int = 0):
+        print(f"Running {name}...", file=sys.stderr)
+        self.results[name] = measure(func, repeat or self.repeat, setup)
+
+    def bench_extraction(self):
+        from rag import RAGService
+        from utils import extract_from_pdf
+        rag_service = RAGService()
+        for label, path in self.pdfs.items():
+            self.add(f"extract_from_pdf[{label}]", lambda: {"chunks": len(extract_from_pdf(path))})
+            self.add(f"process_pdf[{label}]",
+                     lambda: {"pages": rag_service.process_pdf(path)["total_pages"]})
+
+    def get_chunks(self, label: str) -> List[str]:
+        from utils import extract_from_pdf
+        return extract_from_pdf(self.pdfs[label])
+
+    def bench_text(self):
+        from rag import RAGService
+        from utils import split_paragraphs
+        rag_service = RAGService()
+        for label, path in self.pdfs.items():
+            text = rag_service.get_full_text_from_pdf_pages(rag_service.process_pdf(path))
+            self.add(f"split_paragraphs[{label}]",
+                     lambda: {"chunks": len(split_paragraphs(text)), "characters": len(text)})
+            chunks = self.get_chunks(label)
+            self.add(f"token_counting[{label}]", lambda: {"tokens": self.db.count_tokens(chunks)})
+
+    def bench_save_faiss_vectors(self):
+        from langchain_community.vectorstores import FAISS
+        for label in self.pdfs:
+            chunks = list(dict.fromkeys(self.get_chunks(label)))
+            faiss_index = FAISS.from_texts(chunks, self.fakes["embeddings"])
+            namespace = f"benchmark-{label}"
+
+            def save(_):
+                self.db.save_faiss_vectors(faiss_index, namespace)
+                return {"vectors": len(chunks),
+                        "vectors_per_second": self.db.last_ingest_stats["vectors_per_second"]}
+
+            self.add(f"save_faiss_vectors[{label}]", save,
+                     setup=lambda: self.fakes["backend"].delete_namespace(namespace))
+
+    def bench_answers(self):
+        for label in self.pdfs:
+            namespace = f"benchmark-answers-{label}"
+            chunks = list(dict.fromkeys(self.get_chunks(label)))
+            backend = self.fakes["backend"]
+            backend.delete_namespace(namespace)
+            vectors = np.asarray(self.fakes["embeddings"].embed_documents(chunks), dtype=np.float32)
+            backend.bulk_upsert([str(i) for i in range(len(chunks))], vectors,
+                                [{"text": chunk} for chunk in chunks], namespace)
+
+            def answer_all():
+                total_cost = 0.0
+                for question in QUESTIONS:
+                    self.ai.create_text_response_with_remote_db(
+                        question, backend, namespace, add_midiacode_ads=False)
+                    total_cost += self.ai.last_price_usage
+                return {"questions": len(QUESTIONS), "cost": total_cost}
+
+            self.add(f"create_text_response_with_remote_db[{label}]", answer_all)
+
+    def run(self) -> Dict[str, dict]:
+        self.bench_extraction()
+        self.bench_text()
+        self.bench_save_faiss_vectors()
+        self.bench_answers()
+        return self.results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[dict]:
+    """
+    Returns the benchmarks whose median is slower than the baseline median
+    by more than ``tolerance`` (0.2 = 20%).
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median_seconds"] / max(baseline[name]["median_seconds"], 1e-9)
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append({"name": name, "ratio": ratio,
+                                "median_seconds": result["median_seconds"],
+                                "baseline_median_seconds": baseline[name]["median_seconds"]})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ingestion and query hot paths.")
+    parser.add_argument("--output", default="benchmark_report.json", help="JSON report file")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Stored baseline report")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown over the baseline median (0.2 = 20%%)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark")
+    parser.add_argument("--synthetic-pages", type=int, default=200, help="Pages of the synthetic PDF")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="Simulated round trip of each fake OpenAI/Pinecone request")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        suite = BenchmarkSuite(work_dir, args.synthetic_pages, args.repeat, args.latency_ms / 1000)
+        results = suite.run()
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {"repeat": args.repeat, "synthetic_pages": args.synthetic_pages,
+                     "latency_ms": args.latency_ms},
+        "results": results,
+        "regressions": [],
+    }
+    missing_baseline = not args.save_baseline and not os.path.exists(args.baseline)
+    if not args.save_baseline and not missing_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        report["baseline_created_at"] = baseline.get("created_at")
+        report["regressions"] = compare(results, baseline["results"], args.tolerance)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}", file=sys.stderr)
+
+    for name, result in results.items():
+        ratio = result.get("baseline_ratio")
+        print(f"{name}: {result['median_seconds'] * 1000:.1f} ms"
+              + (f" ({ratio:.2f}x baseline)" if ratio else ""))
+    for regression in report["regressions"]:
+        print(f"REGRESSION {regression['name']}: {regression['ratio']:.2f}x slower than the baseline")
+    if missing_baseline:
+        # a run without a baseline checks nothing, it must not pass as green
+        print(f"WARNING no baseline at {args.baseline}, nothing was compared. "
+              f"Store one on this machine with --save-baseline", file=sys.stderr)
+        return 2
+    return 1 if report["regressions"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
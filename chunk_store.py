@@ -0,0 +1,115 @@
+import json
+import mmap
+import os
+from typing import Iterable
+import numpy as np
+
+
+class ChunkStore:
+    """
+    Append-only store of chunk records (JSON objects with the chunk text and
+    metadata), addressed by position.
+
+    Layout: ``<name>.bin`` has an 8 byte magic followed by the UTF-8 JSON
+    records one after the other, ``<name>.idx`` the end offset of each
+    record (uint64, relative to the first record). Both files are memory
+    mapped, so opening a store costs nothing, only the records that are read
+    are decoded, and every process that opens it shares the same page cache.
+
+    Records written after the store was opened are not seen, open it again
+    to read them. Opened with ``count``, the store also ignores the records
+    after that position, e.g. the ones a writer has not committed yet.
+    """
+
+    MAGIC = b"AICHUNK2"
+
+    def __init__(self, path: str, count: int = None):
+        self.path = path
+        index_path = self.get_index_path(path)
+        available = os.path.getsize(index_path) // 8
+        count = available if count is None else min(count, available)
+        # the offsets are mapped before the records, so every offset points to written data
+        self._index = None
+        self._ends = np.zeros(0, dtype="<u8")
+        if count:
+            with open(index_path, "rb") as f:
+                self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._ends = np.frombuffer(self._index, dtype="<u8", count=count)
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(self.MAGIC)] != self.MAGIC:
+            raise Exception(f"Invalid chunk store: {path}")
+
+    @staticmethod
+    def get_index_path(path: str) -> str:
+        return os.path.splitext(path)[0] + ".idx"
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def __getitem__(self, position: int) -> dict:
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        start = len(self.MAGIC) + (int(self._ends[position - 1]) if position else 0)
+        end = len(self.MAGIC) + int(self._ends[position])
+        return json.loads(self._data[start:end].decode("utf-8"))
+
+    @classmethod
+    def append(cls, path: str, records: Iterable[dict], count: int = None) -> int:
+        """
+        Appends records to the store at ``path``, which is created when missing.
+
+        Args:
+            path (str): The records file of the store (``<name>.bin``).
+            records (Iterable[dict]): JSON serializable records, in position order.
+            count (int): Records to keep before the new ones. Records after it,
+                left by an interrupted writer, are overwritten. Default: all.
+
+        Returns:
+            int: The number of records in the store.
+        """
+        index_path = cls.get_index_path(path)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(cls.MAGIC)
+            open(index_path, "wb").close()
+        available = os.path.getsize(index_path) // 8
+        count = available if count is None else count
+        if count > available:
+            raise Exception(f"Chunk store {path} has {available} records, {count} expected")
+
+        encoded = [json.dumps(record, ensure_ascii=False).encode("utf-8") for record in records]
+        with open(path, "r+b") as data_file, open(index_path, "r+b") as index_file:
+            end = 0
+            if count:
+                index_file.seek((count - 1) * 8)
+                end = int(np.frombuffer(index_file.read(8), dtype="<u8")[0])
+            ends = np.uint64(end) + np.cumsum(np.array([len(data) for data in encoded], dtype="<u8"))
+            # records first: the offsets only point to data that is written
+            data_file.truncate(len(cls.MAGIC) + end)
+            data_file.seek(len(cls.MAGIC) + end)
+            for data in encoded:
+                data_file.write(data)
+            data_file.flush()
+            index_file.truncate(count * 8)
+            index_file.seek(count * 8)
+            index_file.write(ends.astype("<u8").tobytes())
+        return count + len(encoded)
+
+    @classmethod
+    def write(cls, path: str, records: Iterable[dict]) -> int:
+        """
+        Writes a new store at ``path`` with the records, replacing any
+        previous one atomically (stores already open keep the old files).
+
+        Returns:
+            int: The number of records written.
+        """
+        tmp_path = os.path.splitext(path)[0] + ".tmp.bin"
+        for file_path in (tmp_path, cls.get_index_path(tmp_path)):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        count = cls.append(tmp_path, records)
+        os.replace(cls.get_index_path(tmp_path), cls.get_index_path(path))
+        os.replace(tmp_path, path)
+        return count
@@ -0,0 +1,287 @@
+import re
+from collections import Counter
+from typing import AbstractSet, Iterable, Iterator, List, Optional, Tuple
+import settings
+import resources
+from pdf_extractor import PDFPage, TextChunk
+
+
+SENTENCE_END = (".", "!", "?", ":", ";")
+BULLET_PATTERN = re.compile(r"^([•▪◦·*–-]|\d+[.)])\s+")
+NUMBERED_HEADING_PATTERN = re.compile(r"^\d+(\.\d+)*\.?\s+\S")
+NAMED_HEADING_PATTERN = re.compile(
+    r"^(cap[ií]tulo|se[cç][aã]o|parte|anexo|ap[eê]ndice|chapter|section|part|appendix)\b", re.IGNORECASE)
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[\"“(\[]?[A-ZÀ-Ý0-9])")
+HEADING_MAX_WORDS = 12
+HEADING_MAX_CHARS = 100
+RUNNING_LINE_EDGE = 3  # lines at the top and at the bottom of a page that can be running headers
+RUNNING_LINE_MIN_PAGES = 2
+
+
+def starts_block(line: str) -> bool:
+    """
+    True when a line can start a paragraph: empty (end of page), uppercase,
+    a digit or a bullet.
+    """
+    return not line or line[0].isupper() or line[0].isdigit() or bool(BULLET_PATTERN.match(line))
+
+
+def is_heading(line: str, next_line: str, previous_line: str = "") -> bool:
+    """
+    Heuristic for the headings of PDF text: a short line without final
+    punctuation that is numbered, named ("Capítulo 2"), in capitals, or
+    set apart from the previous text (blank line or start of the page) and
+    followed by the start of a paragraph.
+    """
+    if len(line) > HEADING_MAX_CHARS or len(line.split()) > HEADING_MAX_WORDS:
+        return False
+    if line.endswith(SENTENCE_END + (",",)) or \
+            (BULLET_PATTERN.match(line) and not NUMBERED_HEADING_PATTERN.match(line)):
+        return False
+    if not (line[0].isupper() or line[0].isdigit()):
+        return False
+    if NUMBERED_HEADING_PATTERN.match(line) or NAMED_HEADING_PATTERN.match(line):
+        return True
+    letters = [char for char in line if char.isalpha()]
+    if len(letters) > 1 and all(char.isupper() for char in letters):
+        return True
+    return not previous_line and bool(next_line) and starts_block(next_line)
+
+
+def running_line_key(line: str) -> str:
+    # page numbers change from page to page, "Página 3 de 10" and "Página 4 de 10" are the same line
+    return re.sub(r"\d+", "#", line.strip().casefold())
+
+
+class RunningLines:
+    """
+    Detects the running headers and footers of a document while its pages
+    are streamed: lines at the top or bottom of a page that repeat on most
+    of the pages seen so far (document title, "Página 3 de 10").
+    """
+
+    def __init__(self, edge: int = RUNNING_LINE_EDGE, min_pages: int = RUNNING_LINE_MIN_PAGES):
+        self.edge = edge
+        self.min_pages = min_pages
+        self.pages = 0
+        self.counts = Counter()
+
+    def add_page(self, text: str) -> AbstractSet[str]:
+        """
+        Counts the edge lines of a page and returns the keys (see
+        running_line_key) of its running lines.
+        """
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        keys = {running_line_key(line) for line in lines[:self.edge] + lines[-self.edge:]}
+        self.counts.update(keys)
+        self.pages += 1
+        return {key for key in keys if self.counts[key] >= self.min_pages and self.counts[key] > self.pages / 2}
+
+
+def join_lines(lines: List[str]) -> str:
+    """
+    Joins the wrapped lines of a paragraph, merging words hyphenated at the end of a line.
+    """
+    text = ""
+    for line in lines:
+        if text.endswith("-") and len(text) > 1 and text[-2].isalpha() and line[:1].islower():
+            text = text[:-1] + line
+        elif text:
+            text += " " + line
+        else:
+            text = line
+    return text
+
+
+def iter_blocks(text: str, skip_lines: AbstractSet[str] = frozenset()) -> Iterator[Tuple[str, str]]:
+    """
+    Splits the text of a page in ("heading", text) and ("paragraph", text)
+    blocks. Paragraphs end at blank lines, at bullets, and at lines with
+    final punctuation followed by a line that can start a paragraph.
+    Lines whose running_line_key is in ``skip_lines`` (running headers
+    and footers) are dropped.
+    """
+    lines = [line.strip() for line in text.splitlines()]
+    if skip_lines:
+        lines = [line for line in lines if not line or running_line_key(line) not in skip_lines]
+    paragraph = []
+    for i, line in enumerate(lines):
+        next_line = lines[i + 1] if i + 1 < len(lines) else ""
+        previous_line = lines[i - 1] if i else ""
+        if not line:
+            if paragraph:
+                yield "paragraph", join_lines(paragraph)
+                paragraph = []
+            continue
+        if not paragraph and is_heading(line, next_line, previous_line):
+            yield "heading", line
+            continue
+        if paragraph and BULLET_PATTERN.match(line):
+            yield "paragraph", join_lines(paragraph)
+            paragraph = []
+        paragraph.append(line)
+        if line.endswith(SENTENCE_END) and starts_block(next_line):
+            yield "paragraph", join_lines(paragraph)
+            paragraph = []
+    if paragraph:
+        yield "paragraph", join_lines(paragraph)
+
+
+class _ChunkBuffer:
+    """
+    Pieces (paragraphs or sentences) of the chunk being built, with their
+    token counts.
+    """
+
+    def __init__(self, chunker: "TokenChunker"):
+        self.chunker = chunker
+        self.heading = None
+        self.heading_tokens = 0
+        self.pieces = []  # (text, tokens, continues the previous piece's paragraph, page number)
+        self.tokens = 0
+        self.page_number = None
+
+    @property
+    def budget(self) -> int:
+        """
+        Tokens left for the body of a chunk after its heading.
+        """
+        return self.chunker.max_tokens - self.heading_tokens
+
+    def set_heading(self, heading: str) -> List[TextChunk]:
+        chunks = self.flush()
+        # a heading longer than a chunk leaves room for min_tokens of body
+        tokens = self.chunker.tokenizer.encode_ordinary(heading)
+        limit = max(self.chunker.max_tokens - self.chunker.min_tokens, 1)
+        if len(tokens) > limit:
+            tokens = tokens[:limit]
+            heading = self.chunker.tokenizer.decode(tokens)
+        self.heading = heading
+        self.heading_tokens = len(tokens)
+        return chunks
+
+    def add(self, text: str, tokens: int, continues: bool, page_number: Optional[int]) -> List[TextChunk]:
+        chunks = []
+        if self.pieces and self.tokens + tokens > self.budget:
+            overlap = self._overlap(self.budget - tokens)
+            chunks = self.flush()
+            for piece in overlap:
+                self._append(*piece)
+        self._append(text, tokens, continues, page_number)
+        return chunks
+
+    def _append(self, text: str, tokens: int, continues: bool, page_number: Optional[int]):
+        # the chunk keeps the page of its first piece, also when it is an overlap piece
+        if not self.pieces:
+            self.page_number = page_number
+        self.pieces.append((text, tokens, continues, page_number))
+        self.tokens += tokens
+
+    def _overlap(self, room: int) -> list:
+        # last pieces of the chunk, repeated at the start of the next one
+        overlap = []
+        total = 0
+        limit = min(self.chunker.overlap_tokens, room)
+        for piece in reversed(self.pieces[1:]):
+            if total + piece[1] > limit:
+                break
+            overlap.insert(0, piece)
+            total += piece[1]
+        return overlap
+
+    def flush(self) -> List[TextChunk]:
+        if not self.pieces:
+            return []
+        body = ""
+        for text, _, continues, _ in self.pieces:
+            body += (" " if continues else "\n\n") + text if body else text
+        text = f"{self.heading}\n\n{body}" if self.heading else body
+        chunk = TextChunk(text=text, page_number=self.page_number, section=self.heading)
+        self.pieces = []
+        self.tokens = 0
+        return [chunk]
+
+
+class TokenChunker:
+    """
+    Splits documents in chunks of about ``max_tokens`` tokens (tiktoken)
+    that follow their structure: a chunk never crosses a heading, paragraphs
+    are only split when they are longer than a chunk (by sentences, then by
+    token windows), and chunks end at page boundaries unless the rest of the
+    page is shorter than ``min_tokens``. Running headers and footers are
+    dropped. Each chunk starts with the heading
+    of its section and keeps the page it starts on.
+    """
+
+    def __init__(self, tokenizer=None, max_tokens: int = settings.CHUNK_MAX_TOKENS,
+                 overlap_tokens: int = settings.CHUNK_OVERLAP_TOKENS,
+                 min_tokens: int = settings.CHUNK_MIN_TOKENS):
+        self.tokenizer = tokenizer or resources.get_tokenizer(settings.EMBEDDING_MODEL_VERSION)
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer.encode_ordinary(text))
+
+    def iter_pieces(self, paragraph: str, max_tokens: int = None) -> Iterator[Tuple[str, int, bool]]:
+        """
+        Yields (text, tokens, continues) pieces of a paragraph of at most
+        ``max_tokens`` tokens (default: a whole chunk).
+        """
+        max_tokens = max_tokens or self.max_tokens
+        tokens = self.count(paragraph)
+        if tokens <= max_tokens:
+            yield paragraph, tokens, False
+            return
+        first = True
+        for sentence in SENTENCE_PATTERN.split(paragraph):
+            encoded = self.tokenizer.encode_ordinary(sentence)
+            if len(encoded) <= max_tokens:
+                yield sentence, len(encoded), not first
+                first = False
+                continue
+            # a sentence longer than a chunk (e.g. a table): token windows
+            step = max(max_tokens - self.overlap_tokens, 1)
+            for start in range(0, len(encoded), step):
+                window = encoded[start:start + max_tokens]
+                yield self.tokenizer.decode(window), len(window), not first
+                first = False
+                if start + max_tokens >= len(encoded):
+                    break
+
+    def iter_page_chunks(self, pages: Iterable[PDFPage]) -> Iterator[Tuple[Optional[int], List[TextChunk]]]:
+        """
+        Streams the chunks of the pages: yields (page_number, chunks) after
+        each page, with the chunks completed so far. The chunks still open
+        at the end of the document are yielded with the last page number.
+        """
+        buffer = _ChunkBuffer(self)
+        running_lines = RunningLines()
+        page_number = None
+        for page in pages:
+            page_number = page.page_number
+            chunks = []
+            for kind, text in iter_blocks(page.content, running_lines.add_page(page.content)):
+                if kind == "heading":
+                    chunks += buffer.set_heading(text)
+                    continue
+                # pieces fit in a chunk together with its heading
+                for piece, tokens, continues in self.iter_pieces(text, buffer.budget):
+                    chunks += buffer.add(piece, tokens, continues, page_number)
+            if buffer.tokens >= self.min_tokens:
+                chunks += buffer.flush()
+            yield page_number, chunks
+        remaining = buffer.flush()
+        if remaining:
+            yield page_number, remaining
+
+    def iter_chunks(self, pages: Iterable[PDFPage]) -> Iterator[TextChunk]:
+        for _, chunks in self.iter_page_chunks(pages):
+            yield from chunks
+
+    def split_text(self, text: str) -> List[str]:
+        """
+        Chunks a text without pages, e.g. an HTML page.
+        """
+        return [chunk.text for chunk in self.iter_chunks([PDFPage(page_number=None, content=text)])]
@@ -1,9 +1,127 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from streamlit.logger import get_logger
 import settings
+import tracing
 
 logger = get_logger(__name__)
 
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a TTL.
+    Each entry can have its own TTL (used for the negative cache).
+    """
+
+    def __init__(self, max_items: int, ttl_seconds: float):
+        self.max_items = max_items
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is not _MISSING:
+                value, expires_at = item
+                if time.time() < expires_at:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl_seconds: float = None):
+        ttl_seconds = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl_seconds)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+_session = None
+_session_lock = threading.Lock()
+_async_client = None
+# code -> content, or None for codes ContentSpot does not know
+_content_cache = TTLCache(settings.CONTENT_SPOT_CACHE_SIZE, settings.CONTENT_SPOT_CACHE_TTL_SECONDS)
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the keep-alive session shared by all ContentSpotService instances.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.CONTENT_SPOT_MAX_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def get_source_fingerprint(source_url: str) -> Optional[str]:
+    """
+    Cheap fingerprint of a content source from the validators of its file
+    (HEAD request for ETag, Last-Modified and Content-Length), it changes
+    when the file at the URL is replaced.
+
+    Args:
+        source_url (str): URL of the source file
+
+    Returns:
+        str: Hex SHA-256 of the URL and its validators, None when the server
+        sends no ETag nor Last-Modified (the file has to be downloaded and
+        hashed to know whether it changed)
+    """
+    try:
+        with tracing.span("source_head", source_url):
+            response = get_session().head(
+                source_url, allow_redirects=True, timeout=settings.CONTENT_SPOT_TIMEOUT_SECONDS)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.warning("Could not get the validators of %s: %s", source_url, e)
+        return None
+    validators = {header: response.headers.get(header)
+                  for header in ("ETag", "Last-Modified", "Content-Length") if response.headers.get(header)}
+    if "ETag" not in validators and "Last-Modified" not in validators:
+        logger.info("No ETag nor Last-Modified for %s", source_url)
+        return None
+    source = {"source_url": source_url, **validators}
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Returns the keep-alive async client, only used from the async runner loop.
+    """
+    global _async_client
+    with _session_lock:
+        if _async_client is None:
+            _async_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=settings.CONTENT_SPOT_MAX_WORKERS),
+                timeout=settings.CONTENT_SPOT_TIMEOUT_SECONDS)
+        return _async_client
+
+
 class ContentSpotService:
 
     def __init__(self):
@@ -12,10 +130,13 @@ class ContentSpotService:
             "Midiacode-Applabel": "midiacode",
             "Accept-Language": "pt-BR"
         }
+        self.session = get_session()
+        self.cache = _content_cache
     
     def get_content(self, code: str) -> dict:
         """
-        Retrieves content from ContentSpot API.
+        Retrieves content from ContentSpot API. Responses are cached, unknown
+        codes are cached for a shorter time.
         
         Args:
             code (str): The content code to retrieve
@@ -23,43 +144,85 @@ class ContentSpotService:
         Returns:
             dict: The content data or None if request fails
         """
+        content = self.cache.get(self.get_cache_key(code), _MISSING)
+        if content is not _MISSING:
+            logger.info("Content %s retrieved from cache", code)
+            return content
+
         try:
             querystring = {"code": code}
             url = f"{self.base_url}/content/"
             logger.info(f"GET {url}?{querystring}")
-            response = requests.get(
-                url,
-                headers=self.headers,
-                params=querystring
-            )
-            
-            if response.status_code == 200:
-                logger.info("Content retrieved successfully")
-                return response.json()
-            else:
-                logger.error("Failed to get content. Status code: %d", response.status_code)
-                return None
+            with tracing.span("contentspot", code):
+                response = self.session.get(
+                    url,
+                    headers=self.headers,
+                    params=querystring,
+                    timeout=settings.CONTENT_SPOT_TIMEOUT_SECONDS
+                )
+            return self.handle_response(code, response)
                 
         except requests.exceptions.RequestException as e:
             logger.error("Error fetching content: %s", str(e))
             return None
+
+    async def aget_content(self, code: str) -> dict:
+        """
+        Async version of get_content, with the same cache.
+        """
+        content = self.cache.get(self.get_cache_key(code), _MISSING)
+        if content is not _MISSING:
+            logger.info("Content %s retrieved from cache", code)
+            return content
+
+        try:
+            querystring = {"code": code}
+            url = f"{self.base_url}/content/"
+            logger.info(f"GET {url}?{querystring}")
+            with tracing.span("contentspot", code):
+                response = await get_async_client().get(url, headers=self.headers, params=querystring)
+            return self.handle_response(code, response)
+
+        except httpx.HTTPError as e:
+            logger.error("Error fetching content: %s", str(e))
+            return None
+
+    def get_cache_key(self, code: str) -> tuple:
+        return (code, self.headers["Accept-Language"])
+
+    def handle_response(self, code: str, response) -> dict:
+        """
+        Caches and returns the content of a requests or httpx response.
+        """
+        if response.status_code == 200:
+            logger.info("Content retrieved successfully")
+            content = response.json()
+            self.cache.set(self.get_cache_key(code), content)
+            return content
+        elif response.status_code == 404:
+            logger.error("Content %s not found", code)
+            self.cache.set(self.get_cache_key(code), None,
+                           ttl_seconds=settings.CONTENT_SPOT_NEGATIVE_CACHE_TTL_SECONDS)
+            return None
+        else:
+            logger.error("Failed to get content. Status code: %d", response.status_code)
+            return None
             
     def get_content_by_codes(self, codes: list[str]) -> list:
         """
-        Retrieves multiple contents from ContentSpot API.
+        Retrieves multiple contents from ContentSpot API, concurrently.
         
         Args:
             codes (list[str]): List of content codes to retrieve
             
         Returns:
-            list: List of content data
+            list: List of content data, in the order of the codes
         """
-        results = []
-        for code in codes:
-            content = self.get_content(code)
-            if content:
-                results.append(content)
-        return results
+        if not codes:
+            return []
+        with ThreadPoolExecutor(max_workers=min(settings.CONTENT_SPOT_MAX_WORKERS, len(codes))) as executor:
+            contents = list(executor.map(self.get_content, codes))
+        return [content for content in contents if content]
 
 
 # # Example usage
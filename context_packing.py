@@ -0,0 +1,93 @@
+from dataclasses import dataclass, field
+from typing import List, Optional
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class ContextCandidate:
+    """
+    A retrieved chunk that may go into the prompt
+    """
+    text: str
+    score: float
+    id: Optional[str] = None
+
+
+@dataclass
+class PackedContext:
+    """
+    The context sent to the LLM and what was left out of it
+    """
+    text: Optional[str]
+    ids: List[str] = field(default_factory=list)
+    used_tokens: int = 0
+    candidate_tokens: int = 0
+    dropped_below_floor: int = 0
+    dropped_over_budget: int = 0
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.candidate_tokens - self.used_tokens
+
+
+class ContextPacker:
+    """
+    Assembles the prompt context from retrieved chunks: best scores first,
+    chunks below a similarity floor are dropped and packing stops when the
+    token budget (counted with the LLM tokenizer) is full.
+    """
+
+    separator = "\n"
+
+    def __init__(self, tokenizer, token_budget: int = settings.CONTEXT_TOKEN_BUDGET,
+                 min_score: float = settings.CONTEXT_MIN_SCORE):
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.min_score = min_score
+
+    def pack(self, candidates: List[ContextCandidate], ranked: bool = False) -> PackedContext:
+        """
+        Args:
+            candidates (List[ContextCandidate]): Retrieved chunks with their similarity score.
+            ranked (bool): Candidates are already in the wanted order (e.g. MMR), do not sort by score.
+
+        Returns:
+            PackedContext: The context text (None when nothing is relevant) and packing stats.
+        """
+        if not candidates:
+            return PackedContext(text=None)
+        if not ranked:
+            candidates = sorted(candidates, key=lambda candidate: candidate.score, reverse=True)
+        token_counts = [len(tokens) for tokens in
+                        self.tokenizer.encode_ordinary_batch([candidate.text for candidate in candidates])]
+        separator_tokens = len(self.tokenizer.encode_ordinary(self.separator))
+        packed = PackedContext(
+            text=None,
+            candidate_tokens=sum(token_counts) + separator_tokens * (len(candidates) - 1)
+        )
+
+        texts = []
+        budget_full = False
+        for candidate, tokens in zip(candidates, token_counts):
+            if candidate.score < self.min_score:
+                packed.dropped_below_floor += 1
+                continue
+            cost = tokens + (separator_tokens if texts else 0)
+            if budget_full or packed.used_tokens + cost > self.token_budget:
+                budget_full = True
+                packed.dropped_over_budget += 1
+                continue
+            texts.append(candidate.text)
+            packed.ids.append(candidate.id)
+            packed.used_tokens += cost
+
+        if texts:
+            packed.text = self.separator.join(texts)
+        logger.info("Context packing: %d of %d chunks, %d of %d tokens (saved %d), %d below floor %.2f",
+                    len(texts), len(candidates), packed.used_tokens, packed.candidate_tokens,
+                    packed.saved_tokens, packed.dropped_below_floor, self.min_score)
+        return packed
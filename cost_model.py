@@ -0,0 +1,120 @@
+from dataclasses import asdict, dataclass
+from typing import Callable, List, Tuple
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Usage:
+    """
+    Tokens and images billed by OpenAI for one operation. ``estimated`` is
+    set when some count comes from the local tokenizer instead of the API.
+    """
+    embedding_tokens: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    images: int = 0
+    estimated: bool = False
+
+    def __add__(self, other: "Usage") -> "Usage":
+        return Usage(
+            embedding_tokens=self.embedding_tokens + other.embedding_tokens,
+            input_tokens=self.input_tokens + other.input_tokens,
+            output_tokens=self.output_tokens + other.output_tokens,
+            images=self.images + other.images,
+            estimated=self.estimated or other.estimated,
+        )
+
+    @property
+    def total_tokens(self) -> int:
+        return self.embedding_tokens + self.input_tokens + self.output_tokens
+
+    @property
+    def cost(self) -> float:
+        return COST_MODEL.cost(self)
+
+    def as_dict(self) -> dict:
+        return {**asdict(self), "total_tokens": self.total_tokens, "cost": self.cost}
+
+
+@dataclass(frozen=True)
+class CostModel:
+    """
+    OpenAI prices in USD for embeddings, chat and images.
+    """
+    embedding_per_token: float = settings.OPEN_AI_EMBEDDING_PRICE_PER_TOKEN
+    chat_input_per_token: float = settings.OPEN_AI_GPT_PRICE_PER_INPUT_TOKEN
+    chat_output_per_token: float = settings.OPEN_AI_GPT_PRICE_PER_OUTPUT_TOKEN
+    per_image: float = settings.OPEN_AI_DALLE_PRICE_PER_IMAGE_256X256
+
+    def cost(self, usage: Usage) -> float:
+        return (usage.embedding_tokens * self.embedding_per_token
+                + usage.input_tokens * self.chat_input_per_token
+                + usage.output_tokens * self.chat_output_per_token
+                + usage.images * self.per_image)
+
+
+COST_MODEL = CostModel()
+
+
+def count_tokens(tokenizer, texts: List[str]) -> int:
+    """
+    Counts the tokens of many texts with the native batched encoder, which
+    runs on several threads. Only used when the API does not report usage.
+    """
+    if not texts:
+        return 0
+    encoded = tokenizer.encode_ordinary_batch(texts, num_threads=settings.TOKEN_COUNT_THREADS)
+    return sum(len(tokens) for tokens in encoded)
+
+
+def chat_usage(message, tokenizer=None, render_prompt: Callable[[], str] = None) -> Usage:
+    """
+    Usage of a chat response (an AIMessage, or the sum of the chunks of a
+    stream). Estimated with the tokenizer from the prompt and answer texts
+    when the response has no usage; ``render_prompt`` returns the prompt
+    text and is only called then.
+    """
+    usage_metadata = getattr(message, "usage_metadata", None)
+    if usage_metadata:
+        return Usage(input_tokens=usage_metadata.get("input_tokens", 0),
+                     output_tokens=usage_metadata.get("output_tokens", 0))
+    token_usage = (getattr(message, "response_metadata", None) or {}).get("token_usage")
+    if token_usage:
+        return Usage(input_tokens=token_usage.get("prompt_tokens", 0),
+                     output_tokens=token_usage.get("completion_tokens", 0))
+    if tokenizer is None:
+        logger.warning("Chat response without usage")
+        return Usage(estimated=True)
+    logger.warning("Chat response without usage, counting tokens locally")
+    prompt_text = render_prompt() if render_prompt is not None else ""
+    return Usage(input_tokens=count_tokens(tokenizer, [prompt_text or ""]),
+                 output_tokens=count_tokens(tokenizer, [message.content or ""]),
+                 estimated=True)
+
+
+def embed_documents(embeddings, texts: List[str], tokenizer=None) -> Tuple[List[List[float]], Usage]:
+    """
+    Embeds texts and returns the vectors with the tokens billed for them.
+
+    The texts go through ``embeddings.embed_documents``, so OpenAIEmbeddings
+    keeps its context length splitting, ``chunk_size`` batching and retries.
+    langchain does not return the usage of the requests: the tokens are
+    counted with the tokenizer of the model, the same count the API bills
+    for embeddings.
+
+    Args:
+        embeddings: The langchain embeddings.
+        texts (List[str]): Texts that fit in the model context (chunks).
+        tokenizer: Tokenizer of the embedding model, to count the tokens.
+
+    Returns:
+        Tuple[List[List[float]], Usage]: The vectors, in the order of the texts, and the usage.
+    """
+    vectors = embeddings.embed_documents(texts)
+    if tokenizer is None:
+        return vectors, Usage(estimated=True)
+    return vectors, Usage(embedding_tokens=count_tokens(tokenizer, texts), estimated=True)
@@ -0,0 +1,127 @@
+from typing import List
+import numpy as np
+from streamlit.logger import get_logger
+import settings
+from context_packing import ContextCandidate
+
+
+logger = get_logger(__name__)
+
+
+def mmr_select(query_vector, vectors: np.ndarray, k: int,
+               lambda_mult: float = settings.RETRIEVAL_MMR_LAMBDA,
+               duplicate_threshold: float = settings.RETRIEVAL_DUPLICATE_THRESHOLD) -> List[int]:
+    """
+    Maximal marginal relevance: picks vectors relevant to the query and
+    different from the ones already picked. Vectors closer than
+    ``duplicate_threshold`` to a picked one are skipped as duplicates.
+
+    Args:
+        query_vector: The query embedding.
+        vectors (np.ndarray): Matrix (n, dimension) of the match embeddings.
+        k (int): How many to pick.
+        lambda_mult (float): 1 = relevance only, 0 = diversity only.
+        duplicate_threshold (float): Cosine similarity above which a match is a duplicate.
+
+    Returns:
+        List[int]: Indices of the picked vectors, in pick order.
+    """
+    if len(vectors) == 0:
+        return []
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+
+    selected = [int(np.argmax(relevance))]
+    available = np.ones(len(vectors), dtype=bool)
+    available[selected[0]] = False
+    # highest similarity of each vector to the selected ones
+    max_similarity = similarity[selected[0]].copy()
+    while len(selected) < k:
+        available &= max_similarity < duplicate_threshold
+        if not available.any():
+            break
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return selected
+
+
+def trim_overlap(text: str, kept_texts: List[str], min_overlap: int = settings.RETRIEVAL_MIN_OVERLAP_CHARS) -> str:
+    """
+    Removes from ``text`` the spans it shares with already kept texts: a
+    prefix that repeats the end of a kept text (chunk overlap), a suffix
+    that repeats the start of one, a kept text contained in it, or the
+    whole text if it is contained in one.
+
+    Returns:
+        str: The remaining text, empty when nothing new is left.
+    """
+    for kept in kept_texts:
+        if text in kept:
+            return ""
+        if len(text) < min_overlap or len(kept) < min_overlap:
+            continue
+        # kept inside text: keep what surrounds it
+        position = text.find(kept)
+        if position != -1:
+            text = (text[:position].rstrip() + "\n" + text[position + len(kept):].lstrip()).strip()
+            continue
+        # prefix of text == suffix of kept
+        head = text[:min_overlap]
+        position = kept.find(head, max(0, len(kept) - len(text)))
+        while position != -1:
+            if text.startswith(kept[position:]):
+                text = text[len(kept) - position:]
+                break
+            position = kept.find(head, position + 1)
+        if len(text) < min_overlap:
+            continue
+        # suffix of text == prefix of kept
+        tail = kept[:min_overlap]
+        position = text.find(tail, max(0, len(text) - len(kept)))
+        while position != -1:
+            if kept.startswith(text[position:]):
+                text = text[:position]
+                break
+            position = text.find(tail, position + 1)
+    return text.strip()
+
+
+def diversify_matches(query_vector, matches: list, k: int = settings.RETRIEVAL_TOP_K) -> List[ContextCandidate]:
+    """
+    Turns query matches (with values) into context candidates without
+    near-duplicates: MMR over the match vectors, then removal of the text
+    spans repeated between the picked chunks.
+
+    Args:
+        query_vector: The query embedding.
+        matches (list): VectorMatch list returned with ``include_values=True``.
+        k (int): Maximum number of candidates.
+
+    Returns:
+        List[ContextCandidate]: Candidates in MMR order.
+    """
+    with_values = [match for match in matches if match.values]
+    if len(with_values) != len(matches):
+        logger.warning("Matches without values, skipping MMR")
+        return [ContextCandidate(text=match.metadata['text'], score=match.score, id=match.id)
+                for match in matches[:k]]
+
+    vectors = np.asarray([match.values for match in matches], dtype=np.float32)
+    candidates = []
+    kept_texts = []
+    for index in mmr_select(query_vector, vectors, k):
+        match = matches[index]
+        text = trim_overlap(match.metadata['text'], kept_texts)
+        if not text:
+            continue
+        kept_texts.append(match.metadata['text'])
+        candidates.append(ContextCandidate(text=text, score=match.score, id=match.id))
+    logger.info("Diversity: kept %d of %d matches", len(candidates), len(matches))
+    return candidates
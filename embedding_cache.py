@@ -0,0 +1,230 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, List
+import numpy as np
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a question so trivial variations share the same cache entry.
+
+    Args:
+        query (str): The user question.
+
+    Returns:
+        str: Lowercased question with collapsed whitespace and no surrounding punctuation.
+    """
+    normalized = unicodedata.normalize("NFKC", query).casefold()
+    normalized = re.sub(r'\s+', ' ', normalized)
+    return normalized.strip(" \t\n?!.,;:¿¡")
+
+
+def truncate_embeddings(vectors, dimension: int) -> np.ndarray:
+    """
+    Shortens embeddings to their first ``dimension`` values and normalizes
+    them again. The text-embedding-3 models are trained so the truncated
+    vector is a valid embedding of that size (the API ``dimensions``
+    parameter does the same).
+
+    Args:
+        vectors: One embedding or a matrix of embeddings.
+        dimension (int): Target dimension.
+
+    Returns:
+        np.ndarray: float32 array with the same number of rows.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.shape[-1] < dimension:
+        raise ValueError(f"Cannot truncate {vectors.shape[-1]}-dimensional embeddings to {dimension}")
+    truncated = vectors[..., :dimension]
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    return truncated / np.maximum(norms, 1e-12)
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache of query embeddings: an in-process LRU in front of a
+    persistent SQLite file. Keys are the normalized query text plus the
+    embedding model and dimension, so changing the model never returns
+    vectors of the wrong space.
+    """
+
+    def __init__(self, model_name: str, dimension: int,
+                 max_memory_items: int = settings.QUERY_EMBEDDING_CACHE_SIZE,
+                 max_disk_items: int = settings.QUERY_EMBEDDING_CACHE_DISK_SIZE,
+                 db_path: str = settings.QUERY_EMBEDDING_CACHE_PATH):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.db_path = db_path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = self._connect() if db_path else None
+        # the disk tier is trimmed back to max_disk_items once it grows 10% past it,
+        # so the rows are only counted when an eviction is likely
+        self._disk_high_water = max_disk_items + max(max_disk_items // 10, 1)
+        self._disk_items = self._count_disk() if self._conn is not None else 0
+
+    def _connect(self):
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            " model TEXT NOT NULL,"
+            " dimension INTEGER NOT NULL,"
+            " query TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_access REAL NOT NULL,"
+            " PRIMARY KEY (model, dimension, query))"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS query_embeddings_last_access"
+            " ON query_embeddings (last_access)"
+        )
+        conn.commit()
+        return conn
+
+    def _memory_key(self, normalized: str) -> tuple:
+        return (self.model_name, self.dimension, normalized)
+
+    def get(self, query: str):
+        """
+        Returns the cached embedding for the query or None.
+        """
+        normalized = normalize_query(query)
+        key = self._memory_key(normalized)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT vector FROM query_embeddings WHERE model = ? AND dimension = ? AND query = ?",
+                    (self.model_name, self.dimension, normalized)
+                ).fetchone()
+                if row is not None:
+                    vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                    self._conn.execute(
+                        "UPDATE query_embeddings SET last_access = ? WHERE model = ? AND dimension = ? AND query = ?",
+                        (time.time(), self.model_name, self.dimension, normalized)
+                    )
+                    self._conn.commit()
+                    self._put_memory(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, vector: List[float]):
+        normalized = normalize_query(query)
+        with self._lock:
+            self._put_memory(self._memory_key(normalized), vector)
+            if self._conn is None:
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (model, dimension, query, vector, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (self.model_name, self.dimension, normalized,
+                 np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+            )
+            # upper bound: replaced rows and other processes are settled by _evict_disk
+            self._disk_items += 1
+            if self._disk_items > self._disk_high_water:
+                self._evict_disk()
+            self._conn.commit()
+
+    def _put_memory(self, key: tuple, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _count_disk(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+
+    def _evict_disk(self):
+        total = self._count_disk()
+        overflow = total - self.max_disk_items
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE rowid IN ("
+                " SELECT rowid FROM query_embeddings ORDER BY last_access LIMIT ?)",
+                (overflow,)
+            )
+        self._disk_items = min(total, self.max_disk_items)
+
+    def get_or_compute(self, query: str, embed: Callable[[str], List[float]]) -> List[float]:
+        """
+        Returns the cached embedding or computes it with ``embed`` and stores it.
+
+        Args:
+            query (str): The user question.
+            embed (Callable): Function that embeds the query, e.g. OpenAIEmbeddings.embed_query.
+
+        Returns:
+            List[float]: The query embedding.
+        """
+        vector = self.get(query)
+        if vector is not None:
+            return vector
+        vector = embed(query)
+        self.put(query, vector)
+        return vector
+
+    async def aget_or_compute(self, query: str, aembed: Callable[[str], Awaitable[List[float]]]) -> List[float]:
+        """
+        Async version of get_or_compute, ``aembed`` is e.g. OpenAIEmbeddings.aembed_query.
+        """
+        vector = self.get(query)
+        if vector is not None:
+            return vector
+        vector = await aembed(query)
+        self.put(query, vector)
+        return vector
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_query_embedding_cache(model_name: str = settings.EMBEDDING_MODEL_VERSION,
+                              dimension: int = settings.EMBEDDING_MODEL_MAX_DIMENSION) -> QueryEmbeddingCache:
+    """
+    Returns the process-wide cache for the model/dimension, so the LRU
+    survives Streamlit reruns and is shared by all sessions.
+    """
+    key = (model_name, dimension)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = QueryEmbeddingCache(model_name, dimension)
+        return _caches[key]
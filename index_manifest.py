@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+def chunk_id(text: str) -> str:
+    """
+    Content-derived id of a text chunk: the same text always gets the same
+    vector id, so unchanged chunks are never embedded twice.
+
+    Args:
+        text (str): The chunk text.
+
+    Returns:
+        str: Hex SHA-256 of the chunk text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(file_path: str) -> str:
+    """
+    Hashes a file in blocks, used as a cheap source fingerprint for PDFs.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifest_version(manifest: Optional["IndexManifest"]) -> Optional[str]:
+    """
+    Version of what is indexed in a namespace: changes when its chunks or
+    the dimension of their embeddings change. None without a manifest.
+    """
+    if manifest is None:
+        return None
+    payload = json.dumps([manifest.dimension, sorted(manifest.chunk_ids)])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class IndexManifest:
+    """
+    What is indexed in a namespace: the source fingerprint (e.g. the HTTP
+    validators of the PDF), the hash of the source file, the chunk ids and the dimension
+    of the embeddings
+    """
+    namespace: str
+    fingerprint: Optional[str] = None
+    file_hash: Optional[str] = None
+    chunk_ids: List[str] = field(default_factory=list)
+    dimension: Optional[int] = None
+    updated_at: float = 0.0
+
+
+class ManifestStore:
+    """
+    Keeps one JSON manifest per namespace in settings.INDEX_MANIFEST_PATH
+    """
+
+    def __init__(self, base_path: str = settings.INDEX_MANIFEST_PATH):
+        self.base_path = base_path
+        self._versions = {}  # namespace -> ((mtime, size) of the manifest file, version)
+        self._lock = threading.Lock()
+
+    def get_manifest_path(self, namespace: str) -> str:
+        return os.path.join(self.base_path, f"{namespace}.json")
+
+    def load(self, namespace: str) -> Optional[IndexManifest]:
+        manifest_path = self.get_manifest_path(namespace)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                return IndexManifest(**json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            logger.error("Invalid manifest %s: %s", manifest_path, e)
+            return None
+
+    def get_version(self, namespace: str) -> Optional[str]:
+        """
+        manifest_version of a namespace. The manifest file is only read again
+        when it changes, e.g. saved by the ingestion of another process.
+        """
+        try:
+            stat = os.stat(self.get_manifest_path(namespace))
+        except OSError:
+            return None
+        file_key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._versions.get(namespace)
+        if cached is not None and cached[0] == file_key:
+            return cached[1]
+        version = manifest_version(self.load(namespace))
+        with self._lock:
+            self._versions[namespace] = (file_key, version)
+        return version
+
+    def save(self, manifest: IndexManifest):
+        os.makedirs(self.base_path, exist_ok=True)
+        manifest.updated_at = time.time()
+        manifest_path = self.get_manifest_path(manifest.namespace)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(manifest), f)
+        os.replace(tmp_path, manifest_path)
+
+    def delete(self, namespace: str):
+        manifest_path = self.get_manifest_path(namespace)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+
+_manifest_store = None
+_manifest_store_lock = threading.Lock()
+
+
+def get_manifest_store() -> ManifestStore:
+    """
+    Returns the process-wide manifest store, whose versions are shared by all Streamlit sessions.
+    """
+    global _manifest_store
+    with _manifest_store_lock:
+        if _manifest_store is None:
+            _manifest_store = ManifestStore()
+        return _manifest_store
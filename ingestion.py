@@ -0,0 +1,331 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, Optional, Set
+import numpy as np
+from streamlit.logger import get_logger
+import settings
+from index_manifest import chunk_id
+from pdf_extractor import chunk_metadata, get_page_count, iter_pdf_pages
+from chunking import TokenChunker
+import tracing
+from cost_model import Usage, embed_documents
+from contentspot import get_source_fingerprint
+
+
+logger = get_logger(__name__)
+
+_DONE = object()
+
+
+@dataclass
+class IngestionProgress:
+    """
+    Progress of the ingestion of a namespace, updated while the pipeline runs
+    """
+    namespace: str
+    total_pages: int = 0
+    pages_indexed: int = 0
+    chunks_indexed: int = 0
+    total_tokens: int = 0
+    price_usage: float = 0.0
+    usage: Usage = field(default_factory=Usage)
+    available: bool = False
+    done: bool = False
+    error: Optional[str] = None
+    started: bool = False
+    source_fingerprint: Optional[str] = None
+    requests: int = 1  # sessions that asked for this ingestion
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def fraction(self) -> float:
+        if self.done:
+            return 1.0
+        return self.pages_indexed / self.total_pages if self.total_pages else 0.0
+
+    @property
+    def status(self) -> str:
+        if self.error:
+            return "failed"
+        if self.done:
+            return "done"
+        return "running" if self.started else "queued"
+
+
+class _StageError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class IngestionPipeline:
+    """
+    Streams a PDF into a namespace: page extraction -> chunking -> embedding
+    -> upsert. Each stage runs in its own thread and hands its results to
+    the next one through a bounded queue, so the stages overlap and memory
+    stays at a few batches. The namespace can be queried as soon as the
+    first pages are upserted.
+    """
+
+    def __init__(self, db, queue_size: int = settings.INGESTION_QUEUE_SIZE,
+                 batch_size: int = settings.EMBEDDING_BATCH_SIZE,
+                 available_after_pages: int = settings.INGESTION_AVAILABLE_AFTER_PAGES):
+        self.db = db
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.available_after_pages = available_after_pages
+        self.seen_ids = set()
+        self.namespace = ""
+        self.embeddings = db.embeddings
+        self.chunker = TokenChunker()
+
+    def _put(self, out_queue: queue.Queue, item, stop: threading.Event) -> bool:
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run_stage(self, items: Iterator, out_queue: queue.Queue, stop: threading.Event):
+        try:
+            for item in items:
+                if not self._put(out_queue, item, stop):
+                    return
+            self._put(out_queue, _DONE, stop)
+        except Exception as e:
+            logger.error("Ingestion stage failed: %s", e)
+            self._put(out_queue, _StageError(e), stop)
+
+    def _iter_queue(self, in_queue: queue.Queue, stop: threading.Event) -> Iterator:
+        while not stop.is_set():
+            try:
+                item = in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+
+    def _chunk_pages(self, pages: Iterator, indexed_ids: Set[str]) -> Iterator[tuple]:
+        """
+        Yields (chunks, last_page_number) batches with the chunks not indexed yet.
+        """
+        batch = []
+        for page_number, chunks in self.chunker.iter_page_chunks(pages):
+            for chunk in chunks:
+                text_id = chunk_id(chunk.text)
+                if text_id in self.seen_ids:
+                    continue
+                self.seen_ids.add(text_id)
+                if text_id not in indexed_ids:
+                    batch.append(chunk)
+            # flush at page boundaries, early for the first pages so they are available soon
+            if len(batch) >= self.batch_size or page_number == self.available_after_pages:
+                yield batch, page_number
+                batch = []
+        yield batch, None
+
+    def _embed_batches(self, batches: Iterator[tuple]) -> Iterator[tuple]:
+        for chunks, page_number in batches:
+            vectors = None
+            usage = Usage()
+            if chunks:
+                with tracing.span("embedding_batch", self.namespace):
+                    vectors, usage = embed_documents(
+                        self.embeddings, [chunk.text for chunk in chunks], self.db.tokenizer)
+                vectors = np.asarray(vectors, dtype=np.float32)
+            yield chunks, vectors, usage, page_number
+
+    def run(self, doc_uuid: str, pdf_path: str, indexed_ids: Set[str] = frozenset(),
+            progress: IngestionProgress = None) -> Iterator[IngestionProgress]:
+        """
+        Runs the pipeline and yields the progress after each upserted batch.
+
+        Args:
+            doc_uuid (str): The namespace.
+            pdf_path (str): Path to the downloaded PDF.
+            indexed_ids (Set[str]): Chunk ids already in the namespace, they are not embedded again.
+            progress (IngestionProgress): Progress object to update, created when None.
+
+        Yields:
+            IngestionProgress: The same progress object, updated.
+        """
+        progress = progress or IngestionProgress(namespace=doc_uuid)
+        progress.total_pages = get_page_count(pdf_path)
+        self.seen_ids = set()
+        self.namespace = doc_uuid
+        self.embeddings = self.db.embeddings_for(doc_uuid)
+        started = time.perf_counter()
+        vector_index = self.db.get_vector_index()
+        stop = threading.Event()
+        pages_queue = queue.Queue(maxsize=self.queue_size)
+        batches_queue = queue.Queue(maxsize=self.queue_size)
+        vectors_queue = queue.Queue(maxsize=self.queue_size)
+        stages = [
+            (iter_pdf_pages(pdf_path, bounded=True), pages_queue),
+            (self._chunk_pages(self._iter_queue(pages_queue, stop), indexed_ids), batches_queue),
+            (self._embed_batches(self._iter_queue(batches_queue, stop)), vectors_queue),
+        ]
+        threads = [
+            threading.Thread(target=self._run_stage, args=(items, out_queue, stop), daemon=True)
+            for items, out_queue in stages
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            namespace_created = False
+            for chunks, vectors, usage, page_number in self._iter_queue(vectors_queue, stop):
+                if chunks:
+                    if not namespace_created:
+                        vector_index.create_namespace(doc_uuid, dimension=vectors.shape[1])
+                        namespace_created = True
+                    with tracing.span("upsert_batch", doc_uuid):
+                        vector_index.bulk_upsert(
+                            [chunk_id(chunk.text) for chunk in chunks], vectors,
+                            [chunk_metadata(chunk) for chunk in chunks],
+                            namespace=doc_uuid)
+                    progress.chunks_indexed += len(chunks)
+                    progress.usage = progress.usage + usage
+                    progress.total_tokens = progress.usage.total_tokens
+                    progress.price_usage = progress.usage.cost
+                progress.pages_indexed = page_number or progress.total_pages
+                if not progress.available and \
+                        progress.pages_indexed >= min(self.available_after_pages, progress.total_pages):
+                    vector_index.flush(doc_uuid)
+                    progress.available = True
+                    tracing.record("ingestion_available", time.perf_counter() - started, doc_uuid)
+                logger.info("Ingestion of %s: %d of %d pages, %d chunks",
+                            doc_uuid, progress.pages_indexed, progress.total_pages, progress.chunks_indexed)
+                yield progress
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=5)
+            # also after a failure: the batches upserted so far are valid chunks
+            vector_index.flush(doc_uuid)
+
+
+class IngestionJobs:
+    """
+    Process-wide table of ingestion jobs keyed by namespace, run by a
+    bounded worker pool. A request for a namespace that is already queued
+    or running joins that job (single flight), so a QR code scanned by many
+    people at once is downloaded and embedded only once. A finished job is
+    returned as is for ``job_ttl_seconds`` and dropped from the table after
+    that; failed jobs are retried on the next request.
+    """
+
+    def __init__(self, max_workers: int = settings.INGESTION_WORKERS,
+                 job_ttl_seconds: int = settings.INGESTION_JOB_TTL_SECONDS):
+        self.job_ttl_seconds = job_ttl_seconds
+        self.submitted = 0
+        self.joined = 0
+        self._jobs: Dict[str, IngestionProgress] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingestion")
+        self._lock = threading.Lock()
+
+    def _can_join(self, job: IngestionProgress, source_fingerprint: Optional[str]) -> bool:
+        if not job.done:
+            return True
+        if job.error:
+            return False
+        if source_fingerprint is not None and job.source_fingerprint != source_fingerprint:
+            return False
+        # finished_at is set right after done, a job in between is still fresh
+        return job.finished_at is None or time.time() - job.finished_at < self.job_ttl_seconds
+
+    def _prune(self):
+        # finished jobs are only kept for job_ttl_seconds, the table does not grow with every QR code
+        now = time.time()
+        expired = [doc_uuid for doc_uuid, job in self._jobs.items()
+                   if job.finished_at is not None and now - job.finished_at >= self.job_ttl_seconds]
+        for doc_uuid in expired:
+            del self._jobs[doc_uuid]
+
+    def submit(self, db, doc_uuid: str, source_url: str, source_fingerprint: str = None) -> IngestionProgress:
+        """
+        Queues the ingestion of a PDF, or joins the job of the namespace.
+
+        Args:
+            db (VectorRemoteDatabase): Database that ingests the PDF.
+            doc_uuid (str): The namespace (QR short code).
+            source_url (str): URL of the PDF.
+            source_fingerprint (str): Cheap fingerprint of the source, see ingest_pdf.
+                When None, the job gets it from the HTTP validators of the PDF.
+
+        Returns:
+            IngestionProgress: The progress of the job, updated by the worker.
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(doc_uuid)
+            if job is not None and self._can_join(job, source_fingerprint):
+                job.requests += 1
+                self.joined += 1
+                logger.info("Joining %s ingestion job of %s (%d requests)", job.status, doc_uuid, job.requests)
+                return job
+            job = IngestionProgress(namespace=doc_uuid, source_fingerprint=source_fingerprint)
+            self._jobs[doc_uuid] = job
+            self.submitted += 1
+        logger.info("Queuing ingestion job of %s", doc_uuid)
+        self._executor.submit(self._run, db, job, source_url)
+        return job
+
+    def _run(self, db, job: IngestionProgress, source_url: str):
+        job.started = True
+        try:
+            if job.source_fingerprint is None:
+                # the HEAD request runs in the worker, not on the script thread of the page
+                job.source_fingerprint = get_source_fingerprint(source_url)
+            for _ in db.ingest_pdf(doc_uuid=job.namespace, source_url=source_url,
+                                   source_fingerprint=job.source_fingerprint, progress=job):
+                pass
+        except Exception as e:
+            logger.error("Ingestion of %s failed: %s", job.namespace, e)
+            job.error = str(e)
+            job.done = True
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, doc_uuid: str) -> Optional[IngestionProgress]:
+        return self._jobs.get(doc_uuid)
+
+    def stats(self) -> dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "submitted": self.submitted,
+            "joined": self.joined,
+            **{status: statuses.count(status) for status in ("queued", "running", "done", "failed")},
+        }
+
+
+_ingestion_jobs = None
+_ingestion_jobs_lock = threading.Lock()
+
+
+def get_ingestion_jobs() -> IngestionJobs:
+    """
+    Returns the process-wide ingestion job table shared by all Streamlit sessions.
+    """
+    global _ingestion_jobs
+    with _ingestion_jobs_lock:
+        if _ingestion_jobs is None:
+            _ingestion_jobs = IngestionJobs()
+        return _ingestion_jobs
+
+
+def start_background_ingestion(db, doc_uuid: str, source_url: str,
+                               source_fingerprint: str = None) -> IngestionProgress:
+    """
+    Submits VectorRemoteDatabase.ingest_pdf to the process-wide job table
+    and returns its progress object right away, so the page can poll it.
+    """
+    return get_ingestion_jobs().submit(db, doc_uuid, source_url, source_fingerprint)
@@ -1,5 +1,6 @@
 import streamlit as st
 import settings
+from tracing import start_metrics_exporter
 
 st.set_page_config(
     layout="centered", 
@@ -17,6 +18,8 @@ pg = st.navigation([
     qrcode_page
 ])
 
+start_metrics_exporter()
+
 if "total_cost" not in st.session_state:
     st.session_state.total_cost = 0.0
 
@@ -0,0 +1,195 @@
+"""
+Moves existing namespaces to another embedding dimension.
+
+Two modes:
+
+- ``truncate``: keeps the first values of the stored vectors and normalizes
+  them again. No API call, only valid for smaller dimensions of the
+  text-embedding-3 models.
+- ``reembed``: embeds the chunk texts stored in the metadata again with the
+  new dimension. Costs embedding tokens, works in both directions.
+
+The migrated vectors are written next to the namespace first and the old
+vectors are only deleted once they are all stored: in another Pinecone
+index (one per dimension), or in a temporary directory that replaces the
+local namespace. A failed run leaves the namespace as it was. The new
+dimension is recorded in the index manifest and queries are embedded to
+match from then on.
+
+Usage:
+    python namespace_migration.py NAMESPACE [NAMESPACE ...] --dimension 1024 --mode truncate
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import List
+import numpy as np
+from streamlit.logger import get_logger
+import settings
+import resources
+from answer_cache import get_answer_cache
+from cost_model import Usage, embed_documents
+from embedding_cache import truncate_embeddings
+from namespace_pool import NamespacePool
+from vector_backend import LocalFaissBackend, PineconeBackend
+from vector_db_remote import VectorRemoteDatabase
+
+
+logger = get_logger(__name__)
+
+MIGRATION_MODES = ("truncate", "reembed")
+
+
+def read_namespace(db: VectorRemoteDatabase, namespace: str):
+    """
+    Reads all the vectors of a namespace.
+
+    Returns:
+        tuple: (ids, vectors as a float32 matrix, metadatas).
+    """
+    ids, batches, metadatas = [], [], []
+    for batch_ids, vectors, batch_metadatas in db.get_vector_index().iter_vectors(namespace):
+        ids.extend(batch_ids)
+        batches.append(vectors)
+        metadatas.extend(batch_metadatas)
+    vectors = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+    return ids, vectors, metadatas
+
+
+def write_local_namespace(vector_index: LocalFaissBackend, namespace: str, ids: List[str],
+                          vectors: np.ndarray, metadatas: List[dict], index_type: str):
+    """
+    Builds the migrated namespace in a temporary directory next to the
+    local store and swaps it in once it is written.
+    """
+    os.makedirs(vector_index.base_path, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix=f".{namespace}-migration-", dir=vector_index.base_path)
+    try:
+        # own pool, the namespace being built is not shared with the app
+        target = LocalFaissBackend(base_path=work_dir, pool=NamespacePool())
+        target.create_namespace(namespace, dimension=vectors.shape[1], index_type=index_type)
+        target.bulk_upsert(ids, vectors, metadatas, namespace=namespace)
+        target.flush(namespace)
+        vector_index.replace_namespace(namespace, target.get_namespace_path(namespace))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def write_pinecone_namespace(vector_index: PineconeBackend, namespace: str, ids: List[str],
+                             vectors: np.ndarray, metadatas: List[dict], old_dimension: int):
+    """
+    Upserts the migrated vectors to the index of their dimension, then
+    deletes the namespace from the index of the old one.
+    """
+    dimension = vectors.shape[1]
+    vector_index.create_namespace(namespace, dimension=dimension)
+    try:
+        vector_index.bulk_upsert(ids, vectors, metadatas, namespace=namespace)
+    except Exception:
+        # drop the partial copy, the namespace keeps its old vectors
+        vector_index.delete_namespace(namespace, dimension=dimension)
+        raise
+    vector_index.delete_namespace(namespace, dimension=old_dimension)
+
+
+def migrate_namespace(db: VectorRemoteDatabase, namespace: str, dimension: int,
+                      mode: str = "truncate") -> dict:
+    """
+    Rebuilds a namespace with vectors of another dimension.
+
+    Args:
+        db (VectorRemoteDatabase): Database with the backend of the namespace.
+        namespace (str): The namespace.
+        dimension (int): Target dimension.
+        mode (str): "truncate" or "reembed".
+
+    Returns:
+        dict: Vectors migrated, old and new dimension, seconds and usage.
+    """
+    if mode not in MIGRATION_MODES:
+        raise ValueError(f"Unknown migration mode: {mode}")
+    if not 0 < dimension <= settings.EMBEDDING_MODEL_MAX_DIMENSION:
+        raise ValueError(f"Invalid dimension {dimension} for {db.model_name}")
+    vector_index = db.get_vector_index()
+    if not isinstance(vector_index, (LocalFaissBackend, PineconeBackend)):
+        raise ValueError(f"Migration is not supported for the {vector_index.name} backend")
+    old_dimension = vector_index.get_namespace_dimension(namespace)
+    if old_dimension is None:
+        raise Exception(f"Namespace {namespace} does not exist")
+    stats = {"namespace": namespace, "mode": mode, "old_dimension": old_dimension,
+             "dimension": dimension, "vectors": 0, "seconds": 0.0, "usage": Usage().as_dict()}
+    if old_dimension == dimension:
+        logger.info("Namespace %s already has %d dimensions", namespace, dimension)
+        return stats
+    if mode == "truncate" and dimension > old_dimension:
+        raise ValueError(f"Cannot truncate {namespace} from {old_dimension} to {dimension} dimensions, "
+                         f"use the reembed mode")
+
+    started = time.perf_counter()
+    index_type = vector_index.get_index_type(namespace) if isinstance(vector_index, LocalFaissBackend) else None
+    ids, vectors, metadatas = read_namespace(db, namespace)
+    logger.info("Migrating %d vectors of %s from %d to %d dimensions (%s)",
+                len(ids), namespace, old_dimension, dimension, mode)
+    usage = Usage()
+    if mode == "truncate":
+        vectors = truncate_embeddings(vectors, dimension)
+    else:
+        missing = [vector_id for vector_id, metadata in zip(ids, metadatas) if not metadata.get("text")]
+        if missing:
+            raise Exception(f"{len(missing)} vectors of {namespace} have no text to embed again")
+        embeddings = resources.get_embeddings(db.model_name, dimension)
+        batches = []
+        texts = [metadata["text"] for metadata in metadatas]
+        for i in range(0, len(texts), settings.EMBEDDING_BATCH_SIZE):
+            batch_vectors, batch_usage = embed_documents(
+                embeddings, texts[i:i+settings.EMBEDDING_BATCH_SIZE], db.tokenizer)
+            batches.append(np.asarray(batch_vectors, dtype=np.float32))
+            usage = usage + batch_usage
+        vectors = np.concatenate(batches)
+
+    if isinstance(vector_index, LocalFaissBackend):
+        # keep the index type of the namespace, e.g. one set with set_index_type
+        write_local_namespace(vector_index, namespace, ids, vectors, metadatas, index_type)
+    else:
+        write_pinecone_namespace(vector_index, namespace, ids, vectors, metadatas, old_dimension)
+
+    manifest = db.manifests.load(namespace)
+    if manifest is not None:
+        manifest.dimension = dimension
+        db.manifests.save(manifest)
+    # cached answers keep working, but drop them so the new vectors are used
+    get_answer_cache().invalidate(namespace)
+
+    stats.update(vectors=len(ids), seconds=time.perf_counter() - started, usage=usage.as_dict())
+    logger.info("Namespace %s migrated: %s", namespace, stats)
+    return stats
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Move namespaces to another embedding dimension.")
+    parser.add_argument("namespaces", nargs="+", help="Namespaces to migrate")
+    parser.add_argument("--dimension", type=int, required=True, help="Target embedding dimension")
+    parser.add_argument("--mode", choices=MIGRATION_MODES, default="truncate",
+                        help="Truncate the stored vectors or embed the texts again")
+    parser.add_argument("--backend", default="", help="Vector backend (default: settings.VECTOR_BACKEND)")
+    args = parser.parse_args(argv)
+
+    db = VectorRemoteDatabase(backend_name=args.backend)
+    results = []
+    for namespace in args.namespaces:
+        try:
+            results.append(migrate_namespace(db, namespace, args.dimension, args.mode))
+        except Exception as e:
+            logger.error("Migration of %s failed: %s", namespace, e)
+            results.append({"namespace": namespace, "error": str(e)})
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+class NamespacePool:
+    """
+    Process-wide LRU pool of open namespaces (local indexes and their id
+    maps), shared by all Streamlit sessions. Each entry has an estimated
+    memory size; when the total goes over ``max_bytes`` the least recently
+    used namespaces are dropped. They are saved on disk, so an evicted
+    namespace is simply opened again on its next use.
+    """
+
+    def __init__(self, max_bytes: int = settings.NAMESPACE_POOL_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size in bytes, eviction callback)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the namespace without counting a hit or miss nor touching the LRU order.
+        """
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def put(self, key: Hashable, value: Any, size_bytes: int,
+            on_evict: Callable[[Hashable, Any], None] = None):
+        """
+        Adds or replaces a namespace and evicts the least recently used
+        others while the pool is over its memory cap. The namespace just
+        added is never evicted, even when it is larger than the cap alone.
+        ``on_evict(key, value)`` is called when the namespace is evicted,
+        outside the lock of the pool.
+        """
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= previous[1]
+            self._entries[key] = (value, size_bytes, on_evict)
+            self.total_bytes += size_bytes
+            evicted = self._evict(keep=key)
+        self._notify(evicted)
+
+    def resize(self, key: Hashable, size_bytes: int):
+        """
+        Updates the size of a namespace, e.g. after an upsert.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self._entries[key] = (entry[0], size_bytes, entry[2])
+            self.total_bytes += size_bytes - entry[1]
+            evicted = self._evict(keep=key)
+        self._notify(evicted)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry[1]
+
+    def _evict(self, keep: Hashable) -> list:
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                self._entries.move_to_end(key)
+                key = next(iter(self._entries))
+            value, size_bytes, on_evict = self._entries.pop(key)
+            self.total_bytes -= size_bytes
+            self.evictions += 1
+            logger.info("Namespace pool evicted %s (%.1f MB), %.1f of %.1f MB used",
+                        key, size_bytes / 2**20, self.total_bytes / 2**20, self.max_bytes / 2**20)
+            if on_evict is not None:
+                evicted.append((on_evict, key, value))
+        return evicted
+
+    def _notify(self, evicted: list):
+        # the callbacks may write to disk or take the locks of a backend
+        for on_evict, key, value in evicted:
+            on_evict(key, value)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "namespaces": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+_namespace_pool = None
+_namespace_pool_lock = threading.Lock()
+
+
+def get_namespace_pool() -> NamespacePool:
+    """
+    Returns the process-wide namespace pool shared by all Streamlit sessions.
+    """
+    global _namespace_pool
+    with _namespace_pool_lock:
+        if _namespace_pool is None:
+            _namespace_pool = NamespacePool()
+        return _namespace_pool
@@ -10,7 +10,7 @@ import settings
 from vector_db import VectorDatabase
 from vector_db_remote import VectorRemoteDatabase
 from streamlit.logger import get_logger
-from utils import add_sidebar
+from utils import add_sidebar, clear_on_first_chunk
 from prompt_template import get_prompt
 
 logger = get_logger(__name__)
@@ -18,13 +18,6 @@ logger = get_logger(__name__)
 ai = AIGenerator(template_prompt=get_prompt())
 db = VectorRemoteDatabase()
 
-# def streamed_response(question: str, my_vectorstore: FAISS):    
-#     response = ai.create_text_response(question, my_vectorstore)
-#     for word in response.split():
-#         yield word + " "
-#         time.sleep(0.5)
-
-
 st.title(f"Midiacode Chat")
 with st.sidebar:    
     with st.expander("Template do Prompt"):
@@ -99,16 +92,14 @@ if prompt := st.chat_input("Escreva aqui..."):
             thinking_placeholder = st.empty()
             thinking_placeholder.markdown(settings.THINKING_ANIMATION, unsafe_allow_html=True)
             
-            # Generate response
-            answer = ai.create_text_response_with_remote_db(
-                prompt, st.session_state.midiacode_vectorstore, source_id=settings.SOURCE_UUID)                
-            
-            # Replace thinking message with actual response
-            thinking_placeholder.empty()
-            response = st.markdown(answer)                
+            # Stream response, the thinking message is replaced by the first token
+            stream = ai.stream_text_response_with_remote_db(
+                prompt, st.session_state.midiacode_vectorstore, source_id=settings.SOURCE_UUID)
+            answer = st.write_stream(clear_on_first_chunk(thinking_placeholder, stream))
             # Add assistant response to chat history
             st.session_state.messages.append(
                 {"role": "assistant", "content": answer})
+            st.session_state.last_timings = ai.last_trace.timings()
         st.caption(
             f":money_with_wings: Custo estimado para esta interação: {ai.last_price_usage:.6f} USD")
         st.session_state.total_cost += ai.last_price_usage
@@ -1,5 +1,6 @@
+import asyncio
 import streamlit as st
-from utils import add_sidebar
+from utils import add_sidebar, clear_on_first_chunk
 import json
 import re
 from langchain.prompts import PromptTemplate
@@ -9,18 +10,49 @@ import settings
 from ai_generator import AIGenerator
 from vector_db_remote import VectorRemoteDatabase
 from prompt_template import get_prompt, prompt_template_generic
+from ingestion import start_background_ingestion
+from async_runner import run_sync
 
 logger = get_logger(__name__)
 
 # Example: https://1mc.co/zh9gTW
 
-def get_content_data(code: str) -> dict:
-    service = ContentSpotService()
-    content = service.get_content(code)
-    if content:
-        # logger.info(json.dumps(content, indent=4))
-        return content
-    return None
+async def aload_content_data(code: str, vector_index) -> tuple:
+    """
+    Loads the ContentSpot content of a code and, concurrently, checks if its
+    namespace is already indexed. Returns (content, namespace_exists).
+    """
+    content, namespace_exists = await asyncio.gather(
+        ContentSpotService().aget_content(code), vector_index.anamespace_exists(code))
+    logger.info("Namespace %s exists: %s", code, namespace_exists)
+    return content or None, namespace_exists
+
+def show_ingestion_progress(code: str):
+    ingestion = st.session_state[f"{code}_ingestion"]
+    if ingestion.error:
+        st.error(f"😱 Não foi possível processar o conteúdo com o código {code}.")
+        return
+    if ingestion.status == "queued":
+        st.progress(0.0, text="Conteúdo na fila para indexação, aguarde um instante...")
+    elif not ingestion.done:
+        total_pages = ingestion.total_pages or "?"
+        st.progress(ingestion.fraction, text=(
+            f"Indexando o conteúdo: {ingestion.pages_indexed} de {total_pages} páginas. "
+            "O chat começa assim que as primeiras páginas estiverem prontas..."))
+    else:
+        cost_session_id = f"{code}_ingestion_cost"
+        if cost_session_id not in st.session_state:
+            logger.info("Base de conhecimento criada.")
+            st.session_state[cost_session_id] = ingestion.price_usage
+            st.session_state.total_cost += ingestion.price_usage
+        st.caption(f"Base de conhecimento carregada.")
+        st.caption(
+            f":money_with_wings: Custo estimado: {ingestion.price_usage:.6f} USD para esta base de conhecimento.")
+    # the chat is rendered by a full rerun once the first pages are available
+    available_session_id = f"{code}_available"
+    if ingestion.available and available_session_id not in st.session_state:
+        st.session_state[available_session_id] = True
+        st.rerun()
 
 def new_chat():
     url = st.text_input("Entre uma URL 1mc.co (ex: https://1mc.co/140uKUqP)")
@@ -62,7 +94,7 @@ db = VectorRemoteDatabase()
 
 if short_code:    
     with st.spinner('Carregando conteúdo...'):
-        content_data = get_content_data(short_code)
+        content_data, namespace_exists = run_sync(aload_content_data(short_code, db.get_vector_index()))
 
     if not content_data:
         st.error(f"😱 Não foi possível carregar o conteúdo com o código {short_code}.")
@@ -89,20 +121,24 @@ if short_code:
                     short_link = f"https://{short_link}"
                 st.markdown(short_link)  
             # Chat             
-            vector_store_session_id = f"{short_code}_vectorstore"
-            if vector_store_session_id not in st.session_state:
+            ingestion_session_id = f"{short_code}_ingestion"
+            # a failed job is submitted again, the job table retries it
+            if ingestion_session_id not in st.session_state or \
+                    st.session_state[ingestion_session_id].status == "failed":
                 logger.info("Carregando base de conhecimento...")
-                with st.spinner("Carregando base de conhecimento..."):     
-                    message_placeholder = st.empty()
-                    message_placeholder.write("O primeiro acesso ao conteúdo pode levar alguns minutos se o conteúdo for muito grande. Aguarde...")                                
-                    vector_index = db.get_or_create_vectorstore(doc_uuid=short_code, source_url=source_url)
-                    st.session_state[vector_store_session_id] = vector_index
-                    message_placeholder.empty()  # Remove a mensagem após concluir
-                logger.info("Base de conhecimento criada.")
-                st.caption(f"Base de conhecimento carregada.")
-                st.caption(
-                    f":money_with_wings: Custo estimado: {db.price_usage:.6f} USD para esta base de conhecimento.")
-                st.session_state.total_cost += db.price_usage
+                st.session_state[ingestion_session_id] = start_background_ingestion(
+                    db, doc_uuid=short_code, source_url=source_url)
+            ingestion = st.session_state[ingestion_session_id]
+            # an indexed namespace is queried right away, the job only checks the PDF for changes
+            available = ingestion.available or namespace_exists
+            if available:
+                st.session_state[f"{short_code}_available"] = True
+            # polls the ingestion while it runs, the chat starts after the first pages
+            st.fragment(show_ingestion_progress, run_every=None if ingestion.done else 1)(short_code)
+            if (ingestion.error and not namespace_exists) or not available:
+                st.stop()
+            # shared by all sessions, local namespaces are opened through the process-wide pool
+            vector_index = db.get_vector_index()
                         
             # Initialize chat history for this session code
             history_message_id = f"{short_code}_messages"
@@ -142,18 +178,16 @@ if short_code:
                     thinking_placeholder = st.empty()
                     thinking_placeholder.markdown(settings.THINKING_ANIMATION, unsafe_allow_html=True)
                     
-                    # Generate response
-                    answer = ai.create_text_response_with_remote_db(
-                        prompt, st.session_state[vector_store_session_id], source_id=short_code,
+                    # Stream response, the thinking message is replaced by the first token
+                    stream = ai.stream_text_response_with_remote_db(
+                        prompt, vector_index, source_id=short_code,
                         add_midiacode_ads=False,
                         content_title=content_title)
-                    
-                    # Replace thinking message with actual response
-                    thinking_placeholder.empty()
-                    response = st.markdown(answer)                
+                    answer = st.write_stream(clear_on_first_chunk(thinking_placeholder, stream))
                     # Add assistant response to chat history
                     st.session_state[history_message_id].append(
                         {"role": "assistant", "content": answer})
+                    st.session_state.last_timings = ai.last_trace.timings()
                     st.caption(
                         f":money_with_wings: Custo estimado para esta interação: {ai.last_price_usage:.6f} USD")
                     st.session_state.total_cost += ai.last_price_usage
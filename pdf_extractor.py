@@ -0,0 +1,111 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+import fitz  # PyMuPDF
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class PDFPage:
+    """
+    Represents a single page from a PDF document
+    """
+    page_number: int
+    content: str
+
+
+@dataclass
+class TextChunk:
+    """
+    A chunk of text to be embedded and where it comes from
+    """
+    text: str
+    page_number: Optional[int] = None
+    section: Optional[str] = None
+
+
+def chunk_metadata(chunk: TextChunk) -> dict:
+    """
+    Vector metadata of a chunk, without empty fields (Pinecone rejects nulls).
+    """
+    metadata = {"text": chunk.text}
+    if chunk.page_number is not None:
+        metadata["page"] = chunk.page_number
+    if chunk.section:
+        metadata["section"] = chunk.section
+    return metadata
+
+
+def get_page_count(pdf_path: str) -> int:
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+
+def extract_page_range(pdf_path: str, start: int, end: int) -> List[tuple]:
+    """
+    Extracts the text of pages [start, end) of a PDF. Runs in the worker
+    processes, so it opens its own document handle.
+
+    Returns:
+        List[tuple]: (page_number, text) with 1-based page numbers.
+    """
+    pages = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(start, end):
+            pages.append((page_num + 1, doc[page_num].get_text()))
+    return pages
+
+
+def iter_pdf_pages(pdf_path: str, workers: int = 0, pages_per_task: int = 0,
+                   bounded: bool = True) -> Iterator[PDFPage]:
+    """
+    Yields the pages of a PDF in order. Page ranges are extracted by a pool
+    of processes when the document is large enough.
+
+    Args:
+        pdf_path (str): Path to the PDF file.
+        workers (int): Number of processes. Defaults to settings.PDF_EXTRACTION_WORKERS.
+        pages_per_task (int): Pages per task. Defaults to settings.PDF_PAGES_PER_TASK.
+        bounded (bool): Keep at most two tasks per worker in flight, so memory
+            does not grow with the size of the document.
+
+    Yields:
+        PDFPage: The pages of the document.
+    """
+    workers = workers or settings.PDF_EXTRACTION_WORKERS
+    pages_per_task = pages_per_task or settings.PDF_PAGES_PER_TASK
+    total_pages = get_page_count(pdf_path)
+    logger.info("Number of pages: %d", total_pages)
+    ranges = [(start, min(start + pages_per_task, total_pages))
+              for start in range(0, total_pages, pages_per_task)]
+
+    if workers <= 1 or total_pages < settings.PDF_PARALLEL_MIN_PAGES:
+        for start, end in ranges:
+            for page_number, content in extract_page_range(pdf_path, start, end):
+                yield PDFPage(page_number=page_number, content=content)
+        return
+
+    max_pending = workers * 2 if bounded else len(ranges)
+    logger.info("Extracting %d pages with %d processes...", total_pages, workers)
+    # spawn: Streamlit runs the scripts in threads, forking them is not safe
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)), mp_context=context) as executor:
+        remaining = iter(ranges)
+        pending = deque()
+        for start, end in remaining:
+            pending.append(executor.submit(extract_page_range, pdf_path, start, end))
+            if len(pending) >= max_pending:
+                break
+        while pending:
+            pages = pending.popleft().result()
+            next_range = next(remaining, None)
+            if next_range is not None:
+                pending.append(executor.submit(extract_page_range, pdf_path, *next_range))
+            for page_number, content in pages:
+                yield PDFPage(page_number=page_number, content=content)
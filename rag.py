@@ -1,22 +1,13 @@
-import fitz  # PyMuPDF
 from typing import Dict, List
-from dataclasses import dataclass
 import os
 import re
 from streamlit.logger import get_logger
-from utils import split_paragraphs
+from chunking import TokenChunker
+from pdf_extractor import PDFPage, TextChunk, iter_pdf_pages
 
 
 logger = get_logger(__name__)
 
-@dataclass
-class PDFPage:
-    """
-    Represents a single page from a PDF document
-    """
-    page_number: int
-    content: str
-
 class RAGService:
     
     def __init__(self):
@@ -36,17 +27,29 @@ class RAGService:
         Returns:
             str: Raw text content from the PDF
         """
-        pdf_data = self.process_pdf(pdf_path)
-        raw_text = self.get_full_text_from_pdf_pages(pdf_data)
-        # TODO better with the split can be in sections contents like chapters, sections, etc.
-        splited = split_paragraphs(raw_text) # It is important to split paragraphs
-        logger.info("Raw text size: %d", len(splited))
-        logger.info("Raw text: %s", splited)
-        return splited
+        return [chunk.text for chunk in self.get_chunks_from_pdf_file(pdf_path)]
+
+    def get_chunks_from_pdf_file(self, pdf_path: str) -> List[TextChunk]:
+        """
+        Splits a PDF file in text chunks that keep their page number.
+        Pages are streamed from the extractor, so only the chunks are kept in memory.
+
+        Args:
+            pdf_path (str): Path to the PDF file
+
+        Returns:
+            List[TextChunk]: The text chunks of all pages
+        """
+        # chunks follow the headings and paragraphs and end at page boundaries,
+        # so an edit in one page mostly changes the chunks of that page
+        chunks = list(TokenChunker().iter_chunks(iter_pdf_pages(pdf_path, bounded=True)))
+        logger.info("Raw text size: %d", len(chunks))
+        return chunks
 
     def process_pdf(self, pdf_path: str) -> Dict:
         """
-        Processes a PDF file and extracts raw text content
+        Processes a PDF file and extracts raw text content.
+        Large documents are extracted in parallel (see pdf_extractor).
         
         Args:
             pdf_path (str): Path to the PDF file
@@ -60,29 +63,14 @@ class RAGService:
                  }
         """
         try:
-            # Open the PDF document
-            doc = fitz.open(pdf_path)
-            
-            # Extract text from all pages
-            pages = []
-            for page_num, page in enumerate(doc):
-                content = page.get_text()
-                pages.append(PDFPage(
-                    page_number=page_num + 1,
-                    content=content
-                ))
-            
+            pages = list(iter_pdf_pages(pdf_path, bounded=False))
             return {
                 "pages": pages,
-                "total_pages": len(doc),
+                "total_pages": len(pages),
                 "file_path": pdf_path
             }
-            
         except Exception as e:
             raise Exception(f"Error processing PDF: {str(e)}")
-        finally:
-            if 'doc' in locals():
-                doc.close()
 
     def get_full_text_from_pdf_pages(self, pdf_result: Dict) -> str:
         """
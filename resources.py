@@ -0,0 +1,65 @@
+import streamlit as st
+import tiktoken
+from openai import OpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from streamlit.logger import get_logger
+import settings
+from vector_backend import VectorBackend, get_vector_backend
+
+
+logger = get_logger(__name__)
+
+# Process-wide registry of the clients used by the pages. Streamlit reruns the
+# page scripts on every interaction; these are built once per process and
+# shared by all sessions (and their HTTP/gRPC connection pools).
+
+
+@st.cache_resource(show_spinner=False)
+def get_embeddings(model_name: str = settings.EMBEDDING_MODEL_VERSION,
+                   dimensions: int = settings.EMBEDDING_MODEL_MAX_DIMENSION) -> OpenAIEmbeddings:
+    logger.info("Creating embeddings client for %s (%d dimensions)", model_name, dimensions)
+    if dimensions < settings.EMBEDDING_MODEL_MAX_DIMENSION:
+        return OpenAIEmbeddings(model=model_name, dimensions=dimensions)
+    return OpenAIEmbeddings(model=model_name)
+
+
+@st.cache_resource(show_spinner=False)
+def get_tokenizer(model_name: str = settings.EMBEDDING_MODEL_VERSION):
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        logger.warning("No tokenizer known for %s, using o200k_base", model_name)
+        return tiktoken.get_encoding("o200k_base")
+
+
+@st.cache_resource(show_spinner=False)
+def get_chat_llm(model_name: str = settings.LLM_MODEL, streaming: bool = False) -> ChatOpenAI:
+    logger.info("Creating chat client for %s (streaming=%s)", model_name, streaming)
+    if streaming:
+        return ChatOpenAI(temperature=0, model=model_name, stream_usage=True)
+    return ChatOpenAI(temperature=0, model=model_name)
+
+
+@st.cache_resource(show_spinner=False)
+def get_chain(prompt_key: str, _prompt, model_name: str = settings.LLM_MODEL, streaming: bool = False):
+    """
+    Returns the compiled prompt | llm chain of a prompt.
+
+    Args:
+        prompt_key (str): Identifies the prompt in the cache, e.g. its template text.
+        _prompt: The PromptTemplate (not hashed by Streamlit).
+        model_name (str): The chat model.
+        streaming (bool): Chain for streamed responses with usage in the last chunk.
+    """
+    return _prompt | get_chat_llm(model_name, streaming)
+
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client() -> OpenAI:
+    return OpenAI()
+
+
+@st.cache_resource(show_spinner=False)
+def get_shared_vector_backend(backend_name: str = '') -> VectorBackend:
+    logger.info("Creating vector backend %s", backend_name or settings.VECTOR_BACKEND)
+    return get_vector_backend(backend_name)
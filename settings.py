@@ -6,18 +6,115 @@ MIDIACODE_LOGO_URL = "https://static.midiacode.com/logos/logo-midiacode-main-h.p
 LLM_MODEL = "gpt-4o-mini-2024-07-18"
 DALLE_MODEL_VERSION = "dall-e-3"
 EMBEDDING_MODEL_VERSION = "text-embedding-3-large"
-EMBEDDING_MODEL_DIMENSION = 3072
+# native size of the model: query embeddings, shortened to the dimension of each namespace
+EMBEDDING_MODEL_MAX_DIMENSION = 3072
+# dimension of new namespaces, text-embedding-3 can return shortened embeddings (e.g. 1024, 256)
+EMBEDDING_MODEL_DIMENSION = int(os.getenv('EMBEDDING_MODEL_DIMENSION', str(EMBEDDING_MODEL_MAX_DIMENSION)))
 OPEN_AI_EMBEDDING_PRICE_PER_TOKEN = 0.13/1000000
 OPEN_AI_DALLE_PRICE_PER_IMAGE_256X256 = 0.040
 OPEN_AI_GPT_PRICE_PER_INPUT_TOKEN = 0.150/1000000
 OPEN_AI_GPT_PRICE_PER_OUTPUT_TOKEN = 0.600/1000000
-# always change the UUID when you change or update the source document
+# token counts come from the API usage, the local tokenizer is only a fallback
+TOKEN_COUNT_THREADS = min(8, os.cpu_count() or 1)
+# namespaces are re-indexed incrementally when the source fingerprint changes,
+# changing the UUID is only needed to start a namespace from scratch
 SOURCE_UUID = "ccc27e35-c964-4259-bc93-11e74cf60b02"
 PDF_FILE_PATH_SOURCE = "2024-MidiacodeTextRepository.pdf"
 PAGE_URL_SOURCE = "https://ptbr.midiacode.com/2022/02/22/perguntas-frequentes/"
 
+HTTP_TIMEOUT_SECONDS = 30
+# ContentSpot metadata cache, unknown codes are kept in a shorter negative cache
+CONTENT_SPOT_TIMEOUT_SECONDS = 10
+CONTENT_SPOT_CACHE_SIZE = 10000
+CONTENT_SPOT_CACHE_TTL_SECONDS = 5 * 60
+CONTENT_SPOT_NEGATIVE_CACHE_TTL_SECONDS = 60
+CONTENT_SPOT_MAX_WORKERS = 8
+
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
 INDEX_NAME = "ailabs1"
+# vector backend used by the chat pages: "pinecone" (remote) or "local" (FAISS on disk)
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'pinecone')
+LOCAL_VECTOR_STORE_PATH = os.getenv('LOCAL_VECTOR_STORE_PATH', 'vector_store')
+# local index type: "flat" (float32), "sq8" (int8, 4x smaller), "pq" (product quantized,
+# 16x smaller), "ivf_sq8" or "ivf_pq" (inverted lists, for large namespaces).
+# Quantized namespaces keep full-precision vectors on disk to re-rank the candidates.
+LOCAL_INDEX_TYPE = os.getenv('LOCAL_INDEX_TYPE', 'flat')
+# per namespace overrides, e.g. LOCAL_INDEX_TYPES="guide=flat,abc123=pq"
+LOCAL_INDEX_TYPES = dict(
+    item.split('=', 1) for item in os.getenv('LOCAL_INDEX_TYPES', '').split(',') if '=' in item)
+LOCAL_INDEX_RERANK_FACTOR = 4  # candidates fetched per result before the exact re-rank
+LOCAL_INDEX_PQ_SUBVECTOR_DIM = 4  # dimensions per PQ code byte
+LOCAL_INDEX_PQ_BITS = 8
+LOCAL_INDEX_IVF_NLIST = 0  # 0 = 4 * sqrt(vectors)
+LOCAL_INDEX_IVF_NPROBE = 16
+LOCAL_INDEX_IVF_MIN_VECTORS = 4096  # IVF namespaces stay flat until they have this many vectors
+# memory cap of the namespaces kept open by each process, least recently used ones are closed first
+NAMESPACE_POOL_MAX_MB = int(os.getenv('NAMESPACE_POOL_MAX_MB', '1024'))
+# PDF extraction: page ranges are extracted by a process pool for large documents
+PDF_EXTRACTION_WORKERS = os.cpu_count() or 1
+PDF_PAGES_PER_TASK = 16
+PDF_PARALLEL_MIN_PAGES = 32
+# ingestion: "direct" embeds batches and upserts them as they are ready,
+# "faiss" builds the whole index in memory first and exports it
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'direct')
+EMBEDDING_BATCH_SIZE = 100
+# chunking (see chunking.TokenChunker), sizes in tokens of the embedding model
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '400'))
+CHUNK_OVERLAP_TOKENS = 50
+CHUNK_MIN_TOKENS = 100  # shorter page endings are merged with the next page
+# streaming ingestion: bounded queues between stages, QR documents can be
+# queried once the first pages are indexed
+INGESTION_QUEUE_SIZE = 4
+INGESTION_AVAILABLE_AFTER_PAGES = 10
+# background ingestion jobs: at most this many documents are ingested at once
+# per process, the others wait in the queue
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', '4'))
+# a finished job is returned as is for this long, later requests check the source again
+INGESTION_JOB_TTL_SECONDS = 600
+# control-plane metadata (index readiness, namespaces) cache
+VECTOR_METADATA_TTL_SECONDS = 300
+VECTOR_NAMESPACE_NEGATIVE_TTL_SECONDS = 10
+VECTOR_INDEX_POLL_INITIAL_SECONDS = 0.5
+VECTOR_INDEX_POLL_MAX_SECONDS = 8
+# bulk upserts: Pinecone accepts up to 1000 vectors and 2MB per request
+PINECONE_UPSERT_MAX_BATCH_SIZE = 1000
+PINECONE_UPSERT_MAX_BATCH_BYTES = 2 * 1024 * 1024 * 9 // 10  # keep a 10% margin
+UPSERT_MAX_WORKERS = 4
+UPSERT_MAX_RETRIES = 3
+UPSERT_RETRY_BACKOFF_SECONDS = 0.5
+# per-namespace manifests of the indexed chunk hashes and source fingerprint
+INDEX_MANIFEST_PATH = os.getenv('INDEX_MANIFEST_PATH', 'index_manifests')
+# query embedding cache: in-process LRU in front of a SQLite file (empty path disables the file)
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_CACHE_DISK_SIZE = 100000
+QUERY_EMBEDDING_CACHE_PATH = os.getenv('QUERY_EMBEDDING_CACHE_PATH', 'cache/query_embeddings.sqlite3')
+# retrieval and prompt context packing
+RETRIEVAL_TOP_K = 20
+CONTEXT_TOKEN_BUDGET = 3000  # tokens of retrieved content in the prompt
+CONTEXT_MIN_SCORE = 0.2  # cosine similarity floor of a retrieved chunk
+# near-duplicate suppression: MMR over the match vectors and chunk overlap removal
+RETRIEVAL_MMR_ENABLED = True
+RETRIEVAL_FETCH_K = 30
+RETRIEVAL_MMR_LAMBDA = 0.7
+RETRIEVAL_DUPLICATE_THRESHOLD = 0.97
+RETRIEVAL_MIN_OVERLAP_CHARS = 50
+# semantic answer cache per namespace (source_id)
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95  # cosine similarity between questions
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+ANSWER_CACHE_MAX_ITEMS_PER_NAMESPACE = 500
+ANSWER_CACHE_MAX_NAMESPACES = 1000
+# per-stage latency histograms by namespace, exported in the Prometheus text format
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # 0 disables the /metrics endpoint
+METRICS_FILE_PATH = os.getenv('METRICS_FILE_PATH', '')  # empty disables the file
+METRICS_FILE_INTERVAL_SECONDS = 15
+METRICS_SAMPLES_PER_SERIES = 1000  # last samples kept for the quantiles
+METRICS_MAX_NAMESPACES = 500
+# timings of the last answer and stage percentiles in the sidebar
+DEBUG_TIMING_PANEL = os.getenv('DEBUG_TIMING_PANEL', 'false').lower() == 'true'
+# offline batch question answering (batch_qa.py)
+BATCH_QA_CONCURRENCY = int(os.getenv('BATCH_QA_CONCURRENCY', '4'))
 
 
 THINKING_ANIMATION = """
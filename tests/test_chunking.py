@@ -0,0 +1,154 @@
+"""
+Tests of the block splitting and chunk bounds of chunking.TokenChunker.
+
+    python -m pytest tests
+"""
+from chunking import RunningLines, TokenChunker, is_heading, iter_blocks
+from pdf_extractor import PDFPage
+
+
+class WordTokenizer:
+    """
+    One token per word, so token counts are easy to check.
+    """
+
+    def encode_ordinary(self, text: str) -> list:
+        return text.split()
+
+    def decode(self, tokens: list) -> str:
+        return " ".join(tokens)
+
+
+def make_chunker(max_tokens: int = 20, overlap_tokens: int = 4, min_tokens: int = 5) -> TokenChunker:
+    return TokenChunker(tokenizer=WordTokenizer(), max_tokens=max_tokens,
+                        overlap_tokens=overlap_tokens, min_tokens=min_tokens)
+
+
+def sentence(words: int, first: str = "Palavra") -> str:
+    return " ".join([first] + ["texto"] * (words - 2) + ["fim."])
+
+
+def test_numbered_named_and_capital_headings():
+    assert is_heading("2.1 Configuração do QR Code", "O sistema permite...", "Texto anterior.")
+    assert is_heading("Capítulo 3", "O sistema permite...", "Texto anterior.")
+    assert is_heading("VISÃO GERAL", "O sistema permite...", "Texto anterior.")
+
+
+def test_short_line_after_text_is_not_a_heading():
+    # only set apart lines (blank line or page start) fall back to the next line
+    assert not is_heading("Manual do Usuário", "O sistema permite...", "Fim do parágrafo.")
+    assert is_heading("Visão geral", "O sistema permite...", "")
+
+
+def test_sentences_and_bullets_are_not_headings():
+    assert not is_heading("Veja o exemplo:", "O sistema permite...")
+    assert not is_heading("- Acesse o painel", "O sistema permite...")
+    assert not is_heading("Os dados são enviados ao servidor e processados em lote "
+                          "antes de chegar ao painel do cliente", "Depois...")
+
+
+def test_iter_blocks_splits_paragraphs_and_headings():
+    text = "\n".join([
+        "1. Introdução",
+        "A plataforma publica conteúdos",
+        "em QR Codes dinâmicos.",
+        "Cada código tem um link curto.",
+        "",
+        "- Primeiro item da lista",
+        "- Segundo item da lista",
+    ])
+    assert list(iter_blocks(text)) == [
+        ("heading", "1. Introdução"),
+        ("paragraph", "A plataforma publica conteúdos em QR Codes dinâmicos."),
+        ("paragraph", "Cada código tem um link curto."),
+        ("paragraph", "- Primeiro item da lista"),
+        ("paragraph", "- Segundo item da lista"),
+    ]
+
+
+def test_iter_blocks_joins_hyphenated_words():
+    assert list(iter_blocks("O conteúdo é publi-\ncado no estúdio.")) == [
+        ("paragraph", "O conteúdo é publicado no estúdio.")]
+
+
+def test_running_lines_are_detected_and_dropped():
+    running_lines = RunningLines()
+    pages = [f"Manual do Usuário\n{text}\nPágina {number} de 3"
+             for number, text in ((1, "Primeira página."), (2, "Segunda página."), (3, "Terceira página."))]
+    assert running_lines.add_page(pages[0]) == set()
+    skip_lines = running_lines.add_page(pages[1])
+    assert skip_lines == {"manual do usuário", "página # de #"}
+    assert list(iter_blocks(pages[1], skip_lines)) == [("paragraph", "Segunda página.")]
+
+
+def test_running_header_does_not_become_a_section():
+    pages = [PDFPage(page_number=number, content=f"Manual do Usuário\n{sentence(8)}\n{sentence(8)}")
+             for number in (1, 2, 3)]
+    chunks = list(make_chunker().iter_chunks(pages))
+    assert all(chunk.section is None for chunk in chunks[1:])
+    assert all("Manual do Usuário" not in chunk.text for chunk in chunks[1:])
+
+
+def test_chunks_stay_within_max_tokens():
+    chunker = make_chunker()
+    text = "\n".join(sentence(7) for _ in range(12))
+    chunks = list(chunker.iter_chunks([PDFPage(page_number=1, content=text)]))
+    assert len(chunks) > 1
+    assert all(chunker.count(chunk.text) <= chunker.max_tokens for chunk in chunks)
+
+
+def test_chunks_start_with_their_heading():
+    chunker = make_chunker()
+    text = "\n".join(["1. Instalação"] + [sentence(7) for _ in range(6)])
+    chunks = list(chunker.iter_chunks([PDFPage(page_number=1, content=text)]))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.section == "1. Instalação"
+        assert chunk.text.startswith("1. Instalação\n\n")
+        assert chunker.count(chunk.text) <= chunker.max_tokens
+
+
+def test_chunks_do_not_cross_headings():
+    text = "\n".join(["1. Instalação", sentence(6), "2. Uso", sentence(6, first="Outro")])
+    chunks = list(make_chunker().iter_chunks([PDFPage(page_number=1, content=text)]))
+    assert [chunk.section for chunk in chunks] == ["1. Instalação", "2. Uso"]
+    assert "Outro" not in chunks[0].text
+
+
+def test_long_sentence_is_split_in_token_windows():
+    chunker = make_chunker(max_tokens=10, overlap_tokens=2, min_tokens=1)
+    words = [f"w{i}" for i in range(25)]
+    pieces = list(chunker.iter_pieces(" ".join(words)))
+    assert [tokens for _, tokens, _ in pieces] == [10, 10, 9]
+    assert pieces[1][0].split()[0] == "w8"  # windows overlap by overlap_tokens
+    assert pieces[-1][0].split()[-1] == "w24"
+
+
+def test_short_page_ending_is_merged_with_next_page():
+    chunker = make_chunker(min_tokens=10)
+    pages = [PDFPage(page_number=1, content=sentence(4)), PDFPage(page_number=2, content=sentence(8))]
+    page_chunks = list(chunker.iter_page_chunks(pages))
+    assert page_chunks[0] == (1, [])
+    chunks = [chunk for _, chunks in page_chunks for chunk in chunks]
+    assert len(chunks) == 1
+    assert chunks[0].page_number == 1
+
+
+def test_long_heading_and_body_stay_within_max_tokens():
+    chunker = make_chunker(max_tokens=20, min_tokens=5)
+    heading = "1. " + " ".join(["Título"] * 30)
+    text = "\n".join([heading, " ".join(["palavra"] * 40)])
+    chunks = list(chunker.iter_chunks([PDFPage(page_number=1, content=text)]))
+    assert chunks
+    assert all(chunker.count(chunk.text) <= chunker.max_tokens for chunk in chunks)
+
+
+def test_overlap_pieces_keep_their_page():
+    chunker = make_chunker(max_tokens=12, overlap_tokens=4, min_tokens=20)
+    pages = [
+        PDFPage(page_number=1, content="\n".join([sentence(4), sentence(4)])),
+        PDFPage(page_number=2, content=sentence(8)),
+    ]
+    chunks = list(chunker.iter_chunks(pages))
+    assert [chunk.page_number for chunk in chunks] == [1, 1]
+    assert chunks[1].text.startswith(sentence(4))
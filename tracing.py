@@ -0,0 +1,261 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from streamlit.logger import get_logger
+import settings
+
+
+logger = get_logger(__name__)
+
+METRIC_NAME = "ai_labs_stage_latency_seconds"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+OTHER_NAMESPACE = "other"
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class LatencyHistogram:
+    """
+    Cumulative Prometheus buckets plus the last samples, from which the
+    p50/p95/p99 are computed.
+    """
+
+    def __init__(self, max_samples: int = settings.METRICS_SAMPLES_PER_SERIES):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=max_samples)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.samples.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+
+    def quantiles(self) -> Dict[float, float]:
+        samples = list(self.samples)
+        return {quantile: percentile(samples, quantile) for quantile in QUANTILES}
+
+
+class MetricsRegistry:
+    """
+    Latency histograms by (stage, namespace). Namespaces past
+    ``max_namespaces`` are counted under "other", so QR codes do not grow
+    the series without bound.
+    """
+
+    def __init__(self, max_namespaces: int = settings.METRICS_MAX_NAMESPACES):
+        self.max_namespaces = max_namespaces
+        self._histograms: Dict[tuple, LatencyHistogram] = {}
+        self._namespaces = set()
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, namespace: str = ""):
+        with self._lock:
+            if namespace not in self._namespaces:
+                if len(self._namespaces) >= self.max_namespaces:
+                    namespace = OTHER_NAMESPACE
+                else:
+                    self._namespaces.add(namespace)
+            key = (stage, namespace)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = LatencyHistogram()
+            histogram.observe(seconds)
+
+    def summary(self, namespace: Optional[str] = None) -> List[dict]:
+        """
+        Returns count and p50/p95/p99 of every stage, for one namespace or
+        merged over all of them when ``namespace`` is None.
+        """
+        with self._lock:
+            samples: Dict[str, List[float]] = {}
+            for (stage, stage_namespace), histogram in self._histograms.items():
+                if namespace is None or stage_namespace == namespace:
+                    samples.setdefault(stage, []).extend(histogram.samples)
+        return [
+            {"stage": stage, "count": len(values),
+             **{f"p{int(quantile * 100)}": percentile(values, quantile) for quantile in QUANTILES}}
+            for stage, values in sorted(samples.items())
+        ]
+
+    def to_prometheus(self) -> str:
+        """
+        Returns the histograms in the Prometheus text exposition format.
+        """
+        lines = [
+            f"# HELP {METRIC_NAME} Latency of the answer and ingestion stages.",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        quantile_lines = [
+            f"# HELP {METRIC_NAME}_quantile Latency quantiles over the last samples.",
+            f"# TYPE {METRIC_NAME}_quantile gauge",
+        ]
+        with self._lock:
+            for (stage, namespace), histogram in sorted(self._histograms.items()):
+                labels = f'stage="{escape_label(stage)}",namespace="{escape_label(namespace)}"'
+                for bound, count in zip(BUCKETS, histogram.bucket_counts):
+                    lines.append(f'{METRIC_NAME}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{METRIC_NAME}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{METRIC_NAME}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{METRIC_NAME}_count{{{labels}}} {histogram.count}")
+                for quantile, value in histogram.quantiles().items():
+                    quantile_lines.append(f'{METRIC_NAME}_quantile{{{labels},quantile="{quantile}"}} {value}')
+        return "\n".join(lines + quantile_lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics() -> MetricsRegistry:
+    return _registry
+
+
+@dataclass
+class Trace:
+    """
+    Spans of one request (an answer or an ingestion), e.g. to show the
+    timings of the last answer in the sidebar.
+    """
+    name: str
+    namespace: str = ""
+    spans: List[tuple] = field(default_factory=list)  # (stage, seconds)
+
+    def timings(self) -> Dict[str, float]:
+        totals = {}
+        for stage, seconds in self.spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def record(stage: str, seconds: float, namespace: Optional[str] = None):
+    """
+    Records a stage latency in the histograms and in the current trace.
+    The namespace defaults to the one of the current trace.
+    """
+    if not settings.METRICS_ENABLED:
+        return
+    current = _current_trace.get()
+    if namespace is None:
+        namespace = current.namespace if current is not None else ""
+    if current is not None:
+        current.spans.append((stage, seconds))
+    _registry.observe(stage, seconds, namespace)
+
+
+@contextmanager
+def span(stage: str, namespace: Optional[str] = None):
+    """
+    Times the block as ``stage``.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, namespace)
+
+
+@contextmanager
+def trace(name: str, namespace: str = ""):
+    """
+    Starts a trace: spans inside the block default to its namespace and are
+    collected in it. The whole block is recorded as the ``name`` stage.
+    """
+    current = Trace(name=name, namespace=namespace)
+    token = _current_trace.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # generator closed from another context
+            _current_trace.set(None)
+        elapsed = time.perf_counter() - start
+        record(name, elapsed, namespace)
+        current.spans.append((name, elapsed))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _registry.to_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_metrics_file(path: str = settings.METRICS_FILE_PATH):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(_registry.to_prometheus())
+    os.replace(tmp_file, path)
+
+
+_exporter_started = False
+_exporter_lock = threading.Lock()
+
+
+def start_metrics_exporter():
+    """
+    Starts, once per process, the /metrics HTTP endpoint (METRICS_PORT) and
+    the periodic metrics file (METRICS_FILE_PATH), when configured.
+    """
+    global _exporter_started
+    with _exporter_lock:
+        if _exporter_started or not settings.METRICS_ENABLED:
+            return
+        _exporter_started = True
+
+    if settings.METRICS_PORT:
+        try:
+            server = ThreadingHTTPServer(("0.0.0.0", settings.METRICS_PORT), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            logger.info("Metrics endpoint on :%d/metrics", settings.METRICS_PORT)
+        except OSError as e:
+            logger.error("Could not start the metrics endpoint: %s", e)
+
+    if settings.METRICS_FILE_PATH:
+        def write_periodically():
+            while True:
+                time.sleep(settings.METRICS_FILE_INTERVAL_SECONDS)
+                try:
+                    write_metrics_file(settings.METRICS_FILE_PATH)
+                except OSError as e:
+                    logger.error("Could not write the metrics file: %s", e)
+
+        threading.Thread(target=write_periodically, name="metrics-file", daemon=True).start()
+        logger.info("Writing metrics to %s", settings.METRICS_FILE_PATH)
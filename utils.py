@@ -1,55 +1,38 @@
 import streamlit as st
 import requests
-import re
-from PyPDF2 import PdfReader
 from bs4 import BeautifulSoup
-from langchain_text_splitters import CharacterTextSplitter
 from streamlit.logger import get_logger
 import settings
 import tempfile
 import os
+from pdf_extractor import iter_pdf_pages
+from chunking import TokenChunker
+import tracing
+from namespace_pool import get_namespace_pool
 
 logger = get_logger(__name__)
 
 
 def split_paragraphs(rawText):
     """
-    Splits the raw text into paragraphs.
+    Splits the raw text into token-bounded chunks that follow its headings
+    and paragraphs (see chunking.TokenChunker).
 
     Args:
-        rawText (str): The raw text to be split.
+        rawText (str): The raw text to be split, with its line breaks.
 
     Returns:
-        list: A list of paragraphs.
+        list: A list of chunk texts.
     """
-    text_splitter = CharacterTextSplitter(
-        separator="\n",
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    return text_splitter.split_text(rawText)
+    return TokenChunker().split_text(rawText)
 
 
-def clean_text(text):
-    # Remove unnecessary line breaks and join words into proper sentences
-    cleaned_text = re.sub(r'\s*\n\s*', ' ', text)
-    return cleaned_text
+def extract_from_pdf(filepath: str):
+    return [chunk.text for chunk in extract_chunks_from_pdf(filepath)]
 
 
-def extract_from_pdf(filepath: str):
-    text_chunks = []
-    with open(filepath, 'rb') as f:
-        reader = PdfReader(f)
-        logger.info("Number of pages: %d", len(reader.pages))
-        for i, page in enumerate(reader.pages):
-            logger.info("Extracting page %d...", i+1)
-            raw = page.extract_text()
-            cleaned = clean_text(raw)
-            chunks = split_paragraphs(cleaned)
-            text_chunks += chunks
-    return text_chunks
+def extract_chunks_from_pdf(filepath: str):
+    return list(TokenChunker().iter_chunks(iter_pdf_pages(filepath)))
 
 
 def extract_from_html_page(url: str):
@@ -61,8 +44,7 @@ def extract_from_html_page(url: str):
             html_content = response.text
             soup = BeautifulSoup(html_content, 'html.parser')
             texts = soup.get_text(separator='\n')
-            cleaned = clean_text(texts)
-            chunks = split_paragraphs(cleaned)
+            chunks = split_paragraphs(texts)
             return chunks
         else:
             logger.error("Failed to retrieve HTML: Status Code %d", response.status_code)
@@ -93,8 +75,57 @@ def add_sidebar():
         st.write(f"Versão {settings.VERSION}")    
         st.caption(f"Modelos: {settings.LLM_MODEL}, {settings.DALLE_MODEL_VERSION}, {settings.EMBEDDING_MODEL_VERSION}")
         st.caption(f":moneybag: Custo da sessão: {st.session_state.total_cost:.6f} USD")
+        if settings.DEBUG_TIMING_PANEL:
+            add_timing_panel()
         st.write("© Midiacode Lda")
 
+def add_timing_panel():
+    """
+    Debug panel with the stage timings of the last answer of the session
+    and the p50/p95/p99 of each stage in this process.
+    """
+    with st.expander(":stopwatch: Tempos"):
+        last_timings = st.session_state.get("last_timings")
+        if last_timings:
+            st.caption("Última resposta (ms)")
+            st.dataframe(
+                [{"etapa": stage, "ms": round(seconds * 1000, 1)} for stage, seconds in last_timings.items()],
+                hide_index=True)
+        st.caption("Percentis do processo (ms)")
+        st.dataframe(
+            [{"etapa": row["stage"], "n": row["count"],
+              "p50": round(row["p50"] * 1000, 1), "p95": round(row["p95"] * 1000, 1),
+              "p99": round(row["p99"] * 1000, 1)}
+             for row in tracing.get_metrics().summary()],
+            hide_index=True)
+        pool_stats = get_namespace_pool().stats()
+        st.caption(
+            f"Namespaces em memória: {pool_stats['namespaces']} "
+            f"({pool_stats['bytes'] / 2**20:.1f} de {pool_stats['max_bytes'] / 2**20:.0f} MB), "
+            f"hits {pool_stats['hits']}, misses {pool_stats['misses']}, evictions {pool_stats['evictions']}")
+
+def clear_on_first_chunk(placeholder, stream):
+    """
+    Wraps a token stream and empties the placeholder (thinking animation)
+    as soon as the first token arrives.
+
+    Args:
+        placeholder: The st.empty() placeholder showing the animation.
+        stream: Generator of answer pieces.
+
+    Yields:
+        str: The same pieces from the stream.
+    """
+    cleared = False
+    for chunk in stream:
+        if not cleared:
+            placeholder.empty()
+            cleared = True
+        yield chunk
+    if not cleared:
+        placeholder.empty()
+
+
 def download_pdf(url):
     """
     Downloads a PDF file from URL and saves it to a temporary location.
@@ -106,24 +137,22 @@ def download_pdf(url):
         str: Full path to the saved PDF file
     """
     try:
-        # Send GET request to download the PDF
-        response = requests.get(url)
+        # Send GET request to download the PDF, streamed to disk
+        response = requests.get(url, stream=True, timeout=settings.HTTP_TIMEOUT_SECONDS)
         
         # Check if request was successful
         if response.status_code == 200:
-            # Extract filename from URL
-            filename = url.split('/')[-1]
-            if not filename.lower().endswith('.pdf'):
-                filename += '.pdf'
-                
-            # Create full path using temporary directory
-            temp_dir = tempfile.gettempdir()
-            file_path = os.path.join(temp_dir, filename)
-            
-            # Save the PDF file
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-                
+            # a file of its own, concurrent jobs may download PDFs with the same name
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
+                file_path = f.name
+                try:
+                    for block in response.iter_content(chunk_size=1024 * 1024):
+                        f.write(block)
+                except Exception:
+                    f.close()
+                    os.remove(file_path)
+                    raise
+
             logger.info("PDF downloaded successfully and saved at: %s", file_path)
             return file_path
         else:
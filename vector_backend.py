@@ -0,0 +1,994 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import numpy as np
+import faiss
+from pinecone.grpc import PineconeGRPC as Pinecone
+from pinecone import ServerlessSpec
+from streamlit.logger import get_logger
+import settings
+from chunk_store import ChunkStore
+from namespace_pool import NamespacePool, get_namespace_pool
+
+
+logger = get_logger(__name__)
+
+# read index files through a memory map where faiss supports it, so worker
+# processes share the page cache instead of each holding a copy
+FAISS_MMAP_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+
+@dataclass
+class VectorMatch:
+    """
+    A single result of a similarity query, same shape for every backend
+    """
+    id: str
+    score: float
+    metadata: Dict = field(default_factory=dict)
+    values: Optional[List[float]] = None
+
+
+@dataclass
+class QueryResult:
+    """
+    Result of a similarity query: matches ordered by descending score
+    """
+    matches: List[VectorMatch]
+    namespace: str = ""
+
+
+class VectorBackend(ABC):
+    """
+    Common interface for the vector stores used by the chat pages.
+
+    A namespace holds the vectors of one document (``doc_uuid`` or QR short code).
+    Vectors are upserted as ``(id, values, metadata)`` tuples, like Pinecone.
+    """
+
+    name = "base"
+    # limits of a single upsert request, None means unlimited
+    max_upsert_batch_size = None
+    max_upsert_batch_bytes = None
+    max_parallel_upserts = 1
+
+    @abstractmethod
+    def namespace_exists(self, namespace: str) -> bool:
+        pass
+
+    def namespaces_exist(self, namespaces: List[str]) -> Dict[str, bool]:
+        return {namespace: self.namespace_exists(namespace) for namespace in namespaces}
+
+    @abstractmethod
+    def create_namespace(self, namespace: str, dimension: int = settings.EMBEDDING_MODEL_DIMENSION):
+        pass
+
+    @abstractmethod
+    def get_namespace_dimension(self, namespace: str) -> Optional[int]:
+        """
+        Dimension of the vectors of a namespace, None when it does not exist.
+        """
+
+    @abstractmethod
+    def upsert(self, vectors: list, namespace: str):
+        pass
+
+    @abstractmethod
+    def query(self, vector, namespace: str, top_k: int = 20,
+              include_values: bool = False, include_metadata: bool = True) -> QueryResult:
+        pass
+
+    @abstractmethod
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, tuple]:
+        """
+        Returns id -> (values, metadata) of the ids found in the namespace.
+        """
+
+    @abstractmethod
+    def list_ids(self, namespace: str) -> List[str]:
+        pass
+
+    def iter_vectors(self, namespace: str, batch_size: int = 1000):
+        """
+        Yields all the vectors of a namespace as (ids, values, metadatas) batches.
+        """
+        ids = self.list_ids(namespace)
+        for i in range(0, len(ids), batch_size):
+            vectors = self.fetch(ids[i:i+batch_size], namespace)
+            batch_ids = [vector_id for vector_id in ids[i:i+batch_size] if vector_id in vectors]
+            yield (batch_ids,
+                   np.asarray([vectors[vector_id][0] for vector_id in batch_ids], dtype=np.float32),
+                   [vectors[vector_id][1] for vector_id in batch_ids])
+
+    @abstractmethod
+    def delete(self, ids: List[str], namespace: str):
+        pass
+
+    def flush(self, namespace: str):
+        """
+        Persists the upserts of a namespace that the backend keeps buffered.
+        Called once per ingestion and at its availability checkpoint; backends
+        that write on every request (Pinecone) have nothing to do.
+        """
+
+    @abstractmethod
+    def delete_namespace(self, namespace: str):
+        pass
+
+    # async versions for the answer path. The Pinecone gRPC client and FAISS
+    # have no asyncio API, the calls run in the default thread pool so they
+    # overlap with the other requests of the answer
+    async def anamespace_exists(self, namespace: str) -> bool:
+        return await asyncio.to_thread(self.namespace_exists, namespace)
+
+    async def aget_namespace_dimension(self, namespace: str) -> Optional[int]:
+        return await asyncio.to_thread(self.get_namespace_dimension, namespace)
+
+    async def aquery(self, vector, namespace: str, top_k: int = 20,
+                     include_values: bool = False, include_metadata: bool = True) -> QueryResult:
+        return await asyncio.to_thread(
+            self.query, vector, namespace, top_k=top_k,
+            include_values=include_values, include_metadata=include_metadata)
+
+    def get_upsert_batches(self, ids: List[str], metadatas: List[Dict], dimension: int) -> List[tuple]:
+        """
+        Splits the vectors in ``(start, end)`` ranges that respect the request
+        limits of the backend (vector count and estimated payload size).
+        """
+        max_size = self.max_upsert_batch_size or len(ids)
+        max_bytes = self.max_upsert_batch_bytes
+        vector_bytes = dimension * 4
+        batches = []
+        start = 0
+        batch_bytes = 0
+        for i, (vector_id, metadata) in enumerate(zip(ids, metadatas)):
+            item_bytes = vector_bytes + len(vector_id) + len(json.dumps(metadata, ensure_ascii=False).encode("utf-8"))
+            full = i - start >= max_size or (max_bytes is not None and batch_bytes + item_bytes > max_bytes)
+            if full and i > start:
+                batches.append((start, i))
+                start = i
+                batch_bytes = 0
+            batch_bytes += item_bytes
+        if start < len(ids):
+            batches.append((start, len(ids)))
+        return batches
+
+    def _upsert_with_retries(self, vectors: list, namespace: str):
+        for attempt in range(settings.UPSERT_MAX_RETRIES + 1):
+            try:
+                return self.upsert(vectors=vectors, namespace=namespace)
+            except Exception as e:
+                if attempt == settings.UPSERT_MAX_RETRIES:
+                    raise
+                wait = settings.UPSERT_RETRY_BACKOFF_SECONDS * 2 ** attempt
+                logger.warning("Upsert of %d vectors failed (%s), retrying in %.1fs...", len(vectors), e, wait)
+                time.sleep(wait)
+
+    def bulk_upsert(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict], namespace: str) -> int:
+        """
+        Upserts a whole matrix of vectors, in batches sized to the request
+        limits and sent concurrently with bounded parallelism and retries.
+
+        Args:
+            ids (List[str]): Vector ids.
+            vectors (np.ndarray): Matrix (n, dimension) of float32 vectors.
+            metadatas (List[Dict]): Metadata of each vector.
+            namespace (str): The namespace.
+
+        Returns:
+            int: Number of vectors upserted.
+        """
+        if len(ids) == 0:
+            return 0
+        batches = self.get_upsert_batches(ids, metadatas, vectors.shape[1])
+        logger.info("Upserting %d vectors in %d batches (%d in parallel)...",
+                    len(ids), len(batches), self.max_parallel_upserts)
+
+        def send(batch):
+            start, end = batch
+            values = vectors[start:end].tolist()
+            return self._upsert_with_retries(
+                list(zip(ids[start:end], values, metadatas[start:end])), namespace)
+
+        if self.max_parallel_upserts <= 1 or len(batches) == 1:
+            for batch in batches:
+                send(batch)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_parallel_upserts) as executor:
+                # list() propagates the first error
+                list(executor.map(send, batches))
+        return len(ids)
+
+
+class PineconeBackend(VectorBackend):
+    """
+    Vector backend stored in Pinecone serverless indexes (one namespace per document).
+
+    A Pinecone index has a single dimension, so namespaces with shortened
+    embeddings live in one index per dimension: ``<index_name>`` for the
+    native dimension of the model and ``<index_name>-<dimension>`` otherwise.
+    """
+
+    name = "pinecone"
+    max_upsert_batch_size = settings.PINECONE_UPSERT_MAX_BATCH_SIZE
+    max_upsert_batch_bytes = settings.PINECONE_UPSERT_MAX_BATCH_BYTES
+    max_parallel_upserts = settings.UPSERT_MAX_WORKERS
+
+    def __init__(self, index_name: str = settings.INDEX_NAME):
+        self.pinecone = Pinecone(api_key=settings.PINECONE_API_KEY)
+        self.index_name = index_name
+        # control-plane metadata cached with a TTL, the backend is shared by the process
+        self._indexes = {}            # dimension -> index
+        self._index_checked_at = {}   # dimension -> time
+        self._namespaces = {}         # namespace -> dimension
+        self._namespaces_fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def get_index_name(self, dimension: int) -> str:
+        if dimension == settings.EMBEDDING_MODEL_MAX_DIMENSION:
+            return self.index_name
+        return f"{self.index_name}-{dimension}"
+
+    def create_index_if_not_exist(self, dimension: int = settings.EMBEDDING_MODEL_MAX_DIMENSION):
+        index_name = self.get_index_name(dimension)
+        try:
+            index_data = self.pinecone.describe_index(index_name)
+            logger.info(index_data)
+            if index_data:
+                logger.info("Index already exists.")
+                return index_data
+        except Exception as e:
+            logger.error(f"Error: {e}")
+
+        logger.info(f"Index {index_name} does not exist. Creating...")
+        self.pinecone.create_index(
+            name=index_name,
+            dimension=dimension,
+            metric="cosine", # better for semantic search
+            spec=ServerlessSpec(
+                cloud="aws",
+                region="us-east-1"
+            )
+        )
+        logger.info("Index created.")
+        return self.pinecone.describe_index(index_name)
+
+    def wait_until_ready(self, index_data):
+        # exponential backoff instead of polling every second
+        delay = settings.VECTOR_INDEX_POLL_INITIAL_SECONDS
+        while not index_data['status']['ready']:
+            logger.info('Index not ready. Waiting %.1fs...', delay)
+            time.sleep(delay)
+            delay = min(delay * 2, settings.VECTOR_INDEX_POLL_MAX_SECONDS)
+            index_data = self.pinecone.describe_index(index_data['name'])
+        return index_data
+
+    def _index_is_fresh(self, dimension: int) -> bool:
+        return dimension in self._indexes and \
+            time.time() - self._index_checked_at.get(dimension, 0.0) < settings.VECTOR_METADATA_TTL_SECONDS
+
+    def get_index(self, dimension: int = settings.EMBEDDING_MODEL_MAX_DIMENSION):
+        if self._index_is_fresh(dimension):
+            return self._indexes[dimension]
+        with self._lock:
+            if not self._index_is_fresh(dimension):
+                index_data = self.wait_until_ready(self.create_index_if_not_exist(dimension))
+                if dimension not in self._indexes:
+                    # passing the host avoids another describe_index call
+                    self._indexes[dimension] = self.pinecone.Index(
+                        name=self.get_index_name(dimension), host=index_data['host'])
+                self._index_checked_at[dimension] = time.time()
+        return self._indexes[dimension]
+
+    def get_index_dimensions(self) -> List[int]:
+        """
+        Dimensions that have an index, from the names of the existing indexes.
+        """
+        dimensions = []
+        for index_name in self.pinecone.list_indexes().names():
+            if index_name == self.index_name:
+                dimensions.append(settings.EMBEDDING_MODEL_MAX_DIMENSION)
+            elif index_name.startswith(self.index_name + "-") and index_name[len(self.index_name) + 1:].isdigit():
+                dimensions.append(int(index_name[len(self.index_name) + 1:]))
+        return dimensions or [settings.EMBEDDING_MODEL_MAX_DIMENSION]
+
+    def refresh_namespaces(self):
+        namespaces = {}
+        for dimension in self.get_index_dimensions():
+            stats = self.get_index(dimension).describe_index_stats()
+            logger.info(stats)
+            for namespace in stats['namespaces'].keys():
+                namespaces.setdefault(namespace, dimension)
+        self._namespaces = namespaces
+        self._namespaces_fetched_at = time.time()
+
+    def namespaces_exist(self, namespaces: List[str]) -> Dict[str, bool]:
+        """
+        Checks several namespaces with at most one describe_index_stats call
+        per index. Known namespaces are served from the cache until the TTL
+        expires, unknown ones trigger a refresh after a shorter negative TTL.
+        """
+        age = time.time() - self._namespaces_fetched_at
+        unknown = [namespace for namespace in namespaces if namespace not in self._namespaces]
+        if age >= settings.VECTOR_METADATA_TTL_SECONDS or (
+                unknown and age >= settings.VECTOR_NAMESPACE_NEGATIVE_TTL_SECONDS):
+            self.refresh_namespaces()
+        return {namespace: namespace in self._namespaces for namespace in namespaces}
+
+    def namespace_exists(self, namespace: str) -> bool:
+        return self.namespaces_exist([namespace])[namespace]
+
+    def get_namespace_dimension(self, namespace: str) -> Optional[int]:
+        if not self.namespace_exists(namespace):
+            return None
+        return self._namespaces.get(namespace)
+
+    def _get_namespace_index(self, namespace: str):
+        return self.get_index(self.get_namespace_dimension(namespace) or settings.EMBEDDING_MODEL_MAX_DIMENSION)
+
+    def create_namespace(self, namespace: str, dimension: int = settings.EMBEDDING_MODEL_DIMENSION):
+        # Pinecone creates namespaces implicitly on the first upsert
+        self.get_index(dimension)
+
+    def upsert(self, vectors: list, namespace: str):
+        dimension = len(vectors[0][1])
+        response = self.get_index(dimension).upsert(vectors=vectors, namespace=namespace)
+        self._namespaces[namespace] = dimension
+        return response
+
+    def query(self, vector, namespace: str, top_k: int = 20,
+              include_values: bool = False, include_metadata: bool = True) -> QueryResult:
+        results = self.get_index(len(vector)).query(
+            vector=list(vector),
+            namespace=namespace,
+            top_k=top_k,
+            include_values=include_values,
+            include_metadata=include_metadata
+        )
+        matches = [
+            VectorMatch(
+                id=match.id,
+                score=match.score,
+                metadata=dict(match.metadata or {}),
+                values=list(match.values) if include_values and match.values else None
+            )
+            for match in results.matches
+        ]
+        return QueryResult(matches=matches, namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, tuple]:
+        index = self._get_namespace_index(namespace)
+        vectors = {}
+        # keep the ids of a request within the URL length limit
+        for i in range(0, len(ids), 100):
+            response = index.fetch(ids=list(ids[i:i+100]), namespace=namespace)
+            for vector_id, vector in response.vectors.items():
+                vectors[vector_id] = (list(vector.values), dict(vector.metadata or {}))
+        return vectors
+
+    def list_ids(self, namespace: str) -> List[str]:
+        ids = []
+        for page in self._get_namespace_index(namespace).list(namespace=namespace):
+            ids.extend(page)
+        return ids
+
+    def delete(self, ids: List[str], namespace: str):
+        ids = list(ids)
+        index = self._get_namespace_index(namespace)
+        # Pinecone accepts at most 1000 ids per delete request
+        for i in range(0, len(ids), 1000):
+            index.delete(ids=ids[i:i+1000], namespace=namespace)
+
+    def delete_namespace(self, namespace: str, dimension: int = None):
+        """
+        Deletes a namespace, from the index of ``dimension`` when given (a
+        namespace being migrated is in two indexes for a while).
+        """
+        if dimension is None:
+            dimension = self.get_namespace_dimension(namespace) or settings.EMBEDDING_MODEL_MAX_DIMENSION
+        self.get_index(dimension).delete(delete_all=True, namespace=namespace)
+        if self._namespaces.get(namespace) == dimension:
+            self._namespaces.pop(namespace, None)
+
+
+LOCAL_INDEX_TYPES = ("flat", "sq8", "pq", "ivf_sq8", "ivf_pq")
+
+
+def get_ivf_nlist(total_vectors: int) -> int:
+    nlist = settings.LOCAL_INDEX_IVF_NLIST or int(4 * total_vectors ** 0.5)
+    # faiss wants about 39 training vectors per list
+    return max(1, min(nlist, total_vectors // 39))
+
+
+def min_training_vectors(index_type: str) -> int:
+    """
+    Vectors needed to train an index type. Smaller namespaces use a flat index.
+    """
+    if index_type == "flat":
+        return 0
+    if index_type == "sq8":
+        return 1
+    if index_type == "pq":
+        return 2 ** settings.LOCAL_INDEX_PQ_BITS
+    return max(settings.LOCAL_INDEX_IVF_MIN_VECTORS, 2 ** settings.LOCAL_INDEX_PQ_BITS)
+
+
+def build_local_index(index_type: str, dimension: int, training_vectors: np.ndarray = None):
+    """
+    Creates an empty, trained FAISS index of the given type, searched by
+    inner product and wrapped in an IndexIDMap2 so vectors keep their labels.
+
+    Args:
+        index_type (str): One of LOCAL_INDEX_TYPES.
+        dimension (int): Vector dimension.
+        training_vectors (np.ndarray): Normalized vectors to train the quantizers.
+
+    Returns:
+        faiss.IndexIDMap2: The index, flat when there are not enough training vectors.
+    """
+    if index_type not in LOCAL_INDEX_TYPES:
+        raise ValueError(f"Unknown local index type: {index_type}")
+    total = 0 if training_vectors is None else len(training_vectors)
+    if index_type == "flat" or total < min_training_vectors(index_type):
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+
+    metric = faiss.METRIC_INNER_PRODUCT
+    pq_m = max(1, dimension // settings.LOCAL_INDEX_PQ_SUBVECTOR_DIM)
+    while dimension % pq_m:
+        pq_m -= 1
+    if index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    elif index_type == "pq":
+        index = faiss.IndexPQ(dimension, pq_m, settings.LOCAL_INDEX_PQ_BITS, metric)
+    else:
+        quantizer = faiss.IndexFlatIP(dimension)
+        nlist = get_ivf_nlist(total)
+        if index_type == "ivf_sq8":
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit, metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, settings.LOCAL_INDEX_PQ_BITS, metric)
+        index.nprobe = min(settings.LOCAL_INDEX_IVF_NPROBE, nlist)
+    logger.info("Training %s index on %d vectors...", index_type, total)
+    index.train(np.ascontiguousarray(training_vectors, dtype=np.float32))
+    return faiss.IndexIDMap2(index)
+
+
+class LocalFaissBackend(VectorBackend):
+    """
+    Vector backend kept on local disk, one directory per namespace.
+
+    Layout of ``<base_path>/<namespace>/``:
+
+    - ``metadata.json``: dimension, index type, label count and removed labels.
+    - ``vectors.f32``: the L2 normalized float32 vectors, one row per label.
+    - ``chunks.bin`` and ``chunks.idx``: the id and metadata (with the chunk
+      text) of each label, see ChunkStore.
+    - ``index.faiss``: the codes of a quantized namespace, once trained.
+
+    Vectors and chunks are memory mapped: opening a namespace only reads
+    metadata.json (and maps the codes of a quantized one), a chunk is
+    decoded when a search returns it, and the worker processes of a node
+    share the page cache. Flat namespaces are searched exactly over the
+    mapped vectors. Quantized ones (see settings.LOCAL_INDEX_TYPE) search
+    the codes and re-rank the candidates with the mapped vectors. Vectors
+    are searched by inner product, so scores are cosine similarities like
+    the Pinecone index.
+
+    Open namespaces live in the process-wide NamespacePool, which closes the
+    least recently used ones when the memory cap is reached. Each open
+    namespace has its own lock: queries hold it while they search, so they
+    never see an upsert or delete of the ingestion half done. Upserts append
+    to the vectors and chunks files; metadata.json and index.faiss are
+    written by ``flush`` (deletes and index type changes flush right away),
+    and rows after the label count of metadata.json are not read. Namespaces
+    with pending upserts are written when the pool evicts them.
+    """
+
+    name = "local"
+    INDEX_FILE = "index.faiss"
+    METADATA_FILE = "metadata.json"
+    VECTORS_FILE = "vectors.f32"
+    CHUNKS_FILE = "chunks.bin"
+    LABEL_MEMORY_BYTES = 200  # id string and dict slot of a loaded id -> label map
+
+    def __init__(self, base_path: str = settings.LOCAL_VECTOR_STORE_PATH, pool: NamespacePool = None):
+        self.base_path = base_path
+        self._pool = pool or get_namespace_pool()
+        self._dirty = {}  # namespace -> open namespace with upserts not written yet
+        self._lock = threading.RLock()
+
+    def get_namespace_path(self, namespace: str) -> str:
+        return os.path.join(self.base_path, namespace)
+
+    def _pool_key(self, namespace: str) -> tuple:
+        return (self.name, self.base_path, namespace)
+
+    def _memory_size(self, namespace: str, data: dict) -> int:
+        """
+        Estimated memory of an open namespace: what a query keeps resident,
+        the codes of a quantized index or the memory mapped vectors of a flat
+        one (every search reads them all), the offsets of the chunk store,
+        and the id map once loaded. Chunk records and the vectors re-ranked
+        by quantized namespaces are only read for a few labels.
+        """
+        size = data["next_label"] * 8  # chunk store offsets
+        index_file = os.path.join(self.get_namespace_path(namespace), self.INDEX_FILE)
+        if data["index"] is not None:
+            # codes take at most a byte per dimension until they are written
+            size += os.path.getsize(index_file) if os.path.exists(index_file) else \
+                data["index"].ntotal * data["dimension"]
+        else:
+            size += data["next_label"] * data["dimension"] * 4
+        if data["labels"] is not None:
+            size += len(data["labels"]) * self.LABEL_MEMORY_BYTES
+        return size
+
+    def _pool_put(self, namespace: str, data: dict):
+        self._pool.put(self._pool_key(namespace), data, self._memory_size(namespace, data), self._on_evict)
+
+    def _on_evict(self, key: tuple, data: dict):
+        # runs in the thread that grew the pool: the pool is never resized
+        # while a namespace lock is held, so the lock order stays backend -> namespace
+        namespace = key[2]
+        with self._lock:
+            # pending upserts are written when the pool drops the namespace, unless
+            # a _load put it back in the meantime, so _dirty only holds open namespaces
+            if self._dirty.get(namespace) is data and key not in self._pool:
+                del self._dirty[namespace]
+                with data["lock"]:
+                    self._write(namespace, data)
+
+    def get_default_index_type(self, namespace: str) -> str:
+        return settings.LOCAL_INDEX_TYPES.get(namespace, settings.LOCAL_INDEX_TYPE)
+
+    def get_index_type(self, namespace: str) -> str:
+        if not self.namespace_exists(namespace):
+            return self.get_default_index_type(namespace)
+        return self._load(namespace)["index_type"]
+
+    def get_namespace_dimension(self, namespace: str) -> Optional[int]:
+        if not self.namespace_exists(namespace):
+            return None
+        return self._load(namespace)["dimension"]
+
+    def namespace_exists(self, namespace: str) -> bool:
+        if namespace in self._dirty or self._pool_key(namespace) in self._pool:
+            return True
+        return os.path.exists(os.path.join(self.get_namespace_path(namespace), self.METADATA_FILE))
+
+    def create_namespace(self, namespace: str, dimension: int = settings.EMBEDDING_MODEL_DIMENSION,
+                         index_type: str = None):
+        with self._lock:
+            if self.namespace_exists(namespace):
+                return self._load(namespace)
+            index_type = index_type or self.get_default_index_type(namespace)
+            logger.info("Creating local %s namespace %s with dimension %d", index_type, namespace, dimension)
+            data = {
+                "index": None,  # faiss index of the codes, trained quantized namespaces only
+                "index_mapped": False,  # read only memory map of index.faiss, copied before a write
+                "index_type": index_type,
+                "trained_on": 0,  # vectors the quantizers were trained on, 0 = exact search for now
+                "dimension": dimension,
+                "next_label": 0,
+                "removed": set(),  # labels of deleted vectors, their rows stay in the files
+                "vectors": None,   # memory map of the vectors
+                "chunks": None,    # ChunkStore of the ids and metadata
+                "labels": {},      # id -> label, loaded on the first write or fetch
+                "lock": threading.RLock(),
+            }
+            self._pool_put(namespace, data)
+            return data
+
+    def _load(self, namespace: str) -> dict:
+        data = self._pool.get(self._pool_key(namespace))
+        if data is not None:
+            return data
+        with self._lock:
+            data = self._dirty.get(namespace)
+            if data is not None:
+                # evicted with pending upserts not written yet, back to the pool
+                self._pool_put(namespace, data)
+                return data
+            # another thread may have opened it in the meantime
+            return self._pool.peek(self._pool_key(namespace)) or self._read(namespace)
+
+    def _read(self, namespace: str) -> dict:
+        path = self.get_namespace_path(namespace)
+        logger.info("Opening local namespace %s", path)
+        with open(os.path.join(path, self.METADATA_FILE), "r", encoding="utf-8") as f:
+            stored = json.load(f)
+        if "entries" in stored:
+            stored = self._upgrade(namespace, stored)
+        data = {
+            "index": None,
+            "index_mapped": False,
+            "index_type": stored["index_type"],
+            "trained_on": stored["trained_on"],
+            "dimension": stored["dimension"],
+            "next_label": stored["next_label"],
+            "removed": set(stored["removed"]),
+            "vectors": None,
+            "chunks": None,
+            "labels": None,
+            "lock": threading.RLock(),
+        }
+        if data["trained_on"] > 0:
+            data["index"] = faiss.read_index(os.path.join(path, self.INDEX_FILE), FAISS_MMAP_FLAGS)
+            data["index_mapped"] = True
+        self._pool_put(namespace, data)
+        return data
+
+    def _upgrade(self, namespace: str, stored: dict) -> dict:
+        """
+        Converts, once, a namespace written by older versions: chunk texts in
+        metadata.json and the vectors of flat namespaces only in index.faiss.
+        """
+        path = self.get_namespace_path(namespace)
+        logger.info("Converting local namespace %s to memory mapped files", path)
+        entries = {int(label): entry for label, entry in stored["entries"].items()}
+        next_label, dimension = stored["next_label"], stored["dimension"]
+        vectors_file = os.path.join(path, self.VECTORS_FILE)
+        if not os.path.exists(vectors_file):
+            # flat namespace: its vectors are in the index
+            index = faiss.read_index(os.path.join(path, self.INDEX_FILE), FAISS_MMAP_FLAGS)
+            vectors = np.zeros((next_label, dimension), dtype=np.float32)
+            for label in entries:
+                vectors[label] = index.reconstruct(label)
+            vectors.tofile(vectors_file + ".tmp")
+            os.replace(vectors_file + ".tmp", vectors_file)
+        ChunkStore.write(os.path.join(path, self.CHUNKS_FILE),
+                         [entries.get(label, {"id": None, "metadata": {}}) for label in range(next_label)])
+        upgraded = {
+            "dimension": dimension,
+            "index_type": stored.get("index_type", "flat"),
+            "trained_on": stored.get("trained_on", 0),
+            "next_label": next_label,
+            "removed": [label for label in range(next_label) if label not in entries],
+        }
+        if upgraded["trained_on"] == 0 and os.path.exists(os.path.join(path, self.INDEX_FILE)):
+            os.remove(os.path.join(path, self.INDEX_FILE))
+        self._write_metadata(path, upgraded)
+        return upgraded
+
+    def _write_metadata(self, path: str, stored: dict):
+        tmp_file = os.path.join(path, self.METADATA_FILE + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(stored, f)
+        os.replace(tmp_file, os.path.join(path, self.METADATA_FILE))
+
+    def _write(self, namespace: str, data: dict):
+        # vectors and chunks are already appended, the label count commits them
+        path = self.get_namespace_path(namespace)
+        os.makedirs(path, exist_ok=True)
+        index_file = os.path.join(path, self.INDEX_FILE)
+        if data["index_mapped"]:
+            pass  # unchanged since it was read
+        elif data["index"] is not None:
+            faiss.write_index(data["index"], index_file + ".tmp")
+            os.replace(index_file + ".tmp", index_file)
+        elif os.path.exists(index_file):
+            os.remove(index_file)
+        self._write_metadata(path, {
+            "dimension": data["dimension"],
+            "index_type": data["index_type"],
+            "trained_on": data["trained_on"],
+            "next_label": data["next_label"],
+            "removed": sorted(data["removed"]),
+        })
+
+    def _save(self, namespace: str, data: dict):
+        self._write(namespace, data)
+        # put back as well, in case the pool dropped it while it was being written
+        self._pool_put(namespace, data)
+
+    def flush(self, namespace: str):
+        with self._lock:
+            data = self._dirty.pop(namespace, None)
+            if data is not None:
+                self._save(namespace, data)
+
+    def _append(self, namespace: str, data: dict, values: np.ndarray, records: List[Dict]):
+        """
+        Writes vectors and their chunk records after the current labels,
+        over the rows an interrupted writer may have left there.
+        """
+        path = self.get_namespace_path(namespace)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, self.VECTORS_FILE), "ab") as f:
+            f.truncate(data["next_label"] * data["dimension"] * 4)
+            f.write(np.ascontiguousarray(values, dtype=np.float32).tobytes())
+        ChunkStore.append(os.path.join(path, self.CHUNKS_FILE), records, count=data["next_label"])
+
+    def _get_vectors(self, namespace: str, data: dict) -> np.ndarray:
+        """
+        Vectors of the namespace, memory mapped up to the label count.
+        """
+        vectors = data["vectors"]
+        if vectors is None or len(vectors) < data["next_label"]:
+            if data["next_label"] == 0:
+                return np.zeros((0, data["dimension"]), dtype=np.float32)
+            vectors = np.memmap(os.path.join(self.get_namespace_path(namespace), self.VECTORS_FILE),
+                                dtype=np.float32, mode="r", shape=(data["next_label"], data["dimension"]))
+            data["vectors"] = vectors
+        return vectors
+
+    def _get_chunks(self, namespace: str, data: dict) -> ChunkStore:
+        chunks = data["chunks"]
+        if chunks is None or len(chunks) < data["next_label"]:
+            chunks = ChunkStore(os.path.join(self.get_namespace_path(namespace), self.CHUNKS_FILE),
+                                count=data["next_label"])
+            if len(chunks) < data["next_label"]:
+                raise Exception(f"Chunk store of {namespace} has {len(chunks)} chunks "
+                                f"for {data['next_label']} labels")
+            data["chunks"] = chunks
+        return chunks
+
+    def _get_labels(self, namespace: str, data: dict) -> Dict[str, int]:
+        """
+        The id -> label map, read from the chunk store the first time it is needed.
+        """
+        if data["labels"] is None:
+            chunks = self._get_chunks(namespace, data) if data["next_label"] else []
+            data["labels"] = {chunks[label]["id"]: label
+                              for label in range(data["next_label"]) if label not in data["removed"]}
+        return data["labels"]
+
+    def _get_writable_index(self, namespace: str, data: dict):
+        """
+        The codes of the namespace, read into memory the first time a write
+        changes them (the memory map of index.faiss is read only).
+        """
+        if data["index_mapped"]:
+            data["index"] = faiss.read_index(os.path.join(self.get_namespace_path(namespace), self.INDEX_FILE))
+            data["index_mapped"] = False
+        return data["index"]
+
+    def _live_labels(self, data: dict) -> np.ndarray:
+        removed = np.fromiter(data["removed"], dtype=np.int64, count=len(data["removed"]))
+        return np.setdiff1d(np.arange(data["next_label"], dtype=np.int64), removed)
+
+    def _rebuild_index(self, namespace: str, data: dict):
+        """
+        Builds the codes of the namespace type again from its vectors,
+        training the quantizers on all of them. Flat namespaces, and the
+        ones without enough vectors to train, have no codes.
+        """
+        labels = self._live_labels(data)
+        if data["index_type"] == "flat" or len(labels) < min_training_vectors(data["index_type"]):
+            data["index"] = None
+            data["index_mapped"] = False
+            data["trained_on"] = 0
+            return
+        vectors = np.array(self._get_vectors(namespace, data)[labels])
+        index = build_local_index(data["index_type"], data["dimension"], vectors)
+        index.add_with_ids(vectors, labels)
+        data["index"] = index
+        data["index_mapped"] = False
+        data["trained_on"] = len(labels)
+
+    def _train_if_needed(self, namespace: str, data: dict):
+        if data["index_type"] == "flat":
+            return
+        total = data["next_label"] - len(data["removed"])
+        trained_on = data["trained_on"]
+        # first training once there are enough vectors, then again when the namespace doubles
+        if (trained_on == 0 and total >= min_training_vectors(data["index_type"])) or \
+                (trained_on > 0 and total >= 2 * trained_on):
+            self._rebuild_index(namespace, data)
+
+    def set_index_type(self, namespace: str, index_type: str):
+        """
+        Converts a namespace to another index type, e.g. from "flat" to "sq8".
+        """
+        if index_type not in LOCAL_INDEX_TYPES:
+            raise ValueError(f"Unknown local index type: {index_type}")
+        with self._lock:
+            data = self._load(namespace)
+            if data["index_type"] == index_type:
+                return
+            with data["lock"]:
+                logger.info("Converting namespace %s from %s to %s", namespace, data["index_type"], index_type)
+                data["index_type"] = index_type
+                self._rebuild_index(namespace, data)
+            self._dirty[namespace] = data
+            self.flush(namespace)
+
+    def memory_stats(self, namespace: str) -> dict:
+        """
+        Bytes a query searches in a namespace: the in-memory codes of a
+        quantized namespace, or the memory mapped vectors of a flat one.
+        """
+        data = self._load(namespace)
+        with data["lock"]:
+            total = data["next_label"] - len(data["removed"])
+            if data["index"] is not None:
+                index_bytes = len(faiss.serialize_index(data["index"]))
+            else:
+                index_bytes = total * data["dimension"] * 4
+        return {
+            "index_type": data["index_type"],
+            "quantized": data["trained_on"] > 0,
+            "vectors": total,
+            "index_bytes": index_bytes,
+            "bytes_per_vector": index_bytes / total if total else 0.0,
+        }
+
+    def _remove_ids(self, namespace: str, data: dict, ids: List[str]):
+        labels_by_id = self._get_labels(namespace, data)
+        labels = [labels_by_id.pop(vector_id) for vector_id in ids if vector_id in labels_by_id]
+        if not labels:
+            return
+        data["removed"].update(labels)
+        if data["index"] is not None:
+            self._get_writable_index(namespace, data).remove_ids(np.array(labels, dtype=np.int64))
+
+    def upsert(self, vectors: list, namespace: str):
+        if not vectors:
+            return
+        values = np.asarray([vector for _, vector, _ in vectors], dtype=np.float32)
+        self.bulk_upsert(
+            [str(vector_id) for vector_id, _, _ in vectors], values,
+            [metadata for _, _, metadata in vectors], namespace)
+        return {"upserted_count": len(vectors)}
+
+    def bulk_upsert(self, ids: List[str], vectors: np.ndarray, metadatas: List[Dict], namespace: str) -> int:
+        # in-process: append the whole matrix at once, the label count is committed by flush
+        if len(ids) == 0:
+            return 0
+        values = np.array(vectors, dtype=np.float32)
+        faiss.normalize_L2(values)
+        with self._lock:
+            data = self.create_namespace(namespace, dimension=vectors.shape[1])
+            with data["lock"]:
+                self._remove_ids(namespace, data, ids)
+                labels = np.arange(data["next_label"], data["next_label"] + len(ids), dtype=np.int64)
+                self._append(namespace, data, values, [
+                    {"id": vector_id, "metadata": metadata or {}} for vector_id, metadata in zip(ids, metadatas)])
+                labels_by_id = self._get_labels(namespace, data)
+                for label, vector_id in zip(labels.tolist(), ids):
+                    labels_by_id[vector_id] = label
+                # rows and chunks are written first: a label is never searchable before them
+                data["next_label"] += len(ids)
+                if data["index"] is not None:
+                    self._get_writable_index(namespace, data).add_with_ids(values, labels)
+                self._train_if_needed(namespace, data)
+            self._dirty[namespace] = data
+            self._pool.resize(self._pool_key(namespace), self._memory_size(namespace, data))
+        return len(ids)
+
+    def query(self, vector, namespace: str, top_k: int = 20,
+              include_values: bool = False, include_metadata: bool = True) -> QueryResult:
+        if not self.namespace_exists(namespace):
+            return QueryResult(matches=[], namespace=namespace)
+        data = self._load(namespace)
+        with data["lock"]:
+            return self._search(namespace, data, vector, top_k, include_values, include_metadata)
+
+    def _search(self, namespace: str, data: dict, vector, top_k: int,
+                include_values: bool, include_metadata: bool) -> QueryResult:
+        total = data["next_label"] - len(data["removed"])
+        if total == 0:
+            return QueryResult(matches=[], namespace=namespace)
+
+        query_vector = np.asarray([vector], dtype=np.float32)
+        faiss.normalize_L2(query_vector)
+        vectors = self._get_vectors(namespace, data)
+        index = data["index"]
+        if index is not None:
+            # approximate candidates from the codes, exact scores from the vectors
+            _, candidates = index.search(query_vector, min(top_k * settings.LOCAL_INDEX_RERANK_FACTOR, index.ntotal))
+            candidates = candidates[0][(candidates[0] >= 0) & (candidates[0] < data["next_label"])]
+            exact_scores = vectors[candidates] @ query_vector[0]
+            order = np.argsort(-exact_scores)[:top_k]
+            scores, labels = exact_scores[order].tolist(), candidates[order].tolist()
+        else:
+            # exact search over the mapped vectors
+            exact_scores = np.asarray(vectors @ query_vector[0])
+            if data["removed"]:
+                exact_scores[np.fromiter(data["removed"], dtype=np.int64, count=len(data["removed"]))] = -np.inf
+            k = min(top_k, total)
+            top = np.argpartition(-exact_scores, k - 1)[:k]
+            top = top[np.argsort(-exact_scores[top])]
+            scores, labels = exact_scores[top].tolist(), top.tolist()
+
+        chunks = self._get_chunks(namespace, data)
+        matches = []
+        for score, label in zip(scores, labels):
+            record = chunks[label]
+            matches.append(VectorMatch(
+                id=record["id"],
+                score=score,
+                metadata=record["metadata"] if include_metadata else {},
+                values=vectors[label].tolist() if include_values else None
+            ))
+        return QueryResult(matches=matches, namespace=namespace)
+
+    def fetch(self, ids: List[str], namespace: str) -> Dict[str, tuple]:
+        if not self.namespace_exists(namespace):
+            return {}
+        data = self._load(namespace)
+        vectors = {}
+        with data["lock"]:
+            labels_by_id = self._get_labels(namespace, data)
+            full_vectors = self._get_vectors(namespace, data)
+            chunks = self._get_chunks(namespace, data)
+            for vector_id in ids:
+                label = labels_by_id.get(str(vector_id))
+                if label is None:
+                    continue
+                vectors[str(vector_id)] = (full_vectors[label].tolist(), chunks[label]["metadata"])
+        # the id map may have been loaded, resized outside the namespace lock (see _on_evict)
+        self._pool.resize(self._pool_key(namespace), self._memory_size(namespace, data))
+        return vectors
+
+    def list_ids(self, namespace: str) -> List[str]:
+        if not self.namespace_exists(namespace):
+            return []
+        data = self._load(namespace)
+        with data["lock"]:
+            ids = list(self._get_labels(namespace, data).keys())
+        self._pool.resize(self._pool_key(namespace), self._memory_size(namespace, data))
+        return ids
+
+    def delete(self, ids: List[str], namespace: str):
+        if not ids or not self.namespace_exists(namespace):
+            return
+        with self._lock:
+            data = self._load(namespace)
+            with data["lock"]:
+                self._remove_ids(namespace, data, [str(vector_id) for vector_id in ids])
+            self._dirty[namespace] = data
+            self.flush(namespace)
+
+    def delete_namespace(self, namespace: str):
+        with self._lock:
+            self._dirty.pop(namespace, None)
+            self._pool.pop(self._pool_key(namespace))
+            path = self.get_namespace_path(namespace)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def replace_namespace(self, namespace: str, source_path: str):
+        """
+        Replaces the files of a namespace with a namespace written elsewhere,
+        e.g. rebuilt by another LocalFaissBackend in a temporary directory of
+        the same file system. The old files are only removed once the new
+        ones are in place.
+        """
+        with self._lock:
+            self._dirty.pop(namespace, None)
+            self._pool.pop(self._pool_key(namespace))
+            path = self.get_namespace_path(namespace)
+            old_path = f"{path}.old-{int(time.time())}"
+            if os.path.exists(path):
+                os.replace(path, old_path)
+            os.replace(source_path, path)
+            if os.path.exists(old_path):
+                shutil.rmtree(old_path)
+
+
+def get_vector_backend(backend_name: str = '') -> VectorBackend:
+    """
+    Creates the vector backend selected in settings.
+
+    Args:
+        backend_name (str): "pinecone" or "local". Defaults to settings.VECTOR_BACKEND.
+
+    Returns:
+        VectorBackend: The backend instance
+    """
+    if backend_name == '':
+        backend_name = settings.VECTOR_BACKEND
+    if backend_name == LocalFaissBackend.name:
+        return LocalFaissBackend()
+    if backend_name == PineconeBackend.name:
+        return PineconeBackend()
+    raise ValueError(f"Unknown vector backend: {backend_name}")
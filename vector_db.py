@@ -1,6 +1,7 @@
 import json
 import os
 import sqlite3
+from collections.abc import Mapping
 import numpy as np
 import faiss
 from requests_aws4auth import AWS4Auth
@@ -8,9 +9,59 @@ from opensearchpy.helpers import bulk
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
 import tiktoken
 import settings
+from chunk_store import ChunkStore
+from cost_model import COST_MODEL, Usage, count_tokens
+from namespace_pool import get_namespace_pool
 from utils import extract_from_html_page, extract_from_pdf
+from vector_backend import FAISS_MMAP_FLAGS
+
+
+class ChunkStoreDocstore(Docstore):
+    """
+    Read-only LangChain docstore over a ChunkStore. Docstore ids are the
+    FAISS labels, so a search decodes only the record at that position.
+    """
+
+    def __init__(self, store: ChunkStore):
+        self.store = store
+
+    def search(self, search: str):
+        try:
+            record = self.store[int(search)]
+        except (IndexError, ValueError):
+            return f"ID {search} not found."
+        return Document(page_content=record["text"], metadata=record["metadata"], id=record["id"])
+
+    def add(self, texts: dict):
+        raise NotImplementedError("ChunkStoreDocstore is read-only")
+
+    def delete(self, ids: list):
+        raise NotImplementedError("ChunkStoreDocstore is read-only")
+
+
+class LabelMapping(Mapping):
+    """
+    FAISS label -> docstore id without building a dict: they are the same number.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __getitem__(self, label: int) -> str:
+        if not 0 <= label < self.size:
+            raise KeyError(label)
+        return str(label)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self) -> int:
+        return self.size
+
 
 class VectorDatabase:
     
@@ -35,11 +86,10 @@ class VectorDatabase:
         Returns:
             int: The number of tokens.
         """
-        tokens = self.tokenizer.encode(text)
-        return len(tokens)
+        return count_tokens(self.tokenizer, [text])
     
     def calculate_cost(self, total_tokens: int) -> float:
-        return total_tokens * settings.OPEN_AI_EMBEDDING_PRICE_PER_TOKEN
+        return COST_MODEL.cost(Usage(embedding_tokens=total_tokens))
     
     def create_vectorstore(self, doc_uuid: str, text_chunks: str):
         self.total_tokens = 0
@@ -47,8 +97,7 @@ class VectorDatabase:
                 
         # if not found create new vector        
         faiss_index = FAISS.from_texts(text_chunks, self.embeddings)
-        self.total_tokens = sum(self.calculate_tokens(chunk)
-                                for chunk in text_chunks)
+        self.total_tokens = count_tokens(self.tokenizer, text_chunks)
         self.price_usage = self.calculate_cost(self.total_tokens)                        
         self.save_faiss_vectors(faiss_index=faiss_index, doc_uuid=doc_uuid) 
         return faiss_index
@@ -82,22 +131,69 @@ class VectorDatabase:
 
     def get_file_name_faiss_index(self, doc_uuid):
         return f"{doc_uuid}_index.faiss"
-        
+
     def save_faiss_vectors(self, faiss_index, doc_uuid):
+        """
+        Writes ``<uuid>_index.faiss/index.faiss`` and the chunk texts and
+        metadata to ``chunks.bin`` (see ChunkStore), in FAISS label order.
+        """
         faiss_file = self.get_file_name_faiss_index(doc_uuid)
-        faiss_index.save_local(faiss_file)        
+        os.makedirs(faiss_file, exist_ok=True)
+        records = []
+        for label in range(faiss_index.index.ntotal):
+            docstore_id = faiss_index.index_to_docstore_id[label]
+            doc = faiss_index.docstore.search(docstore_id)
+            records.append({"id": str(docstore_id), "text": doc.page_content, "metadata": doc.metadata})
+        ChunkStore.write(os.path.join(faiss_file, "chunks.bin"), records)
+        faiss.write_index(faiss_index.index, os.path.join(faiss_file, "index.faiss"))
+        get_namespace_pool().pop(("faiss", faiss_file))
         print('Vectors successfully saved in local path.', faiss_file)
-        
+
+    def convert_legacy_faiss_index(self, doc_uuid):
+        """
+        Replaces the pickled LangChain docstore (index.pkl) of an index saved
+        by older versions with a chunk store. Only runs once per index.
+        """
+        faiss_file = self.get_file_name_faiss_index(doc_uuid)
+        print("Converting pickled docstore to chunk store... ", faiss_file)
+        legacy_db = FAISS.load_local(
+            faiss_file, self.embeddings,
+            allow_dangerous_deserialization=True)
+        self.save_faiss_vectors(legacy_db, doc_uuid)
+        os.remove(os.path.join(faiss_file, "index.pkl"))
+
     def get_faiss_by_id(self, doc_uuid):
+        """
+        Opens a saved index without reading it into memory: the FAISS index is
+        memory mapped and chunk texts are decoded on demand from the chunk store.
+        Indexes saved by older versions (index.pkl) are converted once.
+        Open indexes are kept in the process-wide NamespacePool.
+        """
         faiss_file = self.get_file_name_faiss_index(doc_uuid)
+        pool = get_namespace_pool()
+        new_db = pool.get(("faiss", faiss_file))
+        if new_db is not None:
+            return new_db
         if not os.path.exists(faiss_file):
             print(f"Vectorstore not found: {faiss_file}")
             return None
-        
+
+        chunks_file = os.path.join(faiss_file, "chunks.bin")
+        if not os.path.exists(chunks_file) and os.path.exists(os.path.join(faiss_file, "index.pkl")):
+            self.convert_legacy_faiss_index(doc_uuid)
+
         print("Loading vectorstore... ", faiss_file)
-        new_db = FAISS.load_local(
-            faiss_file, self.embeddings,
-            allow_dangerous_deserialization=True)
+        index = faiss.read_index(os.path.join(faiss_file, "index.faiss"), FAISS_MMAP_FLAGS)
+        store = ChunkStore(chunks_file)
+        if len(store) != index.ntotal:
+            raise Exception(f"Chunk store of {faiss_file} has {len(store)} chunks for {index.ntotal} vectors")
+        new_db = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=ChunkStoreDocstore(store),
+            index_to_docstore_id=LabelMapping(index.ntotal))
+        # the chunk store is page cache, only the index counts
+        pool.put(("faiss", faiss_file), new_db, os.path.getsize(os.path.join(faiss_file, "index.faiss")))
         return new_db
         
     
@@ -1,66 +1,71 @@
+import hashlib
 import json
 import os
 import sqlite3
+import time
 import numpy as np
 import faiss
-from pinecone.grpc import PineconeGRPC as Pinecone
-from pinecone import ServerlessSpec
 from requests_aws4auth import AWS4Auth
 from opensearchpy.helpers import bulk
 from opensearchpy import OpenSearch, RequestsHttpConnection
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from pinecone import Pinecone, ServerlessSpec
-import tiktoken
 import settings
-from utils import extract_from_html_page, extract_from_pdf, download_pdf
+from utils import extract_from_html_page, extract_chunks_from_pdf, download_pdf
 from streamlit.logger import get_logger
-from rag import RAGService
+from pdf_extractor import TextChunk, chunk_metadata
+from ingestion import IngestionPipeline, IngestionProgress
+from vector_backend import VectorBackend
+import resources
+from answer_cache import get_answer_cache
+from index_manifest import IndexManifest, ManifestStore, chunk_id, file_fingerprint
+import tracing
+from cost_model import COST_MODEL, Usage, count_tokens, embed_documents
 
 
 logger = get_logger(__name__)
 
 
+def as_text_chunk(chunk) -> TextChunk:
+    return chunk if isinstance(chunk, TextChunk) else TextChunk(text=chunk)
+
+
 class VectorRemoteDatabase:
     
     price_usage = 0
     total_tokens = 0
+    usage = Usage()
+    last_ingest_stats = None
     
-    def __init__(self, model_name=''):
+    def __init__(self, model_name='', backend_name='', dimension: int = settings.EMBEDDING_MODEL_DIMENSION):
         if model_name == '':
             model_name = settings.EMBEDDING_MODEL_VERSION
             
         self.model_name = model_name
-        self.tokenizer = tiktoken.encoding_for_model(model_name) 
-        self.embeddings = OpenAIEmbeddings(model=model_name)  # Specify the model here
+        # dimension of the new namespaces, existing ones keep the one they were created with
+        self.dimension = dimension
+        # clients are shared by the whole process, see resources
+        self.tokenizer = resources.get_tokenizer(model_name) 
+        self.embeddings = resources.get_embeddings(model_name, dimension)  # Specify the model here
         
-        self.pinecone = Pinecone(api_key=settings.PINECONE_API_KEY)
-        self.index_name = settings.INDEX_NAME
+        # pinecone or local FAISS, see settings.VECTOR_BACKEND
+        self.backend = resources.get_shared_vector_backend(backend_name)
+        self.manifests = ManifestStore()
+
+    def get_namespace_dimension(self, namespace: str) -> int:
+        """
+        Dimension of the vectors of a namespace, the default one when it does not exist yet.
+        """
+        return self.get_vector_index().get_namespace_dimension(namespace) or self.dimension
+
+    def embeddings_for(self, namespace: str):
+        """
+        Embeddings client that matches the dimension of the namespace.
+        """
+        dimension = self.get_namespace_dimension(namespace)
+        if dimension == self.dimension:
+            return self.embeddings
+        return resources.get_embeddings(self.model_name, dimension)
 
-    def create_index_if_not_exist(self): 
-        try:
-            index_data = self.pinecone.describe_index(self.index_name)
-            logger.info(index_data)     
-            if index_data and index_data['status']['ready']:
-                logger.info("Index already exists.")
-                return True
-        except Exception as e:
-            logger.error(f"Error: {e}")
-            
-        logger.info(f"Index {self.index_name} does not exist. Creating...")
-        self.pinecone.create_index(
-            name=self.index_name,
-            dimension=settings.EMBEDDING_MODEL_DIMENSION, 
-            metric="cosine", # better for semantic search
-            spec=ServerlessSpec(
-                cloud="aws",
-                region="us-east-1"
-            ) 
-        )
-        logger.info("Index created.") 
-        return True       
-            
-                        
     def calculate_tokens(self, text: str) -> int:
         """
         Calculate the number of tokens for the given text using the tokenizer.
@@ -71,104 +76,354 @@ class VectorRemoteDatabase:
         Returns:
             int: The number of tokens.
         """
-        tokens = self.tokenizer.encode(text)
-        return len(tokens)
+        return count_tokens(self.tokenizer, [text])
+
+    def count_tokens(self, texts: list) -> int:
+        return count_tokens(self.tokenizer, texts)
     
     def calculate_cost(self, total_tokens: int) -> float:
-        return total_tokens * settings.OPEN_AI_EMBEDDING_PRICE_PER_TOKEN
-    
-    def create_vectorstore(self, doc_uuid: str, text_chunks: str):
+        return COST_MODEL.cost(Usage(embedding_tokens=total_tokens))
+
+    def reset_usage(self):
+        self.usage = Usage()
         self.total_tokens = 0
         self.price_usage = 0
+
+    def add_usage(self, usage: Usage):
+        self.usage = self.usage + usage
+        self.total_tokens = self.usage.total_tokens
+        self.price_usage = self.usage.cost
+    
+    def create_vectorstore(self, doc_uuid: str, text_chunks: str):
+        self.reset_usage()
                 
-        # when not found create new vector
-        logger.info(f"Creating FAISS vectorstore from texts chunks with size {len(text_chunks)}...")
-        faiss_index = FAISS.from_texts(text_chunks, self.embeddings)
-        self.total_tokens = sum(self.calculate_tokens(chunk)
-                                for chunk in text_chunks)
-        logger.info(f"Total token for {doc_uuid}: {self.total_tokens}")
-        self.price_usage = self.calculate_cost(self.total_tokens)
+        # when not found create new vector, ids are derived from the chunk content
+        text_chunks = list({chunk.text: chunk for chunk in map(as_text_chunk, text_chunks)}.values())
+        if settings.INGESTION_MODE == 'faiss':
+            vector_index = self.create_vectorstore_from_faiss(doc_uuid, text_chunks)
+        else:
+            vector_index = self.embed_and_upsert(doc_uuid, text_chunks)
+        logger.info(f"Total token for {doc_uuid}: {self.total_tokens} (estimated: {self.usage.estimated})")
         logger.info(f"Price usage for {doc_uuid}: {self.price_usage}")                                
-        vector_index = self.save_faiss_vectors(faiss_index=faiss_index, doc_uuid=doc_uuid) 
+        # cached answers were generated from the previous content
+        get_answer_cache().invalidate(doc_uuid)
+        return vector_index
+
+    def create_vectorstore_from_faiss(self, doc_uuid: str, text_chunks: list):
+        logger.info(f"Creating FAISS vectorstore from texts chunks with size {len(text_chunks)}...")
+        faiss_index = FAISS.from_texts(
+            [chunk.text for chunk in text_chunks], self.embeddings_for(doc_uuid),
+            metadatas=[chunk_metadata(chunk) for chunk in text_chunks],
+            ids=[chunk_id(chunk.text) for chunk in text_chunks])
+        # FAISS.from_texts does not expose the API usage
+        self.add_usage(Usage(
+            embedding_tokens=self.count_tokens([chunk.text for chunk in text_chunks]), estimated=True))
+        return self.save_faiss_vectors(faiss_index=faiss_index, doc_uuid=doc_uuid) 
+
+    def embed_and_upsert(self, doc_uuid: str, text_chunks: list):
+        """
+        Embeds the chunks in batches and upserts each batch straight to the
+        vector backend, so only one batch of vectors is in memory at a time.
+
+        Args:
+            doc_uuid (str): The namespace.
+            text_chunks (list): TextChunk list without duplicates.
+
+        Returns:
+            VectorBackend: The vector index.
+        """
+        logger.info("Embedding %d text chunks directly into namespace %s...", len(text_chunks), doc_uuid)
+        start_time = time.perf_counter()
+        vector_index = self.get_vector_index()
+        embeddings = self.embeddings_for(doc_uuid)
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        for i in range(0, len(text_chunks), batch_size):
+            batch = text_chunks[i:i+batch_size]
+            texts = [chunk.text for chunk in batch]
+            with tracing.span("embedding_batch", doc_uuid):
+                vectors, usage = embed_documents(embeddings, texts, self.tokenizer)
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if i == 0:
+                vector_index.create_namespace(doc_uuid, dimension=vectors.shape[1])
+            with tracing.span("upsert_batch", doc_uuid):
+                vector_index.bulk_upsert(
+                    [chunk_id(text) for text in texts], vectors,
+                    [chunk_metadata(chunk) for chunk in batch], namespace=doc_uuid)
+            self.add_usage(usage)
+            logger.info("Embedded %d of %d chunks", min(i + batch_size, len(text_chunks)), len(text_chunks))
+        vector_index.flush(doc_uuid)
+
+        self.log_ingest_throughput(doc_uuid, len(text_chunks), time.perf_counter() - start_time)
         return vector_index
+
+    def update_vectorstore(self, doc_uuid: str, text_chunks: list, source_fingerprint: str = None,
+                           manifest: IndexManifest = None, file_hash: str = None):
+        """
+        Brings a namespace in line with the given chunks: only chunks whose
+        content hash is not indexed yet are embedded, and vectors of chunks
+        that disappeared from the source are deleted.
+
+        Args:
+            doc_uuid (str): The namespace.
+            text_chunks (list): All text chunks (str or TextChunk) of the current source.
+            source_fingerprint (str): Fingerprint of the source, stored in the manifest.
+            manifest (IndexManifest): The current manifest of the namespace, if any.
+            file_hash (str): Hash of the source file, stored in the manifest.
+
+        Returns:
+            VectorBackend: The vector index.
+        """
+        self.reset_usage()
+        chunks_by_id = {chunk_id(chunk.text): chunk for chunk in map(as_text_chunk, text_chunks)}
+        if not self.namespace_exists(namespace=doc_uuid):
+            indexed_ids = set()
+        elif manifest is not None:
+            indexed_ids = set(manifest.chunk_ids)
+        else:
+            # no manifest on this node, rebuild it from the ids stored in the backend
+            indexed_ids = set(self.get_vector_index().list_ids(doc_uuid))
+
+        new_ids = [i for i in chunks_by_id if i not in indexed_ids]
+        vanished_ids = [i for i in indexed_ids if i not in chunks_by_id]
+        logger.info("Namespace %s: %d chunks, %d new, %d vanished",
+                    doc_uuid, len(chunks_by_id), len(new_ids), len(vanished_ids))
+
+        if new_ids:
+            self.create_vectorstore(
+                doc_uuid=doc_uuid, text_chunks=[chunks_by_id[i] for i in new_ids])
+        if vanished_ids:
+            self.get_vector_index().delete(vanished_ids, namespace=doc_uuid)
+            get_answer_cache().invalidate(doc_uuid)
+
+        self.manifests.save(IndexManifest(
+            namespace=doc_uuid,
+            fingerprint=source_fingerprint,
+            file_hash=file_hash,
+            chunk_ids=list(chunks_by_id.keys()),
+            dimension=self.get_namespace_dimension(doc_uuid)
+        ))
+        return self.get_vector_index()
     
-    def get_or_create_vectorstore(self, doc_uuid: str, source_url='midiacode_guide'):
-        self.total_tokens = 0
-        self.price_usage = 0        
-        vector_index = self.get_pinecone_index()
+    def get_or_create_vectorstore(self, doc_uuid: str, source_url='midiacode_guide', source_fingerprint=None):
+        """
+        Returns the vector index with the namespace up to date with its source.
+
+        The namespace is left untouched when its manifest has the same source
+        fingerprint. Otherwise the source is extracted again and only the
+        changed chunks are embedded (see update_vectorstore and ingest_pdf).
+
+        Args:
+            doc_uuid (str): The namespace (settings.SOURCE_UUID or QR short code).
+            source_url (str): URL of the PDF or 'midiacode_guide'.
+            source_fingerprint (str): Cheap fingerprint of the source, e.g. from
+                the HTTP validators of the PDF. Defaults to the hash of the PDF file
+                (of the guide PDF and FAQ page for 'midiacode_guide').
+
+        Returns:
+            VectorBackend: The vector index.
+        """
+        self.reset_usage()
+        vector_index = self.get_vector_index()
                 
         logger.info("Getting vectorstore for namespace: %s", doc_uuid)
-        if self.namespace_exists(namespace=doc_uuid):
-            logger.info("Namespace %s already exists.", doc_uuid)
-            # TODO check if necessary to update vectorstore
+        if source_url != 'midiacode_guide':
+            for progress in self.ingest_pdf(doc_uuid, source_url, source_fingerprint):
+                self.usage = progress.usage
+                self.total_tokens = progress.total_tokens
+                self.price_usage = progress.price_usage
             return vector_index
 
-        if source_url == 'midiacode_guide':
-            logger.info("Creating vectorstore for namespace: %s", doc_uuid)            
-            text_chunks = self.create_midiacode_text_chunks_knowledge_base()
-        else:
-            logger.info("Creating vectorstore for namespace: %s", doc_uuid)                        
-            local_file_path = download_pdf(url=source_url)            
-            rag_service = RAGService()
-            text_chunks = rag_service.get_text_from_pdf_file(local_file_path)            
-            
-        logger.info("Creating vectorstore...")
-        vector_index = self.create_vectorstore(
-            doc_uuid=doc_uuid, text_chunks=text_chunks)
+        text_chunks_from_html = None
+        if source_fingerprint is None:
+            # the FAQ page is read once, for the fingerprint and for the chunks
+            logger.info("Extracting text from HTML: %s", settings.PAGE_URL_SOURCE)
+            text_chunks_from_html = extract_from_html_page(url=settings.PAGE_URL_SOURCE)
+            source_fingerprint = self.get_guide_fingerprint(text_chunks_from_html)
+        manifest = self.manifests.load(doc_uuid)
+        if self.is_up_to_date(doc_uuid, manifest, source_fingerprint):
+            return vector_index
+
+        logger.info("Indexing vectorstore for namespace: %s", doc_uuid)            
+        text_chunks = self.create_midiacode_text_chunks_knowledge_base(text_chunks_from_html)
+        logger.info("Updating vectorstore...")
+        vector_index = self.update_vectorstore(
+            doc_uuid=doc_uuid, text_chunks=text_chunks,
+            source_fingerprint=source_fingerprint, manifest=manifest)
         return vector_index
+
+    def get_guide_fingerprint(self, text_chunks_from_html) -> str:
+        """
+        Fingerprint of the guide namespace: the hash of the guide PDF and of the
+        text extracted from the FAQ page, so a change to either is re-ingested.
+
+        Args:
+            text_chunks_from_html (list): Chunks of the FAQ page (extract_from_html_page).
+
+        Returns:
+            str: The fingerprint, or None when the FAQ page could not be read and
+                the namespace is kept as is.
+        """
+        if text_chunks_from_html is None:
+            logger.warning("Could not read %s, keeping the guide namespace as is.", settings.PAGE_URL_SOURCE)
+            return None
+        digest = hashlib.sha256(file_fingerprint(settings.PDF_FILE_PATH_SOURCE).encode())
+        for chunk in text_chunks_from_html:
+            digest.update(b"\0")
+            digest.update(as_text_chunk(chunk).text.encode())
+        return digest.hexdigest()
+
+    def is_up_to_date(self, doc_uuid: str, manifest: IndexManifest, source_fingerprint: str = None) -> bool:
+        if manifest is None or not self.namespace_exists(namespace=doc_uuid):
+            return False
+        if source_fingerprint is None or manifest.fingerprint == source_fingerprint:
+            logger.info("Namespace %s already exists and is up to date.", doc_uuid)
+            return True
+        return False
+
+    def ingest_pdf(self, doc_uuid: str, source_url: str, source_fingerprint: str = None,
+                   progress: IngestionProgress = None):
+        """
+        Brings the namespace of a PDF up to date through the streaming
+        IngestionPipeline and yields its progress. The namespace becomes
+        available (``progress.available``) once the first pages are indexed.
+
+        Args:
+            doc_uuid (str): The namespace (QR short code).
+            source_url (str): URL of the PDF.
+            source_fingerprint (str): Cheap fingerprint of the source, e.g. from
+                the HTTP validators of the PDF (contentspot.get_source_fingerprint).
+                Defaults to the hash of the PDF file.
+            progress (IngestionProgress): Progress object to update, created when None.
+
+        Yields:
+            IngestionProgress: The progress, updated after each upserted batch.
+        """
+        progress = progress or IngestionProgress(namespace=doc_uuid)
+        manifest = self.manifests.load(doc_uuid)
+        namespace_exists = self.namespace_exists(namespace=doc_uuid)
+        # without a source fingerprint the PDF is downloaded and its hash compared below
+        if source_fingerprint is not None and self.is_up_to_date(doc_uuid, manifest, source_fingerprint):
+            progress.available = progress.done = True
+            yield progress
+            return
+
+        logger.info("Indexing vectorstore for namespace: %s", doc_uuid)                        
+        with tracing.span("download_pdf", doc_uuid):
+            local_file_path = download_pdf(url=source_url)            
+        if local_file_path is None:
+            if namespace_exists:
+                logger.warning("Could not download %s, keeping namespace %s as is.", source_url, doc_uuid)
+                progress.available = progress.done = True
+                yield progress
+                return
+            raise Exception(f"Error downloading PDF: {source_url}")
+        try:
+            file_hash = file_fingerprint(local_file_path)
+            if source_fingerprint is None:
+                source_fingerprint = file_hash
+            if namespace_exists and manifest is not None and manifest.file_hash == file_hash:
+                logger.info("PDF of namespace %s did not change.", doc_uuid)
+                manifest.fingerprint = source_fingerprint
+                self.manifests.save(manifest)
+                progress.available = progress.done = True
+                yield progress
+                return
+
+            if not namespace_exists:
+                indexed_ids = set()
+            elif manifest is not None:
+                indexed_ids = set(manifest.chunk_ids)
+            else:
+                # no manifest on this node, rebuild it from the ids stored in the backend
+                indexed_ids = set(self.get_vector_index().list_ids(doc_uuid))
+
+            start_time = time.perf_counter()
+            pipeline = IngestionPipeline(self)
+            yield from pipeline.run(doc_uuid, local_file_path, indexed_ids=indexed_ids, progress=progress)
+            self.log_ingest_throughput(doc_uuid, progress.chunks_indexed, time.perf_counter() - start_time)
+
+            vanished_ids = [i for i in indexed_ids if i not in pipeline.seen_ids]
+            if vanished_ids:
+                self.get_vector_index().delete(vanished_ids, namespace=doc_uuid)
+            if vanished_ids or progress.chunks_indexed:
+                # cached answers were generated from the previous content
+                get_answer_cache().invalidate(doc_uuid)
+            logger.info("Namespace %s: %d chunks, %d new, %d vanished",
+                        doc_uuid, len(pipeline.seen_ids), progress.chunks_indexed, len(vanished_ids))
+            self.manifests.save(IndexManifest(
+                namespace=doc_uuid,
+                fingerprint=source_fingerprint,
+                file_hash=file_hash,
+                chunk_ids=list(pipeline.seen_ids),
+                dimension=self.get_namespace_dimension(doc_uuid)
+            ))
+            progress.available = progress.done = True
+            yield progress
+        finally:
+            # every job downloads to its own temporary file
+            os.remove(local_file_path)
                     
-    def create_midiacode_text_chunks_knowledge_base(self):        
+    def create_midiacode_text_chunks_knowledge_base(self, text_chunks_from_html=None):        
         # merge two sources
         logger.info("Extracting text from PDF: %s", settings.PDF_FILE_PATH_SOURCE)
-        text_chunks_from_pdf = extract_from_pdf(settings.PDF_FILE_PATH_SOURCE)
-        logger.info("Extracting text from HTML: %s", settings.PAGE_URL_SOURCE)
-        text_chunks_from_html = extract_from_html_page(url=settings.PAGE_URL_SOURCE)
-        text_chunks = text_chunks_from_pdf + text_chunks_from_html
+        text_chunks_from_pdf = extract_chunks_from_pdf(settings.PDF_FILE_PATH_SOURCE)
+        if text_chunks_from_html is None:
+            logger.info("Extracting text from HTML: %s", settings.PAGE_URL_SOURCE)
+            text_chunks_from_html = extract_from_html_page(url=settings.PAGE_URL_SOURCE)
+        text_chunks = text_chunks_from_pdf + (text_chunks_from_html or [])
         # texts = [settings.PDF_FILE_PATH_SOURCE, settings.PAGE_URL_SOURCE]
         # metadata_list = [{'text': text} for text in texts]     
         logger.info("Text chunks: %d", len(text_chunks))   
         return text_chunks
 
-    def get_pinecone_index(self):
-        self.create_index_if_not_exist()
-        while not self.pinecone.describe_index(self.index_name).status['ready']:
-            logger.info('Index not ready. Waiting...')
-            time.sleep(1)
-        return self.pinecone.Index(self.index_name)
-        
+    def get_vector_index(self) -> VectorBackend:
+        """
+        Returns the configured vector backend. It exposes the same
+        ``query``/``upsert`` calls for Pinecone and for the local FAISS store.
+        """
+        return self.backend
+
     def save_faiss_vectors(self, faiss_index, doc_uuid):
-        logger.info('Saving vectors to pinecone...')        
-        dimension = len(faiss_index.index.reconstruct(0))
-        logger.info('Vector dimension: %d', dimension)
-        pinecone_index = self.get_pinecone_index()
-
-        # Preparar dados para upsert
-        vectors_to_upsert = []
-        for i in range(faiss_index.index.ntotal):
-            logger.info('Vector %d of %d', i, faiss_index.index.ntotal)
-            # Extrair vetor
-            vector = faiss_index.index.reconstruct(i).tolist()
-            
-            # Extrair documento correspondente
-            doc_id = faiss_index.index_to_docstore_id[i]
-            doc = faiss_index.docstore.search(doc_id)
-            metadata = {"text": doc.page_content}
-            
-            # Usar doc_id como ID no Pinecone (ou gere um único)
-            logger.info('Appending vector %d of %d with id %s', i, faiss_index.index.ntotal, doc_id)
-            vectors_to_upsert.append((str(doc_id), vector, metadata))
-        
-        # Enviar em lotes (ex: 100 vetores por lote)
-        batch_size = 100
-        for i in range(0, len(vectors_to_upsert), batch_size):
-            logger.info('Batch %d of %d', i, len(vectors_to_upsert))
-            pinecone_index.upsert(vectors=vectors_to_upsert[i:i+batch_size], namespace=doc_uuid)
-                
-        logger.info('Vectors successfully saved in pinecone.')
-        return pinecone_index
+        logger.info('Saving vectors to %s backend...', self.backend.name)        
+        start_time = time.perf_counter()
+        total = faiss_index.index.ntotal
+        # all vectors at once as a (total, dimension) float32 matrix
+        vectors = faiss_index.index.reconstruct_n(0, total)
+        logger.info('Vector dimension: %d', vectors.shape[1])
+        vector_index = self.get_vector_index()
+        vector_index.create_namespace(doc_uuid, dimension=vectors.shape[1])
+
+        # Usar doc_id como ID no backend, os metadados em uma única passagem
+        ids = [str(faiss_index.index_to_docstore_id[i]) for i in range(total)]
+        docs = [faiss_index.docstore.search(doc_id) for doc_id in ids]
+        metadatas = [{"text": doc.page_content, **doc.metadata} for doc in docs]
+        with tracing.span("upsert_batch", doc_uuid):
+            vector_index.bulk_upsert(ids, vectors, metadatas, namespace=doc_uuid)
+        vector_index.flush(doc_uuid)
+
+        self.log_ingest_throughput(doc_uuid, total, time.perf_counter() - start_time)
+        return vector_index
+
+    def log_ingest_throughput(self, doc_uuid: str, total_vectors: int, seconds: float):
+        self.last_ingest_stats = {
+            "vectors": total_vectors,
+            "seconds": seconds,
+            "vectors_per_second": total_vectors / seconds if seconds > 0 else 0.0,
+        }
+        tracing.record("ingestion", seconds, doc_uuid)
+        logger.info('Vectors successfully saved in %s backend for %s: %d vectors in %.2fs (%.1f vectors/s)',
+                    self.backend.name, doc_uuid, total_vectors, seconds,
+                    self.last_ingest_stats["vectors_per_second"])
 
     def namespace_exists(self, namespace: str) -> bool:        
-        index = self.get_pinecone_index()
-        stats = index.describe_index_stats()
-        logger.info(stats)
-        return namespace in stats['namespaces']
+        with tracing.span("namespace_check", namespace):
+            return self.get_vector_index().namespace_exists(namespace)
+
+    def namespaces_exist(self, namespaces: list) -> dict:
+        """
+        Checks several namespaces (e.g. QR short codes) at once.
+
+        Returns:
+            dict: namespace -> True when it exists.
+        """
+        return self.get_vector_index().namespaces_exist(namespaces)